@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+DEFAULT_ANALYSIS_CACHE_DIR = '.cache/analysis'
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    """ファイル全体をメモリに載せずにハッシュを計算"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analysis_cache_key(content_hash, prompt, model, schema_version):
+    """解析対象の内容・プロンプト・モデル・スキーマのバージョンからキャッシュキーを作成"""
+    payload = json.dumps({
+        'content': content_hash,
+        'prompt': prompt,
+        'model': model,
+        'schema_version': schema_version,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnalysisCache:
+    """モデルの解析結果（JSON）をキーごとに保存するキャッシュ"""
+
+    def __init__(self, cache_dir=DEFAULT_ANALYSIS_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+
+    def path_for(self, key):
+        return self.cache_dir / f'{key}.json'
+
+    def get(self, key):
+        cached_path = self.path_for(key)
+        if not cached_path.exists():
+            return None
+        try:
+            with open(cached_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'解析結果のキャッシュを読み込めませんでした: {e}')
+            return None
+
+    def put(self, key, result):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cached_path = self.path_for(key)
+        tmp_path = cached_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, cached_path)
+        return cached_path
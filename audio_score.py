@@ -0,0 +1,147 @@
+import json
+import math
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ffmpeg_utils import ffmpeg_binary
+from instrumentation import measure
+from media_index import open_index, lookup_audio_scores, store_audio_scores, DEFAULT_INDEX_PATH
+
+# 音声の解析設定（インデックスのキーに含める）
+AUDIO_SETTINGS = dict(
+    sample_rate=8000,        # モノラル 8kHz に落として読む
+    frame_seconds=0.05,      # 音量を測る短い窓の長さ
+    onset_db=6.0,            # 前の窓からこれ以上大きくなったら立ち上がり（歓声・拍手・花火など）
+    silence_db=-50.0,        # これより小さい窓は立ち上がりに数えない
+    loudness_range_db=20.0,  # ファイルの中央値からこの分大きければ音量のスコアは 1
+    onset_full=4,            # 1秒あたりこの数の立ち上がりで立ち上がりのスコアは 1
+    onset_weight=0.3,        # スコアのうち立ち上がりの割合（残りは音量）
+)
+# 一度に読む秒数
+READ_SECONDS = 60
+# 1秒ごとの値の列（loudness_db, onsets, score）
+LOUDNESS, ONSETS, SCORE = range(3)
+
+
+def frame_power(samples, frame_size):
+    """短い窓ごとの平均パワー（端数の窓は捨てる）"""
+    usable = len(samples) // frame_size * frame_size
+    return np.square(samples[:usable].astype(np.float32) / 32768).reshape(-1, frame_size).mean(axis=1)
+
+
+def decode_frame_power(video_path, settings=AUDIO_SETTINGS):
+    """ffmpeg でモノラル・低サンプルレートに落とした音声を少しずつ読み、窓ごとのパワーを返す
+
+    ffmpeg が途中で失敗した場合は RuntimeError（読めた分だけのスコアを保存しないように）
+    """
+    sample_rate = settings['sample_rate']
+    frame_size = int(sample_rate * settings['frame_seconds'])
+    cmd = [
+        ffmpeg_binary(), '-v', 'error', '-i', str(video_path), '-vn',
+        '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', '-',
+    ]
+    chunk_bytes = READ_SECONDS * sample_rate * 2
+    powers = []
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # エラー出力が多い（壊れたファイルで警告が続くなど）とパイプが詰まって止まるので、別スレッドで読み続ける
+    with ThreadPoolExecutor(max_workers=1) as drain:
+        stderr_future = drain.submit(process.stderr.read)
+        try:
+            while data := process.stdout.read(chunk_bytes):
+                # 窓の境目が読み込みの境目とずれないよう、READ_SECONDS は窓の長さの倍数にしておく
+                powers.append(frame_power(np.frombuffer(data, dtype='<i2'), frame_size))
+        finally:
+            process.stdout.close()
+            stderr = stderr_future.result().decode('utf-8', errors='replace')
+            process.stderr.close()
+            returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f'ffmpegの実行に失敗しました: {stderr.strip()}')
+    return np.concatenate(powers) if powers else np.zeros(0, dtype=np.float32)
+
+
+def per_second_scores(power, settings=AUDIO_SETTINGS):
+    """窓ごとのパワーから1秒ごとの (音量 dB, 立ち上がりの数, スコア) を計算"""
+    frames_per_second = round(1 / settings['frame_seconds'])
+    seconds = math.ceil(len(power) / frames_per_second)
+    if seconds == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    frame_db = 10 * np.log10(power + 1e-10)
+    rises = np.diff(frame_db, prepend=frame_db[:1]) >= settings['onset_db']
+    onsets = rises & (frame_db > settings['silence_db'])
+
+    padded = np.full(seconds * frames_per_second, np.nan, dtype=np.float32)
+    padded[:len(power)] = power
+    loudness = 10 * np.log10(np.nanmean(padded.reshape(seconds, -1), axis=1) + 1e-10)
+    onset_counts = np.zeros(seconds * frames_per_second)
+    onset_counts[:len(onsets)] = onsets
+    onset_counts = onset_counts.reshape(seconds, -1).sum(axis=1)
+
+    # 録音レベルはファイルごとに違うので、音量はファイルの中央値との差で比べる
+    loud_term = np.clip((loudness - np.median(loudness)) / settings['loudness_range_db'], 0, 1)
+    onset_term = np.clip(onset_counts / settings['onset_full'], 0, 1)
+    weight = settings['onset_weight']
+    score = (1 - weight) * loud_term + weight * onset_term
+    return np.stack([loudness, onset_counts, score], axis=1).astype(np.float32)
+
+
+def media_audio_scores(info, index_path=DEFAULT_INDEX_PATH, settings=AUDIO_SETTINGS):
+    """1ファイル分の1秒ごとのスコア（インデックスにあれば使い、なければ計算して保存）"""
+    settings_key = json.dumps(settings, sort_keys=True)
+    conn = open_index(index_path)
+    try:
+        stored = lookup_audio_scores(conn, info, settings_key)
+        if stored is not None:
+            return np.frombuffer(stored, dtype=np.float32).reshape(-1, 3)
+        if info.has_audio:
+            try:
+                with measure('audio_score', byte_count=info.size) as counters:
+                    scores = per_second_scores(decode_frame_power(info.path, settings), settings)
+                    counters['frames'] = len(scores)
+            except RuntimeError as e:
+                # 読めなかったファイルは今回だけ 0 とし、次回また読み直せるよう保存しない
+                print(f'音声のスコアを計算できませんでした: {info.path}: {e}')
+                return np.zeros((math.ceil(info.duration), 3), dtype=np.float32)
+        else:
+            # 音声のないファイルは全て 0（静か）とする
+            scores = np.zeros((math.ceil(info.duration), 3), dtype=np.float32)
+        store_audio_scores(conn, info, settings_key, scores.tobytes())
+        return scores
+    finally:
+        conn.close()
+
+
+def timeline_audio_track(timeline, index_path=DEFAULT_INDEX_PATH, jobs=4, settings=AUDIO_SETTINGS):
+    """タイムライン全体の1秒ごとのスコア（元のタイムラインの秒数で引ける配列）"""
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        all_scores = list(executor.map(lambda info: media_audio_scores(info, index_path, settings), timeline))
+    track = np.zeros(math.ceil(timeline[-1].end) if timeline else 0, dtype=np.float32)
+    for info, scores in zip(timeline, all_scores):
+        start = int(info.offset)
+        values = scores[:max(0, len(track) - start), SCORE]
+        track[start:start + len(values)] = np.maximum(track[start:start + len(values)], values)
+    return track
+
+
+def proxy_track(track, remap, proxy_duration):
+    """事前フィルタ・重複除去で詰めたプロキシ上の秒数に並べ直す（remap がなければそのまま）"""
+    from prefilter import to_original
+    if not remap:
+        return track
+    seconds = math.ceil(proxy_duration)
+    originals = np.array([to_original(t + 0.5, remap) for t in range(seconds)], dtype=np.int64)
+    return track[np.clip(originals, 0, len(track) - 1)] if len(track) else np.zeros(seconds, dtype=np.float32)
+
+
+def span_score(track, start, end):
+    """[start, end) 秒の平均スコア（範囲外は 0）"""
+    values = track[max(0, int(start)):max(0, math.ceil(end))]
+    return float(values.mean()) if len(values) else 0.0
+
+
+def rank_windows(windows, track, max_windows):
+    """音声のスコアが高い区間を max_windows 個選び、時刻順で返す"""
+    if max_windows is None or len(windows) <= max_windows:
+        return windows
+    ranked = sorted(windows, key=lambda window: span_score(track, *window), reverse=True)
+    return sorted(ranked[:max_windows])
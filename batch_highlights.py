@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import glob
+import hashlib
+import multiprocessing
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import generate_video_highlight as pipeline
+from highlight_analysis import MODEL
+from model_client import ModelClient, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_MAX_RETRIES, DEFAULT_REQUEST_TIMEOUT
+
+DEFAULT_QUEUE_PATH = '.cache/batch_queue.sqlite3'
+DEFAULT_OUTPUT_DIR = 'videos/highlights'
+
+# ステージは上から順に実行する（analysis 以外はCPUを使うのでプロセスプールで実行）
+STAGES = ('probe', 'proxy', 'analysis', 'render')
+CPU_STAGES = ('probe', 'proxy', 'render')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    input_dir TEXT PRIMARY KEY,
+    output_file TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL
+)
+'''
+
+
+def open_queue(queue_path=DEFAULT_QUEUE_PATH):
+    Path(queue_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(queue_path))
+    conn.row_factory = sqlite3.Row
+    conn.execute(SCHEMA)
+    return conn
+
+
+def expand_input_dirs(patterns):
+    """ディレクトリのパスまたはglobを展開（重複は除く）"""
+    input_dirs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            path = Path(path).resolve()
+            if path.is_dir() and str(path) not in input_dirs:
+                input_dirs.append(str(path))
+    return input_dirs
+
+
+def output_file_for(input_dir, output_dir, used):
+    """出力ファイル名はディレクトリ名（同じ名前が既にあればパスのハッシュを付ける）"""
+    name = Path(input_dir).name
+    output_file = str(Path(output_dir) / f'{name}.mp4')
+    if output_file in used:
+        digest = hashlib.sha1(input_dir.encode('utf-8')).hexdigest()[:8]
+        output_file = str(Path(output_dir) / f'{name}_{digest}.mp4')
+    return output_file
+
+
+def enqueue(conn, input_dirs, output_dir=DEFAULT_OUTPUT_DIR):
+    """未登録のディレクトリをキューに追加（登録済みのものは状態を引き継ぐ）"""
+    used = {row['output_file'] for row in conn.execute('SELECT output_file FROM jobs')}
+    added = 0
+    with conn:
+        for input_dir in input_dirs:
+            if conn.execute('SELECT 1 FROM jobs WHERE input_dir = ?', (input_dir,)).fetchone():
+                continue
+            output_file = output_file_for(input_dir, output_dir, used)
+            used.add(output_file)
+            conn.execute(
+                'INSERT INTO jobs (input_dir, output_file, stage, status, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (input_dir, output_file, STAGES[0], 'pending', time.time()),
+            )
+            added += 1
+    return added
+
+
+def recover(conn, retry_failed=False):
+    """前回の実行中に止まったジョブを、止まったステージから再開できるようにする"""
+    statuses = ('running', 'failed') if retry_failed else ('running',)
+    with conn:
+        cursor = conn.execute(
+            f'UPDATE jobs SET status = ?, updated_at = ? WHERE status IN ({",".join("?" * len(statuses))})',
+            ('pending', time.time(), *statuses),
+        )
+    return cursor.rowcount
+
+
+def pending_jobs(conn):
+    return [dict(row) for row in conn.execute("SELECT * FROM jobs WHERE status = 'pending' ORDER BY input_dir")]
+
+
+def update_job(conn, input_dir, stage, status, error=None):
+    # ステージを開始した回数を attempts に数える
+    with conn:
+        conn.execute(
+            'UPDATE jobs SET stage = ?, status = ?, error = ?, updated_at = ?, attempts = attempts + ? '
+            'WHERE input_dir = ?',
+            (stage, status, error, time.time(), int(status == 'running'), input_dir),
+        )
+
+
+def run_cpu_stage(stage, input_dir, output_file, options):
+    """プロセスプールで実行するステージ（成果物はファイルとインデックスに保存される）"""
+    if stage == 'probe':
+        if not pipeline.probe_stage(input_dir, options['index_path']):
+            raise ValueError('処理可能な動画がありませんでした')
+    elif stage == 'proxy':
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        result = pipeline.proxy_stage(
+            input_dir, output_file, options['refresh'], options['cache_dir'], options['cache_max_gb'],
+            options['jobs'], options['incremental'], options['index_path'], options['proxy_size_mb'],
+            options['prefilter'], options['analysis_input'], options['analysis_mode'], options['token_budget'],
+            options['proxy_engine'], options['font'], options['dedup'],
+        )
+        if result is None:
+            raise RuntimeError('プロキシ動画を作成できませんでした')
+    elif stage == 'render':
+        timeline = pipeline.probe_stage(input_dir, options['index_path'])
+        highlights = pipeline.load_highlights(output_file)
+        pipeline.render_stage(
+            timeline, output_file, highlights, options['render_mode'], options['subtitles'],
+            options['max_open_decoders'], options['font'], options['render_jobs'],
+        )
+    else:
+        raise ValueError(f'未対応のステージです: {stage}')
+
+
+async def run_analysis_stage(input_dir, output_file, client, options):
+    timeline = await asyncio.to_thread(pipeline.probe_stage, input_dir, options['index_path'])
+    remap, file_spans = pipeline.load_remap(output_file)
+    await pipeline.analysis_stage_async(
+        timeline, output_file, client, remap, file_spans,
+        target_minutes=options['target_minutes'], highlight_ratio=options['highlight_ratio'],
+        jobs=options['jobs'], upload=options['upload'], analysis_cache_dir=options['analysis_cache_dir'],
+        refresh_analysis=options['refresh_analysis'], analysis_mode=options['analysis_mode'],
+        analysis_input=options['analysis_input'], window_minutes=options['window_minutes'],
+        window_overlap=options['window_overlap'], index_path=options['index_path'],
+        audio_score=options['audio_score'], max_windows=options['max_windows'],
+    )
+
+
+async def run_job(conn, pool, client, job, options):
+    """1ディレクトリ分のステージを順に実行し、ステージが終わるごとにキューに記録する"""
+    loop = asyncio.get_running_loop()
+    input_dir = job['input_dir']
+    output_file = job['output_file']
+    name = Path(input_dir).name
+    for stage in STAGES[STAGES.index(job['stage']):]:
+        update_job(conn, input_dir, stage, 'running')
+        print(f'[{name}] {stage} を開始')
+        try:
+            if stage in CPU_STAGES:
+                await loop.run_in_executor(pool, run_cpu_stage, stage, input_dir, output_file, options)
+            else:
+                await run_analysis_stage(input_dir, output_file, client, options)
+        except Exception as e:
+            update_job(conn, input_dir, stage, 'failed', f'{type(e).__name__}: {e}')
+            print(f'[{name}] {stage} でエラーが発生しました: {e}')
+            return False
+        next_index = STAGES.index(stage) + 1
+        if next_index < len(STAGES):
+            update_job(conn, input_dir, STAGES[next_index], 'pending')
+    update_job(conn, input_dir, 'done', 'done')
+    print(f'[{name}] 完了: {output_file}')
+    return True
+
+
+async def run_batch(conn, options, workers=2, analysis_jobs=4, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                    request_timeout=DEFAULT_REQUEST_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES):
+    """キューの未完了ジョブを全て実行（解析は全ジョブで1つのクライアントを共有してレートを守る）"""
+    jobs = pending_jobs(conn)
+    if not jobs:
+        print('実行するジョブはありません')
+        return []
+    print(f'{len(jobs)}件のジョブを実行します')
+    client = ModelClient(
+        MODEL, concurrency=analysis_jobs, requests_per_minute=requests_per_minute,
+        timeout=request_timeout, max_retries=max_retries
+    )
+    # イベントループのスレッドがあるので fork ではなく spawn でワーカーを起動
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return await asyncio.gather(*(run_job(conn, pool, client, job, options) for job in jobs))
+
+
+def print_status(conn):
+    for row in conn.execute('SELECT * FROM jobs ORDER BY input_dir'):
+        error = f'  {row["error"]}' if row['error'] else ''
+        print(f'{row["status"]:8} {row["stage"]:9} {row["input_dir"]}{error}')
+
+
+def default_options(**overrides):
+    """ステージに渡す設定（generate_video_highlight.main の引数と同じ意味）"""
+    options = dict(
+        target_minutes=None, highlight_ratio=0.3, refresh=False,
+        cache_dir=pipeline.DEFAULT_CACHE_DIR, cache_max_gb=5, jobs=1, incremental=False,
+        index_path=pipeline.DEFAULT_INDEX_PATH, max_open_decoders=pipeline.DEFAULT_MAX_OPEN,
+        render_mode='moviepy', subtitles='burn', upload='inline', proxy_size_mb=10,
+        analysis_cache_dir=pipeline.DEFAULT_ANALYSIS_CACHE_DIR, refresh_analysis=False,
+        analysis_mode='single', window_minutes=pipeline.DEFAULT_WINDOW_SECONDS / 60,
+        window_overlap=pipeline.DEFAULT_OVERLAP_SECONDS, prefilter=False, analysis_input='video',
+        token_budget=pipeline.DEFAULT_TOKEN_BUDGET, font=None, render_jobs=1,
+        proxy_engine='moviepy', dedup=False, audio_score=False, max_windows=None,
+    )
+    options.update(overrides)
+    return options
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='複数ディレクトリの動画のハイライトをまとめて作成')
+    parser.add_argument(
+        'input_dirs', nargs='*',
+        help='入力動画のディレクトリパス（globも可、例: "videos/trips/*"）'
+    )
+    parser.add_argument(
+        '--output-dir', '-o', default=DEFAULT_OUTPUT_DIR,
+        help=f'出力先のディレクトリ（デフォルト: {DEFAULT_OUTPUT_DIR}）'
+    )
+    parser.add_argument(
+        '--queue-path', default=DEFAULT_QUEUE_PATH,
+        help=f'ジョブの状態を保存するデータベース（デフォルト: {DEFAULT_QUEUE_PATH}）'
+    )
+    parser.add_argument(
+        '--workers', '-w', type=int, default=2,
+        help='プロキシ作成・書き出しを同時に実行するプロセス数（デフォルト: 2）'
+    )
+    parser.add_argument(
+        '--retry-failed', action='store_true',
+        help='失敗したジョブを失敗したステージから再実行するかどうか'
+    )
+    parser.add_argument(
+        '--status', action='store_true',
+        help='ジョブの状態を表示して終了'
+    )
+    parser.add_argument(
+        '--target-minutes', '-t', type=float,
+        help='目標とする動画の長さ（分）'
+    )
+    parser.add_argument(
+        '--highlight-ratio', '-r', type=float, default=0.3,
+        help='元の動画の長さに対するハイライトの割合（デフォルト: 0.3）'
+    )
+    parser.add_argument(
+        '--analysis-mode', choices=['single', 'chunked'], default='single',
+        help='解析方法（chunked: 重なりのある区間に分けて並列に解析）'
+    )
+    parser.add_argument(
+        '--window-minutes', type=float, default=pipeline.DEFAULT_WINDOW_SECONDS / 60,
+        help=f'chunked で1回の解析に渡す区間の長さ（分、デフォルト: {pipeline.DEFAULT_WINDOW_SECONDS // 60}）'
+    )
+    parser.add_argument(
+        '--window-overlap', type=float, default=pipeline.DEFAULT_OVERLAP_SECONDS,
+        help=f'chunked で隣り合う区間の重なり（秒、デフォルト: {pipeline.DEFAULT_OVERLAP_SECONDS}）'
+    )
+    parser.add_argument(
+        '--audio-score', action='store_true',
+        help='chunked で元動画の音声のスコアをハイライトの選定に使うかどうか'
+    )
+    parser.add_argument(
+        '--max-windows', type=int,
+        help='chunked で音声のスコアが高い区間をこの数だけGeminiに送る'
+    )
+    parser.add_argument(
+        '--analysis-input', choices=['video', 'contact-sheet'], default='video',
+        help='Geminiに送る内容（contact-sheet: シーンごとの代表フレームを並べた画像）'
+    )
+    parser.add_argument(
+        '--prefilter', action='store_true',
+        help='静止・露出不良・ピンぼけの区間を除いてからGeminiに送るかどうか'
+    )
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='撮り直しなどの重複したファイルを1本にまとめてからGeminiに送るかどうか'
+    )
+    parser.add_argument(
+        '--upload', choices=['inline', 'files'], default='inline',
+        help='動画の送り方（files: Files API でアップロード）'
+    )
+    parser.add_argument(
+        '--proxy-size-mb', type=float, default=10,
+        help='Gemini用の圧縮動画の目標サイズ（MB、デフォルト: 10）'
+    )
+    parser.add_argument(
+        '--proxy-engine', choices=['moviepy', 'ffmpeg'], default='moviepy',
+        help='プロキシ動画の書き出し方法（ffmpeg: フィルタグラフ1つで書き出し、使えない場合は moviepy）'
+    )
+    parser.add_argument(
+        '--render-mode', choices=['moviepy', 'smart'], default='moviepy',
+        help='ハイライト動画の書き出し方法（smart: キーフレーム間をストリームコピー）'
+    )
+    parser.add_argument(
+        '--subtitles', choices=['burn', 'srt', 'vtt', 'ass'], default='burn',
+        help='ナレーションの出力方法（burn: 焼き込み、それ以外: 字幕ファイル＋ソフトサブ）'
+    )
+    parser.add_argument(
+        '--render-jobs', type=int, default=1,
+        help='1ジョブあたりのハイライト書き出しのプロセス数（デフォルト: 1）'
+    )
+    parser.add_argument(
+        '--font',
+        help='焼き込むナレーションのフォント（デフォルト: 自動で選択）'
+    )
+    parser.add_argument(
+        '--analysis-jobs', type=int, default=4,
+        help='全ジョブで同時に実行する解析リクエストの数（デフォルト: 4）'
+    )
+    parser.add_argument(
+        '--requests-per-minute', type=float, default=DEFAULT_REQUESTS_PER_MINUTE,
+        help=f'Geminiへの1分あたりの最大リクエスト数（デフォルト: {DEFAULT_REQUESTS_PER_MINUTE}）'
+    )
+    parser.add_argument(
+        '--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+        help=f'解析リクエスト1回あたりのタイムアウト（秒、デフォルト: {DEFAULT_REQUEST_TIMEOUT}）'
+    )
+    parser.add_argument(
+        '--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+        help=f'レート制限・タイムアウト・サーバーエラー時の再試行回数（デフォルト: {DEFAULT_MAX_RETRIES}）'
+    )
+
+    args = parser.parse_args()
+    try:
+        pipeline.check_windows(args.window_minutes * 60, args.window_overlap)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.max_windows is not None and args.max_windows < 1:
+        parser.error('--max-windows は1以上を指定してください')
+    conn = open_queue(args.queue_path)
+    if args.status:
+        print_status(conn)
+    else:
+        added = enqueue(conn, expand_input_dirs(args.input_dirs), args.output_dir)
+        resumed = recover(conn, args.retry_failed)
+        print(f'追加: {added}件 / 再開: {resumed}件')
+        options = default_options(
+            target_minutes=args.target_minutes,
+            highlight_ratio=args.highlight_ratio,
+            analysis_mode=args.analysis_mode,
+            window_minutes=args.window_minutes,
+            window_overlap=args.window_overlap,
+            analysis_input=args.analysis_input,
+            prefilter=args.prefilter,
+            dedup=args.dedup,
+            audio_score=args.audio_score,
+            max_windows=args.max_windows,
+            upload=args.upload,
+            proxy_size_mb=args.proxy_size_mb,
+            proxy_engine=args.proxy_engine,
+            render_mode=args.render_mode,
+            subtitles=args.subtitles,
+            font=args.font,
+            render_jobs=args.render_jobs,
+        )
+        asyncio.run(run_batch(
+            conn, options, args.workers, args.analysis_jobs, args.requests_per_minute,
+            args.request_timeout, args.max_retries
+        ))
+        print_status(conn)
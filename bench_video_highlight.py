@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from ffmpeg_utils import ffmpeg_binary
+
+# 入力フォルダの大きさのプリセット（ファイル数・1ファイルの秒数・解像度・フレームレート）
+PRESETS = {
+    'small': dict(files=4, seconds=5, width=320, height=240, fps=30),
+    'medium': dict(files=8, seconds=15, width=640, height=360, fps=30),
+    'large': dict(files=4, seconds=60, width=1280, height=720, fps=30),
+    'many': dict(files=40, seconds=3, width=320, height=240, fps=30),
+}
+DEFAULT_WORK_DIR = '.cache/bench'
+DEFAULT_OUTPUT_PATH = 'bench_output.txt'
+# 起動時間を計測するコマンドはリポジトリのディレクトリで実行する（どこから起動しても同じモジュールを読み込む）
+REPO_DIR = Path(__file__).resolve().parent
+# 起動時間を計測するコマンド（キャッシュ済みの実行やバッチの起動はモジュールの読み込みが大半を占める）
+STARTUP_COMMANDS = {
+    'import generate_video_highlight': ['-c', 'import generate_video_highlight'],
+    'import batch_highlights': ['-c', 'import batch_highlights'],
+    'generate_video_highlight.py --help': ['generate_video_highlight.py', '--help'],
+}
+# 起動時に読み込まれていないことを確認する重いモジュール
+HEAVY_MODULES = ('moviepy.editor', 'litellm', 'pydantic')
+# スタブのモデルが返すハイライトの数と長さ
+STUB_HIGHLIGHTS = 4
+STUB_HIGHLIGHT_SECONDS = 3
+
+
+def measure_startup(repeat=5):
+    """コマンドごとの起動時間（中央値）と、読み込まれた重いモジュールを調べる"""
+    results = {}
+    for name, args in STARTUP_COMMANDS.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, *args], capture_output=True, check=True, cwd=REPO_DIR)
+            timings.append(time.perf_counter() - started)
+        results[name] = statistics.median(timings)
+    baseline = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], capture_output=True, check=True, cwd=REPO_DIR)
+        baseline.append(time.perf_counter() - started)
+    check = (
+        'import sys, generate_video_highlight, batch_highlights; '
+        f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    )
+    loaded = subprocess.run(
+        [sys.executable, '-c', check], capture_output=True, text=True, check=True, cwd=REPO_DIR
+    ).stdout.strip()
+    return dict(
+        interpreter_seconds=statistics.median(baseline),
+        commands=results,
+        heavy_modules_loaded=[m for m in loaded.split(',') if m],
+    )
+
+
+def format_startup(startup):
+    lines = [f"起動時間（Python 自体: {startup['interpreter_seconds']:.3f}s）"]
+    for name, seconds in startup['commands'].items():
+        lines.append(f"  {name:<40} {seconds:7.3f}s")
+    lines.append(f"  起動時に読み込まれた重いモジュール: {', '.join(startup['heavy_modules_loaded']) or 'なし'}")
+    return '\n'.join(lines)
+
+
+def check_text_rendering(proxy_engine, subtitles):
+    """タイムスタンプと字幕の描画に必要なものがあるか確認し、足りなければ理由を返す（揃っていれば None）
+
+    ffmpeg の drawtext がなければタイムスタンプは MoviePy の TextClip（ImageMagick）で描く
+    """
+    from ffmpeg_proxy import available_filters
+
+    needs_imagemagick = subtitles == 'burn' or proxy_engine != 'ffmpeg' or 'drawtext' not in available_filters()
+    if not needs_imagemagick:
+        return None
+    from timestamp_overlay import build_glyph_atlas
+
+    try:
+        build_glyph_atlas()
+    except Exception as e:
+        return (
+            f'ImageMagick で文字を描画できません（{e}）。ImageMagick をインストールするか、'
+            'drawtext 付きの ffmpeg で --proxy-engine ffmpeg --subtitles srt を指定してください'
+        )
+    return None
+
+
+def input_dir_for(work_dir, case):
+    name = f"{case['files']}x{case['seconds']}s_{case['width']}x{case['height']}_{case['fps']}fps"
+    return Path(work_dir) / 'inputs' / name
+
+
+def write_synthetic_video(path, seconds, width, height, fps, seed):
+    """NumPy で作ったフレーム（ノイズの模様をパンしつつ途中でシーンを切り替え）をffmpegで書き出す"""
+    rng = np.random.default_rng(seed)
+    # 2枚の模様を用意し、後半で切り替える（事前フィルタやシーン検出にも使える入力）
+    scenes = []
+    for _ in range(2):
+        coarse = rng.integers(0, 256, (height // 8 + 2, width // 8 + 2 + int(seconds * 4), 3), dtype=np.uint8)
+        scenes.append(np.repeat(np.repeat(coarse, 8, axis=0), 8, axis=1))
+    frame_count = int(seconds * fps)
+    cmd = [
+        ffmpeg_binary(), '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+        '-f', 'lavfi', '-i', f'sine=frequency={220 + seed * 20}:sample_rate=48000:duration={seconds}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', str(path),
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for i in range(frame_count):
+            scene = scenes[0] if i < frame_count // 2 else scenes[1]
+            # 1秒に32画素ずつ横にパンする
+            x = int(i * 32 / fps)
+            process.stdin.write(np.ascontiguousarray(scene[:height, x:x + width]).tobytes())
+    finally:
+        process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f'ベンチマーク用の動画を作成できませんでした: {path}')
+    return path
+
+
+def generate_inputs(work_dir, case):
+    """同じ条件の入力フォルダは作成済みのものを使う（乱数のシードは固定なので毎回同じ内容）"""
+    input_dir = input_dir_for(work_dir, case)
+    input_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(case['files']):
+        path = input_dir / f'C{i + 1:04d}.MP4'
+        if not path.exists():
+            tmp_path = path.with_suffix('.tmp.mp4')
+            write_synthetic_video(tmp_path, case['seconds'], case['width'], case['height'], case['fps'], seed=i)
+            tmp_path.replace(path)
+    return input_dir
+
+
+def stub_highlights(total_duration, count=STUB_HIGHLIGHTS, seconds=STUB_HIGHLIGHT_SECONDS):
+    """モデルの代わりに、全体に均等に散らばったハイライトを返す"""
+    from highlight_models import Narration, VideoHighlight, VideoHighlights
+
+    highlights = []
+    step = total_duration / count
+    for i in range(count):
+        start = round(i * step + step / 4, 2)
+        end = round(min(start + seconds, total_duration), 2)
+        highlights.append(VideoHighlight(
+            start_second=start, end_second=end,
+            narration=[Narration(narration=f'ハイライト{i + 1}', start_second=start, end_second=end)],
+        ))
+    return VideoHighlights(highlights=highlights)
+
+
+class StubClient:
+    """リクエストせずに決まったハイライトを返すクライアント（base64 への変換までは実際に行う）"""
+    model = 'bench/stub'
+
+    def __init__(self, total_duration):
+        self.total_duration = total_duration
+
+    async def request_highlights(self, prompt, media_part):
+        return stub_highlights(self.total_duration)
+
+
+def run_case(case, work_dir, jobs=1, subtitles='srt', render_mode='moviepy', render_jobs=1,
+             proxy_engine='moviepy'):
+    """1つの条件でプロキシ作成・解析（スタブ）・ハイライト書き出しを実行し、計測結果を返す
+
+    最大RSSを条件ごとに測るため、新しいプロセスで実行する
+    """
+    import generate_video_highlight as pipeline
+    from instrumentation import start_run
+    from pipeline_state import state_path
+    from proxy_cache import ProxyCache
+
+    input_dir = input_dir_for(work_dir, case)
+    run_dir = Path(work_dir) / 'runs' / input_dir.name
+    run_dir.mkdir(parents=True, exist_ok=True)
+    output_file = run_dir / 'bench.mp4'
+    # 前回書き出したセグメントを再利用しないよう、実行状態を消してから実行する
+    state_path(output_file).unlink(missing_ok=True)
+
+    recorder = start_run()
+    started = time.perf_counter()
+    proxy_path, timeline, _ = pipeline.merge_videos_with_timestamp(
+        input_dir, str(output_file), refresh=True, cache=ProxyCache(run_dir / 'proxy_cache'), jobs=jobs,
+        index_path=run_dir / 'index.sqlite3', proxy_engine=proxy_engine
+    )
+    if proxy_path is None:
+        raise RuntimeError('プロキシ動画を作成できませんでした')
+    total_duration = timeline[-1].end
+    highlights = asyncio.run(pipeline.analysis_stage_async(
+        timeline, output_file, StubClient(total_duration),
+        analysis_cache_dir=run_dir / 'analysis_cache', refresh_analysis=True
+    ))
+    pipeline.render_stage(timeline, output_file, highlights, render_mode, subtitles, render_jobs=render_jobs)
+    wall_seconds = time.perf_counter() - started
+
+    report = recorder.report()
+    stages = report['stages']
+    source_frames = sum(int(info.duration * info.fps) for info in timeline)
+    source_bytes = sum(info.size for info in timeline)
+    return dict(
+        case=dict(
+            case, jobs=jobs, subtitles=subtitles, render_mode=render_mode, render_jobs=render_jobs,
+            proxy_engine=proxy_engine
+        ),
+        wall_seconds=wall_seconds,
+        source_frames_per_second=source_frames / wall_seconds,
+        source_bytes_per_second=source_bytes / wall_seconds,
+        proxy_seconds=stages['proxy_encode']['seconds'],
+        proxy_frames_per_second=stages['proxy_encode']['frames_per_second'],
+        render_seconds=stages.get('render', {}).get('seconds', 0.0),
+        render_frames_per_second=stages.get('render', {}).get('frames_per_second', 0.0),
+        peak_rss_bytes=report['peak_rss_bytes'],
+        children_peak_rss_bytes=report['children_peak_rss_bytes'],
+        stages=stages,
+    )
+
+
+def run_isolated(case, work_dir, **options):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_case, case, work_dir, **options).result()
+
+
+def summarize(results):
+    """同じ条件を繰り返した結果から中央値を取る"""
+    ordered = sorted(results, key=lambda r: r['wall_seconds'])
+    summary = dict(ordered[len(ordered) // 2])
+    summary['repeats'] = len(results)
+    summary['peak_rss_bytes'] = max(r['peak_rss_bytes'] or 0 for r in results)
+    return summary
+
+
+def format_row(summary):
+    case = summary['case']
+    mb = 1024 * 1024
+    return (
+        f"{case['files']:>3} x {case['seconds']:>3}s {case['width']}x{case['height']}@{case['fps']} "
+        f"jobs={case['jobs']} render_jobs={case.get('render_jobs', 1)} "
+        f"proxy={case.get('proxy_engine', 'moviepy')}  total {summary['wall_seconds']:7.2f}s  "
+        f"source {summary['source_frames_per_second']:8.1f} frames/s {summary['source_bytes_per_second'] / mb:6.2f} MB/s  "
+        f"proxy {summary['proxy_frames_per_second']:7.1f} frames/s  "
+        f"render {summary['render_frames_per_second']:7.1f} frames/s  "
+        f"peak RSS {summary['peak_rss_bytes'] / mb:7.1f} MB (子プロセス {summary['children_peak_rss_bytes'] / mb:.1f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='合成した入力フォルダでプロキシ作成とハイライト書き出しの速度を計測')
+    parser.add_argument(
+        '--preset', '-p', action='append', choices=list(PRESETS),
+        help='計測する入力の大きさ（複数指定可、デフォルト: small）'
+    )
+    parser.add_argument('--files', type=int, help='プリセットの代わりに使うファイル数')
+    parser.add_argument('--seconds', type=float, help='1ファイルの長さ（秒）')
+    parser.add_argument('--width', type=int, help='幅')
+    parser.add_argument('--height', type=int, help='高さ')
+    parser.add_argument('--fps', type=int, help='フレームレート')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='プロキシ書き出しのプロセス数（デフォルト: 1）'
+    )
+    parser.add_argument(
+        '--proxy-engine', choices=['moviepy', 'ffmpeg'], default='moviepy',
+        help='プロキシ動画の書き出し方法（デフォルト: moviepy）'
+    )
+    parser.add_argument(
+        '--render-jobs', type=int, default=1,
+        help='ハイライト書き出しのプロセス数（デフォルト: 1）'
+    )
+    parser.add_argument(
+        '--repeat', '-n', type=int, default=3,
+        help='同じ条件を繰り返す回数（中央値を報告、デフォルト: 3）'
+    )
+    parser.add_argument(
+        '--subtitles', choices=['burn', 'srt', 'vtt', 'ass'], default='srt',
+        help='ナレーションの出力方法（burn は ImageMagick が必要、デフォルト: srt）'
+    )
+    parser.add_argument(
+        '--render-mode', choices=['moviepy', 'smart'], default='moviepy',
+        help='ハイライト動画の書き出し方法'
+    )
+    parser.add_argument(
+        '--startup-only', action='store_true',
+        help='起動時間（モジュールの読み込み時間）だけを計測する'
+    )
+    parser.add_argument(
+        '--work-dir', default=DEFAULT_WORK_DIR,
+        help=f'合成した入力と出力の保存先（デフォルト: {DEFAULT_WORK_DIR}）'
+    )
+    parser.add_argument(
+        '--output', '-o', default=DEFAULT_OUTPUT_PATH,
+        help=f'結果を追記するテキストファイル（デフォルト: {DEFAULT_OUTPUT_PATH}）'
+    )
+    parser.add_argument(
+        '--json',
+        help='リリース間の比較用に、結果をJSONで保存するパス'
+    )
+
+    args = parser.parse_args()
+    cases = [dict(PRESETS[name]) for name in (args.preset or ['small'])]
+    custom = dict(files=args.files, seconds=args.seconds, width=args.width, height=args.height, fps=args.fps)
+    if any(value is not None for value in custom.values()):
+        base = cases[0] if args.preset else PRESETS['small']
+        cases = [dict(base, **{k: v for k, v in custom.items() if v is not None})]
+    if not args.startup_only:
+        # 書き出しの途中で失敗しないよう、最初に確認する
+        error = check_text_rendering(args.proxy_engine, args.subtitles)
+        if error:
+            parser.error(error)
+
+    startup = measure_startup()
+    print(format_startup(startup))
+
+    summaries = []
+    for case in ([] if args.startup_only else cases):
+        print(f'入力を作成中: {input_dir_for(args.work_dir, case)}')
+        generate_inputs(args.work_dir, case)
+        results = [
+            run_isolated(
+                case, args.work_dir, jobs=args.jobs, subtitles=args.subtitles, render_mode=args.render_mode,
+                render_jobs=args.render_jobs, proxy_engine=args.proxy_engine
+            )
+            for _ in range(args.repeat)
+        ]
+        summary = summarize(results)
+        summaries.append(summary)
+        print(format_row(summary))
+
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(format_startup(startup) + '\n')
+        for summary in summaries:
+            f.write(format_row(summary) + '\n')
+    print(f'結果を追記しました: {args.output}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(dict(startup=startup, cases=summaries), f, ensure_ascii=False, indent=2)
+        print(f'結果を保存しました: {args.json}')
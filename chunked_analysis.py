@@ -0,0 +1,226 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from analysis_cache import analysis_cache_key, file_sha256
+from ffmpeg_utils import run_ffmpeg
+from highlight_analysis import MODEL, load_prompt, video_part
+from highlight_models import Narration, VideoHighlight, VideoHighlights, SCHEMA_VERSION
+from model_client import ModelClient, DEFAULT_CONCURRENCY
+
+DEFAULT_WINDOW_SECONDS = 20 * 60
+DEFAULT_OVERLAP_SECONDS = 30
+WINDOW_PROMPT_PATH = "prompts/window_prompt.md"
+# 区間ごとには目標より多めに抽出し、全体の選定で削る
+WINDOW_BUDGET_MARGIN = 1.5
+# これより短くなるハイライトは採用しない
+MIN_HIGHLIGHT_SECONDS = 3
+
+
+def check_windows(window_seconds, overlap_seconds):
+    """区間の長さと重なりが分割できる値かどうか（できない場合は ValueError）"""
+    if window_seconds <= 0:
+        raise ValueError(f'区間の長さは正の値にしてください: {window_seconds}秒')
+    if overlap_seconds < 0 or overlap_seconds >= window_seconds:
+        raise ValueError(f'区間の重なり（{overlap_seconds}秒）は0以上、区間の長さ（{window_seconds}秒）未満にしてください')
+
+
+def plan_windows(total_duration, window_seconds=DEFAULT_WINDOW_SECONDS, overlap_seconds=DEFAULT_OVERLAP_SECONDS):
+    """タイムラインを重なりのある区間 (開始秒数, 終了秒数) に分割"""
+    check_windows(window_seconds, overlap_seconds)
+    if total_duration <= window_seconds:
+        return [(0, total_duration)]
+    step = window_seconds - overlap_seconds
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window_seconds, total_duration)
+        windows.append((start, end))
+        if end >= total_duration:
+            return windows
+        start += step
+
+
+def shift_highlights(highlights, offset, window_end):
+    """区間内の秒数を全体の秒数に直し、区間の外にはみ出した部分を切り捨てる"""
+    shifted = []
+    for highlight in highlights:
+        start = highlight.start_second + offset
+        end = min(highlight.end_second + offset, window_end)
+        if end <= start:
+            continue
+        narration = [
+            Narration(
+                narration=n.narration,
+                start_second=n.start_second + offset,
+                end_second=min(n.end_second + offset, end),
+            )
+            for n in highlight.narration if n.start_second + offset < end
+        ]
+        shifted.append(VideoHighlight(start_second=start, end_second=end, narration=narration))
+    return shifted
+
+
+def highlight_duration(highlight):
+    return highlight.end_second - highlight.start_second
+
+
+def merge_overlapping(highlights):
+    """区間の重なり部分で重複して選ばれたハイライトを1つにまとめ、残りの重なりは後ろのハイライトの頭を切る
+
+    半分以上重なるものは同じ場面とみなして長い方を残す。返すハイライトはどの2つも重ならない
+    """
+    merged = []
+    for highlight in sorted(highlights, key=lambda h: h.start_second):
+        if merged:
+            previous = merged[-1]
+            overlap = min(previous.end_second, highlight.end_second) - max(previous.start_second, highlight.start_second)
+            if overlap > 0.5 * min(highlight_duration(previous), highlight_duration(highlight)):
+                if highlight_duration(highlight) > highlight_duration(previous):
+                    # 入れ替えた長い方が、さらに前のハイライトと重ならないようにする
+                    merged[-1] = trim_highlight_start(highlight, merged[-2].end_second) if len(merged) > 1 else highlight
+                continue
+            highlight = trim_highlight_start(highlight, previous.end_second)
+        merged.append(highlight)
+    return merged
+
+
+def trim_highlight_start(highlight, start):
+    """start より前の部分を切る（重なっていなければそのまま）"""
+    if start <= highlight.start_second:
+        return highlight
+    narration = [
+        Narration(narration=n.narration, start_second=max(n.start_second, start), end_second=n.end_second)
+        for n in highlight.narration if n.end_second > start
+    ]
+    return VideoHighlight(start_second=start, end_second=highlight.end_second, narration=narration)
+
+
+def trim_highlight(highlight, duration):
+    end = highlight.start_second + duration
+    narration = [
+        Narration(narration=n.narration, start_second=n.start_second, end_second=min(n.end_second, end))
+        for n in highlight.narration if n.start_second < end
+    ]
+    return VideoHighlight(start_second=highlight.start_second, end_second=end, narration=narration)
+
+
+def default_score(highlight):
+    # ナレーションが多く、長いものを優先
+    return (len(highlight.narration), highlight_duration(highlight))
+
+
+def audio_tiebreak_score(track):
+    """ナレーションの数が同じなら、音声のスコア（歓声・拍手など）が高いものを優先"""
+    from audio_score import span_score
+
+    def score(highlight):
+        return (
+            len(highlight.narration),
+            round(span_score(track, highlight.start_second, highlight.end_second), 3),
+            highlight_duration(highlight),
+        )
+    return score
+
+
+def reduce_highlights(highlights, target_seconds, score=None):
+    """スコア順に選び、合計が target_seconds になるようにする（最後の1つは切り詰める）"""
+    ranked = sorted(highlights, key=score or default_score, reverse=True)
+    chosen = []
+    total = 0
+    for highlight in ranked:
+        remaining = target_seconds - total
+        if remaining < MIN_HIGHLIGHT_SECONDS:
+            break
+        if highlight_duration(highlight) > remaining:
+            highlight = trim_highlight(highlight, remaining)
+        chosen.append(highlight)
+        total += highlight_duration(highlight)
+    return sorted(chosen, key=lambda h: h.start_second)
+
+
+def cut_window(proxy_path, start, end, output_path):
+    """プロキシから区間を正確な位置で切り出す（プロキシは小さいので再エンコードは軽い）"""
+    run_ffmpeg([
+        '-ss', f'{start:.3f}', '-i', proxy_path, '-t', f'{end - start:.3f}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
+        '-c:a', 'aac', '-b:a', '32k', output_path,
+    ])
+    return output_path
+
+
+def window_prompt(start, end, target_seconds, total_duration):
+    window_target = min(end - start, target_seconds * (end - start) / total_duration * WINDOW_BUDGET_MARGIN)
+    with open(WINDOW_PROMPT_PATH, "r") as f:
+        note = f.read().format(window_start=int(start), window_end=int(end))
+    return load_prompt(int(end - start), int(window_target)) + note
+
+
+async def analyze_windows(proxy_path, windows, total_duration, target_seconds, cache, client,
+                          upload='inline', refresh=False):
+    """区間ごとの切り出し・エンコード・リクエストをクライアントの同時実行数までに抑えて解析する
+
+    切り出した動画と base64 のデータはリクエストが終わるまで残るので、リクエストの枠だけでなく
+    切り出しから解析までをまとめて制限する
+    """
+    proxy_hash = file_sha256(proxy_path)
+    in_flight = asyncio.Semaphore(getattr(client, 'concurrency', DEFAULT_CONCURRENCY))
+
+    with tempfile.TemporaryDirectory(dir=Path(proxy_path).parent) as work_dir:
+        async def analyze_window(index, start, end):
+            prompt = window_prompt(start, end, target_seconds, total_duration)
+            key = analysis_cache_key(f'{proxy_hash}:{start:.3f}-{end:.3f}', prompt, client.model, SCHEMA_VERSION)
+            cached_result = None if refresh else cache.get(key)
+            if cached_result is not None:
+                highlights = VideoHighlights.model_validate(cached_result)
+            else:
+                async with in_flight:
+                    # ffmpeg とアップロードはブロッキングなのでスレッドで実行
+                    window_path = await asyncio.to_thread(
+                        cut_window, proxy_path, start, end, Path(work_dir) / f'window_{index:04d}.mp4'
+                    )
+                    media_part = await asyncio.to_thread(video_part, window_path, upload)
+                    highlights = await client.request_highlights(prompt, media_part)
+                    del media_part
+                    window_path.unlink(missing_ok=True)
+                cache.put(key, highlights.model_dump())
+            return shift_highlights(highlights.highlights, start, end)
+
+        results = await asyncio.gather(*(analyze_window(i, start, end) for i, (start, end) in enumerate(windows)))
+    return [highlight for highlights in results for highlight in highlights]
+
+
+async def analyze_in_windows_async(proxy_path, total_duration, target_seconds, cache, client, upload='inline',
+                                   window_seconds=DEFAULT_WINDOW_SECONDS, overlap_seconds=DEFAULT_OVERLAP_SECONDS,
+                                   refresh=False, score=None, track=None, max_windows=None):
+    """区間ごとに並列で解析し、全体の秒数に直して目標の長さに収まるように選定
+
+    track（プロキシ上の1秒ごとの音声のスコア）を渡すと、max_windows 個の区間だけをモデルに送り、
+    選定ではナレーションの数が同じハイライトを音声のスコアで比べる
+    """
+    windows = plan_windows(total_duration, window_seconds, overlap_seconds)
+    print(f"{len(windows)}区間に分割して解析します")
+    if track is not None:
+        from audio_score import rank_windows
+        selected = rank_windows(windows, track, max_windows)
+        if len(selected) < len(windows):
+            print(f"音声のスコアが高い{len(selected)}区間だけを解析します")
+        windows = selected
+        score = score or audio_tiebreak_score(track)
+    # 区間ごとの目標の長さは、送る区間の長さの合計で配分する
+    analyzed_duration = min(total_duration, sum(end - start for start, end in windows))
+    candidates = await analyze_windows(
+        proxy_path, windows, analyzed_duration, target_seconds, cache, client, upload, refresh
+    )
+    merged = merge_overlapping(candidates)
+    return VideoHighlights(highlights=reduce_highlights(merged, target_seconds, score))
+
+
+def analyze_in_windows(proxy_path, total_duration, target_seconds, cache, upload='inline',
+                       window_seconds=DEFAULT_WINDOW_SECONDS, overlap_seconds=DEFAULT_OVERLAP_SECONDS,
+                       jobs=4, refresh=False, model=MODEL, score=None, client=None, track=None, max_windows=None,
+                       **client_options):
+    client = client or ModelClient(model, concurrency=jobs, **client_options)
+    return asyncio.run(analyze_in_windows_async(
+        proxy_path, total_duration, target_seconds, cache, client, upload,
+        window_seconds, overlap_seconds, refresh, score, track, max_windows
+    ))
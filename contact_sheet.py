@@ -0,0 +1,191 @@
+import asyncio
+import base64
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from analysis_cache import AnalysisCache, analysis_cache_key
+from frame_cache import FrameCache
+from highlight_analysis import MODEL
+from highlight_models import VideoHighlights, SCHEMA_VERSION
+from instrumentation import measure
+from media_index import DEFAULT_INDEX_PATH
+from model_client import ModelClient
+from prefilter import score_media, DEFAULT_PREFILTER_CACHE_DIR, PREFILTER_SETTINGS, SAMPLE_SETTINGS
+
+CONTACT_SHEET_PROMPT_PATH = "prompts/contact_sheet_prompt.md"
+
+# 1枚のコンタクトシートに並べるフレーム数とサイズ
+SHEET_COLUMNS = 4
+SHEET_ROWS = 4
+JPEG_QUALITY = 80
+# 長いシーンはこの秒数ごとに代表フレームを追加
+MAX_SCENE_SECONDS = 10
+# 送るフレーム数の上限（超える場合は均等に間引く）
+MAX_FRAMES = 400
+
+
+def scene_frames(scores, sample_fps, spans=None, settings=PREFILTER_SETTINGS,
+                 max_scene_seconds=MAX_SCENE_SECONDS):
+    """シーンごと（長いシーンは一定の秒数ごと）に最もシャープなフレームのインデックスを選ぶ"""
+    blur = np.asarray(scores['blur'])
+    exposure = np.asarray(scores['exposure'])
+    count = len(blur)
+    if count == 0:
+        return []
+    usable = (exposure >= settings['dark_max']) & (exposure <= settings['bright_min'])
+    if spans is not None:
+        # 事前フィルタで残した区間のフレームだけを使う
+        times = np.arange(count) / sample_fps
+        in_spans = np.zeros(count, dtype=bool)
+        for start, end in spans:
+            in_spans |= (times >= start) & (times < end)
+        usable &= in_spans
+
+    cuts = np.flatnonzero(np.asarray(scores['cut']) >= settings['cut_min'])
+    boundaries = np.concatenate([[0], cuts, [count]])
+    chunk = max(1, int(max_scene_seconds * sample_fps))
+    selected = []
+    for scene_start, scene_end in zip(boundaries[:-1], boundaries[1:]):
+        for start in range(scene_start, scene_end, chunk):
+            end = min(start + chunk, scene_end)
+            candidates = np.flatnonzero(usable[start:end])
+            if len(candidates) == 0:
+                continue
+            selected.append(int(start + candidates[np.argmax(blur[start:end][candidates])]))
+    return selected
+
+
+def tile_sheet(tiles, columns=SHEET_COLUMNS, font_size=20):
+    """(秒数, フレーム) を格子状に並べ、各フレームの左上に秒数を描く"""
+    tile_height, tile_width = tiles[0][1].shape[:2]
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = Image.new('RGB', (tile_width * columns, tile_height * rows))
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=font_size)
+    for i, (seconds, frame) in enumerate(tiles):
+        x = (i % columns) * tile_width
+        y = (i // columns) * tile_height
+        sheet.paste(Image.fromarray(frame), (x, y))
+        label = f'{seconds:.0f}s'
+        left, top, right, bottom = draw.textbbox((x + 4, y + 4), label, font=font)
+        draw.rectangle((left - 3, top - 3, right + 3, bottom + 3), fill=(0, 0, 0))
+        draw.text((x + 4, y + 4), label, fill=(255, 255, 255), font=font)
+    return sheet
+
+
+def build_contact_sheets(timeline, file_spans=None, jobs=4, max_frames=MAX_FRAMES,
+                         cache_dir=DEFAULT_PREFILTER_CACHE_DIR, sample_settings=SAMPLE_SETTINGS, frame_cache=None,
+                         index_path=DEFAULT_INDEX_PATH):
+    """タイムライン全体の代表フレームをコンタクトシート（PIL.Image）のリストにする
+
+    スコア用（gray）とタイル用（rgb）の縮小フレームは元動画1回のデコードでまとめて作る
+    """
+    cache = AnalysisCache(cache_dir)
+    frame_cache = frame_cache or FrameCache(index_path=index_path)
+    sample_fps = sample_settings['sample_fps']
+    frame_cache.ensure_all(timeline, ('gray', 'rgb'), jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        all_scores = list(executor.map(
+            lambda info: score_media(info, cache, sample_settings, frame_cache), timeline
+        ))
+
+    # (ファイルの番号, 間引いたフレームの番号) をタイムライン順に並べ、多すぎる場合は均等に間引く
+    picks = []
+    for i, (info, scores) in enumerate(zip(timeline, all_scores)):
+        spans = file_spans[i] if file_spans is not None else None
+        picks.extend((i, index) for index in scene_frames(scores, sample_fps, spans))
+    if len(picks) > max_frames:
+        picks = [picks[int(i)] for i in np.linspace(0, len(picks) - 1, max_frames)]
+
+    # 選んだフレームだけを memmap から読む（rgb は gray より間引いてあるので、同じ時刻以前の最も近いフレームを使う）
+    frames = [frame_cache.frames(info, 'rgb') for info in timeline]
+    rgb_fps = frame_cache.variant_fps('rgb')
+    picks = dict.fromkeys((i, int(index * rgb_fps / sample_fps)) for i, index in picks)
+    tiles = [
+        (timeline[i].offset + index / rgb_fps, frames[i][index])
+        for i, index in picks if index < len(frames[i])
+    ]
+    per_sheet = SHEET_COLUMNS * SHEET_ROWS
+    return [tile_sheet(tiles[start:start + per_sheet]) for start in range(0, len(tiles), per_sheet)]
+
+
+def encode_sheets(sheets, quality=JPEG_QUALITY):
+    encoded = []
+    for sheet in sheets:
+        buffer = io.BytesIO()
+        sheet.save(buffer, format='JPEG', quality=quality)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def save_sheets(encoded_sheets, sheet_dir):
+    """確認用にコンタクトシートを書き出す"""
+    sheet_dir = Path(sheet_dir)
+    sheet_dir.mkdir(parents=True, exist_ok=True)
+    for stale_path in sheet_dir.glob('sheet_*.jpg'):
+        stale_path.unlink()
+    for i, data in enumerate(encoded_sheets):
+        (sheet_dir / f'sheet_{i:03d}.jpg').write_bytes(data)
+    return sheet_dir
+
+
+def sheet_parts(encoded_sheets):
+    """リクエストに含める画像（base64埋め込みのJPEG）"""
+    return [
+        "data:image/jpeg;base64,{}".format(base64.b64encode(data).decode("utf-8"))
+        for data in encoded_sheets
+    ]
+
+
+def contact_sheet_prompt(prompt, sheet_count):
+    with open(CONTACT_SHEET_PROMPT_PATH, "r") as f:
+        return prompt + f.read().format(sheet_count=sheet_count, columns=SHEET_COLUMNS)
+
+
+def prepare_sheets(timeline, file_spans=None, jobs=4, scores_cache_dir=DEFAULT_PREFILTER_CACHE_DIR, frame_cache=None):
+    with measure('media_encode') as counters:
+        encoded_sheets = encode_sheets(build_contact_sheets(
+            timeline, file_spans, jobs, cache_dir=scores_cache_dir, frame_cache=frame_cache
+        ))
+        counters['bytes'] = sum(len(data) for data in encoded_sheets)
+    return encoded_sheets
+
+
+async def analyze_contact_sheets_async(timeline, prompt, cache, client, sheet_dir=None, file_spans=None, jobs=4,
+                                       refresh=False, scores_cache_dir=DEFAULT_PREFILTER_CACHE_DIR,
+                                       frame_cache=None):
+    """動画の代わりにコンタクトシートを送って解析（同じシート・プロンプトの結果があれば再利用）"""
+    # フレームの読み込みと画像の作成はブロッキングなのでスレッドで実行
+    encoded_sheets = await asyncio.to_thread(
+        prepare_sheets, timeline, file_spans, jobs, scores_cache_dir, frame_cache
+    )
+    if not encoded_sheets:
+        raise ValueError('コンタクトシートに使えるフレームがありませんでした')
+    if sheet_dir is not None:
+        save_sheets(encoded_sheets, sheet_dir)
+    prompt = contact_sheet_prompt(prompt, len(encoded_sheets))
+    digest = hashlib.sha256()
+    for data in encoded_sheets:
+        digest.update(hashlib.sha256(data).digest())
+    key = analysis_cache_key(digest.hexdigest(), prompt, client.model, SCHEMA_VERSION)
+    cached_result = None if refresh else cache.get(key)
+    if cached_result is not None:
+        print(f"キャッシュ済みの解析結果を使用します: {key[:12]}")
+        return VideoHighlights.model_validate(cached_result)
+    total_bytes = sum(len(data) for data in encoded_sheets)
+    print(f"Geminiでコンタクトシートを解析（{len(encoded_sheets)}枚、{total_bytes / 1024:.0f}KB）")
+    highlights = await client.request_highlights(prompt, sheet_parts(encoded_sheets))
+    cache.put(key, highlights.model_dump())
+    return highlights
+
+
+def analyze_contact_sheets(timeline, prompt, cache, sheet_dir=None, file_spans=None, jobs=4, refresh=False,
+                           model=MODEL, scores_cache_dir=DEFAULT_PREFILTER_CACHE_DIR, client=None, frame_cache=None,
+                           **client_options):
+    client = client or ModelClient(model, **client_options)
+    return asyncio.run(analyze_contact_sheets_async(
+        timeline, prompt, cache, client, sheet_dir, file_spans, jobs, refresh, scores_cache_dir, frame_cache
+    ))
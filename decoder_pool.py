@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+# 同時に開いておく元動画の上限
+DEFAULT_MAX_OPEN = 4
+# VideoFileClip の音声読み込みと同じサンプリングレート
+AUDIO_FPS = 44100
+# フレームレートが取得できなかったファイルに使うフレームレート
+DEFAULT_FPS = 30
+
+
+def open_clip(path):
+    # moviepy.editor は読み込みに時間がかかるので、デコーダを開く時に読み込む
+    from moviepy.editor import VideoFileClip
+    return VideoFileClip(path)
+
+
+class DecoderPool:
+    """元動画のデコーダを必要になった時だけ開き、上限を超えたら古いものから閉じる"""
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max(1, max_open)
+        self._clips = OrderedDict()
+
+    def get(self, path):
+        clip = self._clips.pop(path, None)
+        if clip is None:
+            while len(self._clips) >= self.max_open:
+                _, oldest = self._clips.popitem(last=False)
+                oldest.close()
+            clip = open_clip(path)
+        self._clips[path] = clip
+        return clip
+
+    def close(self):
+        while self._clips:
+            _, clip = self._clips.popitem()
+            clip.close()
+
+
+def split_on_timeline(timeline, start, end):
+    """連結後の秒数区間を (MediaInfo, ファイル内の開始秒数, ファイル内の終了秒数) に分割"""
+    pieces = []
+    for info in timeline:
+        piece_start = max(start, info.offset)
+        piece_end = min(end, info.end)
+        if piece_end > piece_start:
+            pieces.append((info, piece_start - info.offset, piece_end - info.offset))
+    return pieces
+
+
+def pooled_subclip(pool, info, start, end):
+    """フレームを読む時にプールからデコーダを取得するサブクリップ"""
+    from moviepy.editor import VideoClip, AudioClip
+
+    def make_frame(t):
+        return pool.get(info.path).get_frame(start + t)
+
+    clip = VideoClip(make_frame, duration=end - start).set_fps(info.fps or DEFAULT_FPS)
+    if info.has_audio:
+        def make_audio_frame(t):
+            return pool.get(info.path).audio.get_frame(start + t)
+
+        clip = clip.set_audio(AudioClip(make_audio_frame, duration=end - start, fps=AUDIO_FPS))
+    return clip
@@ -0,0 +1,205 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from analysis_cache import AnalysisCache
+from frame_cache import FrameCache
+from media_index import DEFAULT_INDEX_PATH
+from prefilter import score_media, DEFAULT_PREFILTER_CACHE_DIR
+
+# 撮り直しとみなす基準（プロキシのキャッシュキーに含める）
+DEDUP_SETTINGS = dict(
+    hash_distance=10,   # 知覚ハッシュ（64ビット）のハミング距離がこれ以下なら同じ画
+    min_match=0.8,      # フレームのこの割合以上が代表のクリップにも映っていれば重複
+    min_contrast=8.0,   # 輝度の標準偏差がこれ未満の（真っ黒などの）フレームは比べない
+)
+# 知覚ハッシュの計算に使う縮小サイズと、残す低周波成分の大きさ
+HASH_SIZE = 32
+HASH_LOW = 8
+# 一度に比べるフレーム数（距離の行列のメモリを抑える）
+SEARCH_CHUNK = 1024
+
+
+def area_matrix(source, target):
+    """長さ source を target に面積平均で縮小する行列 (target, source)"""
+    edges = np.linspace(0, source, target + 1)
+    positions = np.arange(source)
+    overlap = np.clip(
+        np.minimum(edges[1:, None], positions[None, :] + 1) - np.maximum(edges[:-1, None], positions[None, :]), 0, None
+    )
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def dct_matrix(size):
+    """正規直交の DCT-II の行列"""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def phash_frames(frames):
+    """グレースケールのフレーム (枚数, 高さ, 幅) の知覚ハッシュを uint64 の配列で返す
+
+    32x32 に縮小して DCT をかけ、左上 8x8 の低周波成分が中央値（直流成分を除く）より大きいかをビットにする
+    """
+    count, height, width = frames.shape
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64)
+    small = area_matrix(height, HASH_SIZE) @ np.asarray(frames, dtype=np.float32) @ area_matrix(width, HASH_SIZE).T
+    dct = dct_matrix(HASH_SIZE)
+    low = (dct @ small @ dct.T)[:, :HASH_LOW, :HASH_LOW].reshape(count, -1)
+    bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def clip_hashes(frames, min_contrast=DEDUP_SETTINGS['min_contrast']):
+    """比べる価値のあるフレーム（平坦でないもの）だけのハッシュ"""
+    contrast = np.asarray(frames, dtype=np.float32).std(axis=(1, 2))
+    return phash_frames(np.asarray(frames)[contrast >= min_contrast])
+
+
+def match_matrix(hashes, max_distance=DEDUP_SETTINGS['hash_distance']):
+    """クリップ i のフレームのうち、クリップ j に距離 max_distance 以内のフレームがある割合 [i, j]
+
+    全クリップのハッシュを1つの配列にまとめ、XOR とビット数のカウントで距離をまとめて計算する。
+    距離の行列は比べる側・比べられる側ともに SEARCH_CHUNK ずつに区切り、最大 SEARCH_CHUNK x SEARCH_CHUNK に抑える
+    """
+    clip_count = len(hashes)
+    matrix = np.zeros((clip_count, clip_count))
+    owners = np.repeat(np.arange(clip_count), [len(h) for h in hashes])
+    if len(owners) == 0:
+        return matrix
+    all_hashes = np.concatenate(hashes)
+    for i, clip in enumerate(hashes):
+        if len(clip) == 0:
+            continue
+        found = np.zeros((len(clip), clip_count), dtype=bool)
+        for chunk_start in range(0, len(clip), SEARCH_CHUNK):
+            chunk = clip[chunk_start:chunk_start + SEARCH_CHUNK]
+            # クリップごとの最小距離（64ビットなので 65 は「まだ見つかっていない」）
+            nearest = np.full((len(chunk), clip_count), 65, dtype=np.uint8)
+            for ref_start in range(0, len(all_hashes), SEARCH_CHUNK):
+                ref_owners = owners[ref_start:ref_start + SEARCH_CHUNK]
+                starts = np.flatnonzero(np.r_[True, ref_owners[1:] != ref_owners[:-1]])
+                distance = np.bitwise_count(chunk[:, None] ^ all_hashes[None, ref_start:ref_start + SEARCH_CHUNK])
+                present = ref_owners[starts]
+                nearest[:, present] = np.minimum(nearest[:, present], np.minimum.reduceat(distance, starts, axis=1))
+            found[chunk_start:chunk_start + len(chunk)] = nearest <= max_distance
+        matrix[i] = found.mean(axis=0)
+        matrix[i, i] = 1.0
+    return matrix
+
+
+def frames_in_spans(frames, sample_fps, spans=None):
+    """残す区間に入るフレームだけ（spans が None なら全て）"""
+    if spans is None:
+        return frames
+    times = np.arange(len(frames)) / sample_fps
+    keep = np.zeros(len(frames), dtype=bool)
+    for start, end in spans:
+        keep |= (times >= start) & (times < end)
+    return frames[keep]
+
+
+def clip_quality(info, scores):
+    """代表を選ぶ基準（解像度、シャープさ、長さの順に大きい方）"""
+    sharpness = float(np.mean(scores['blur'])) if len(scores['blur']) else 0.0
+    return ((info.width or 0) * (info.height or 0), sharpness, info.duration)
+
+
+def group_duplicates(matrix, qualities, min_match=DEDUP_SETTINGS['min_match']):
+    """似たクリップをまとめ、[(代表の番号, [(重複の番号, 一致率)])] を返す
+
+    代表は品質が最も高いクリップ。代表に映っていない部分が多いクリップは重複にしない
+    """
+    count = len(qualities)
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    similar = (matrix >= min_match) | (matrix.T >= min_match)
+    for i, j in zip(*np.nonzero(np.triu(similar, k=1))):
+        parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+    result = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        representative = max(members, key=lambda i: (qualities[i], -i))
+        duplicates = [
+            (i, float(matrix[i, representative])) for i in members
+            if i != representative and matrix[i, representative] >= min_match
+        ]
+        if duplicates:
+            result.append((representative, duplicates))
+    return result
+
+
+def find_duplicates(timeline, settings=DEDUP_SETTINGS, frame_cache=None, scores_cache_dir=DEFAULT_PREFILTER_CACHE_DIR,
+                    jobs=4, index_path=DEFAULT_INDEX_PATH, file_spans=None):
+    """撮り直しなどの重複したクリップを探し、代表と重複のファイルのリストを返す
+
+    file_spans（事前フィルタで残す区間）を渡すと、その区間のフレームだけで比べる。
+    区間が残っていないクリップは重複にも代表にもならないので、グループの全員が除かれることはない
+    """
+    frame_cache = frame_cache or FrameCache(index_path=index_path)
+    cache = AnalysisCache(scores_cache_dir)
+    spans = file_spans or [None] * len(timeline)
+
+    def load(info, clip_spans):
+        frames = frames_in_spans(frame_cache.frames(info, 'gray'), frame_cache.variant_fps('gray'), clip_spans)
+        return clip_hashes(frames, settings['min_contrast']), score_media(info, cache, frame_cache=frame_cache)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        loaded = list(executor.map(load, timeline, spans))
+    hashes = [clip for clip, _ in loaded]
+    qualities = [clip_quality(info, scores) for info, (_, scores) in zip(timeline, loaded)]
+    matrix = match_matrix(hashes, settings['hash_distance'])
+    return [
+        dict(
+            representative=timeline[representative].path,
+            duplicates=[dict(path=timeline[i].path, similarity=similarity) for i, similarity in duplicates],
+        )
+        for representative, duplicates in group_duplicates(matrix, qualities, settings['min_match'])
+    ]
+
+
+def drop_duplicates(timeline, file_spans, groups):
+    """重複したファイルを除いた残す区間（file_spans が None なら各ファイルの全体から除く）"""
+    skipped = {duplicate['path'] for group in groups for duplicate in group['duplicates']}
+    if not skipped:
+        return file_spans
+    if file_spans is None:
+        file_spans = [[[0.0, info.duration]] for info in timeline]
+    return [[] if info.path in skipped else spans for info, spans in zip(timeline, file_spans)]
+
+
+def dedup_map_path(output_file):
+    """重複の対応表の保存先（例: videos/tokyo.dedup.json）"""
+    return Path(output_file).with_suffix('.dedup.json')
+
+
+def save_dedup_map(output_file, timeline, groups):
+    """除いたファイルとその代表を、元のタイムライン上の位置と一緒に保存する"""
+    positions = {info.path: [info.offset, info.end] for info in timeline}
+    data = [
+        dict(
+            representative=group['representative'],
+            representative_timeline=positions[group['representative']],
+            duplicates=[dict(duplicate, timeline=positions[duplicate['path']]) for duplicate in group['duplicates']],
+        )
+        for group in groups
+    ]
+    path = dedup_map_path(output_file)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    return path
@@ -0,0 +1,119 @@
+import functools
+import re
+import subprocess
+from ffmpeg_utils import ffmpeg_binary, run_ffmpeg
+from proxy_planner import width_for
+
+# 音声のないファイルや区間に入れる無音（連結時に全区間のストリーム構成を揃える）
+SILENCE_SOURCE = 'anullsrc=r=44100:cl=stereo'
+
+
+@functools.cache
+def available_filters():
+    """ffmpegで使えるフィルタ名（drawtext は freetype 付きのビルドにしかない）"""
+    result = subprocess.run([ffmpeg_binary(), '-hide_banner', '-filters'], capture_output=True, text=True,
+                            errors='replace')
+    return {match.group(1) for match in re.finditer(r'^\s*[.A-Z|]{3}\s+(\w+)', result.stdout, re.MULTILINE)}
+
+
+def quote(value):
+    """フィルタのオプション値をシングルクォートで囲む"""
+    return "'" + str(value).replace("'", "'\\''") + "'"
+
+
+def ffmpeg_color(color):
+    """moviepy（ImageMagick）の色指定を ffmpeg の色指定に変換（例: rgba(0,0,0,0.7) -> 0x000000@0.7）"""
+    match = re.fullmatch(r'rgba?\((\d+),\s*(\d+),\s*(\d+)(?:,\s*([\d.]+))?\)', color.strip())
+    if match is None:
+        return color
+    r, g, b, alpha = match.groups()
+    value = f'0x{int(r):02x}{int(g):02x}{int(b):02x}'
+    return value if alpha is None else f'{value}@{alpha}'
+
+
+def timestamp_drawtext(fontfile, fontsize=24, color='white', bg_color='rgba(0,0,0,0.7)'):
+    """右上に経過秒数（四捨五入）を描く drawtext フィルタ
+
+    0.5 秒は切り上げる（timestamp_overlay.timestamp_label と同じ floor(t + 0.5)）
+    """
+    return (
+        f"drawtext=fontfile={quote(fontfile)}:text='%{{eif\\:floor(t+0.5)\\:d}}秒'"
+        f":fontsize={fontsize}:fontcolor={ffmpeg_color(color)}"
+        f":box=1:boxcolor={ffmpeg_color(bg_color)}:boxborderw=0:x=w-tw:y=0"
+    )
+
+
+def proxy_size(timeline, height):
+    """全ファイルを揃える解像度（最も多い解像度を height まで縮小、幅は偶数）"""
+    sizes = [(info.width, info.height) for info in timeline]
+    width, source_height = max(set(sizes), key=sizes.count)
+    if height is None or source_height <= height:
+        return width - width % 2, source_height - source_height % 2
+    return width_for(height, width, source_height), height
+
+
+def proxy_pieces(timeline, file_spans=None):
+    """連結する区間 (元動画の情報, 開始秒数, 長さ) のリスト（事前フィルタで除外した区間は含めない）"""
+    pieces = []
+    for i, info in enumerate(timeline):
+        spans = file_spans[i] if file_spans is not None else None
+        if spans is None:
+            pieces.append((info, None, None))
+        else:
+            pieces.extend((info, start, end - start) for start, end in spans)
+    return pieces
+
+
+def proxy_command(timeline, output_path, size, fps, bitrate, audio_bitrate=None, codec='libx264',
+                  preset='ultrafast', file_spans=None, overlay=None):
+    """ファイルの連結・縮小・フレームレートの変換・秒数の描画を1つのフィルタグラフにまとめた引数
+
+    区間は入力側の -ss/-t で切り出すので、除外した区間はデコードしない
+    """
+    width, height = size
+    args = []
+    chains = []
+    labels = []
+    pieces = proxy_pieces(timeline, file_spans)
+    for i, (info, start, duration) in enumerate(pieces):
+        if start is not None:
+            args += ['-ss', f'{start:.6f}', '-t', f'{duration:.6f}']
+        args += ['-i', info.path]
+        # 縦横比の違うファイルは縮小して余白を付け、concat に渡す形式を揃える
+        chains.append(
+            f'[{i}:v:0]fps={fps:g},scale={width}:{height}:force_original_aspect_ratio=decrease,'
+            f'pad={width}:{height}:-1:-1,setsar=1,format=yuv420p[v{i}]'
+        )
+        labels.append(f'[v{i}]')
+        if audio_bitrate is not None:
+            if info.has_audio:
+                chains.append(f'[{i}:a:0]aresample=44100,aformat=channel_layouts=stereo[a{i}]')
+            else:
+                length = duration if duration is not None else info.duration
+                chains.append(f'{SILENCE_SOURCE},atrim=duration={length:.6f}[a{i}]')
+            labels.append(f'[a{i}]')
+
+    streams = 'v=1:a=1' if audio_bitrate is not None else 'v=1:a=0'
+    outputs = '[joined][a]' if audio_bitrate is not None else '[joined]'
+    chains.append(f"{''.join(labels)}concat=n={len(pieces)}:{streams}{outputs}")
+    # 秒数は連結後のタイムスタンプ（プロキシ上の秒数）で描く
+    chains.append(f"[joined]{overlay or 'null'}[v]")
+
+    args += ['-filter_complex', ';'.join(chains), '-map', '[v]']
+    args += ['-c:v', codec, '-preset', preset, '-b:v', bitrate, '-r', f'{fps:g}']
+    if audio_bitrate is not None:
+        args += ['-map', '[a]', '-c:a', 'aac', '-b:a', audio_bitrate]
+    else:
+        args += ['-an']
+    args += ['-movflags', '+faststart', output_path]
+    return args
+
+
+def encode_proxy(timeline, output_path, size, fps, bitrate, audio_bitrate=None, codec='libx264',
+                 preset='ultrafast', file_spans=None, fontfile=None, style=None):
+    """プロキシ動画を ffmpeg 1回で書き出す（フレームは Python を通らない）"""
+    overlay = timestamp_drawtext(fontfile, **(style or {}))
+    run_ffmpeg(proxy_command(
+        timeline, output_path, size, fps, bitrate, audio_bitrate, codec, preset, file_spans, overlay
+    ))
+    return output_path
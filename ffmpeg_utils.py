@@ -0,0 +1,38 @@
+import functools
+import os
+import subprocess
+import tempfile
+
+
+@functools.cache
+def ffmpeg_binary():
+    """moviepyと同じffmpegバイナリ（moviepy.config は imageio を読み込むので最初に使う時に読み込む）"""
+    from moviepy.config import get_setting
+    return get_setting('FFMPEG_BINARY')
+
+
+def run_ffmpeg(args, loglevel='error'):
+    """moviepyと同じffmpegバイナリでコマンドを実行"""
+    cmd = [ffmpeg_binary(), '-hide_banner', '-loglevel', loglevel, '-y', *map(str, args)]
+    result = subprocess.run(cmd, capture_output=True, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpegの実行に失敗しました: {result.stderr.strip()}')
+    return result
+
+
+def concat_copy(segment_paths, output_path):
+    """concat demuxerで再エンコードせずに動画を連結"""
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+        for segment_path in segment_paths:
+            escaped = os.path.abspath(segment_path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        list_path = f.name
+    try:
+        run_ffmpeg([
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c', 'copy', '-movflags', '+faststart', output_path,
+        ])
+    finally:
+        os.remove(list_path)
+    return output_path
+
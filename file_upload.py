@@ -0,0 +1,100 @@
+import json
+import os
+import time
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+GEMINI_BASE_URL = 'https://generativelanguage.googleapis.com'
+# チャンクサイズは 256KiB の倍数にする
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = 60
+
+
+def _request(url, data=None, headers=None, method='POST'):
+    request = Request(url, data=data, headers=headers or {}, method=method)
+    with urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+        return response.headers, response.read()
+
+
+def _with_key(url, api_key):
+    return f'{url}?key={api_key}' if api_key else url
+
+
+def query_offset(upload_url):
+    """サーバーが受け取り済みのバイト数を問い合わせる"""
+    headers, _ = _request(upload_url, headers={'X-Goog-Upload-Command': 'query'})
+    return int(headers.get('X-Goog-Upload-Size-Received', 0))
+
+
+def start_upload(path, mime_type, api_key, base_url):
+    size = os.path.getsize(path)
+    metadata = json.dumps({'file': {'display_name': Path(path).name}}).encode('utf-8')
+    headers, _ = _request(
+        _with_key(f'{base_url}/upload/v1beta/files', api_key),
+        data=metadata,
+        headers={
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Header-Content-Length': str(size),
+            'X-Goog-Upload-Header-Content-Type': mime_type,
+            'Content-Type': 'application/json',
+        },
+    )
+    return headers['X-Goog-Upload-URL']
+
+
+def upload_chunks(upload_url, path, chunk_size=CHUNK_SIZE):
+    """ファイルをチャンクごとに読み込んで送信（失敗時は受信済みの位置から再開）"""
+    size = os.path.getsize(path)
+    offset = 0
+    retries = 0
+    with open(path, 'rb') as f:
+        while True:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            last = offset + len(chunk) >= size
+            try:
+                _, body = _request(upload_url, data=chunk, headers={
+                    'X-Goog-Upload-Command': 'upload, finalize' if last else 'upload',
+                    'X-Goog-Upload-Offset': str(offset),
+                    'Content-Length': str(len(chunk)),
+                })
+            except (HTTPError, URLError, TimeoutError) as e:
+                if isinstance(e, HTTPError) and e.code < 500:
+                    raise
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise
+                print(f'アップロードを再開します（{retries}/{MAX_RETRIES}）: {e}')
+                time.sleep(2 ** retries)
+                offset = query_offset(upload_url)
+                continue
+            retries = 0
+            offset += len(chunk)
+            if last:
+                return json.loads(body)['file']
+
+
+def wait_until_active(file_info, api_key, base_url, poll_interval=2, timeout=600):
+    """アップロードした動画の処理が終わるまで待つ"""
+    deadline = time.monotonic() + timeout
+    while file_info.get('state', 'ACTIVE') == 'PROCESSING':
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'ファイルの処理が終わりませんでした: {file_info["name"]}')
+        time.sleep(poll_interval)
+        _, body = _request(_with_key(f'{base_url}/v1beta/{file_info["name"]}', api_key), method='GET')
+        file_info = json.loads(body)
+    if file_info.get('state') == 'FAILED':
+        raise RuntimeError(f'ファイルの処理に失敗しました: {file_info["name"]}')
+    return file_info
+
+
+def upload_file(path, mime_type='video/mp4', api_key=None, base_url=GEMINI_BASE_URL,
+                chunk_size=CHUNK_SIZE, poll_interval=2):
+    """Files API の resumable upload で動画をアップロードし、ファイル情報（uri など）を返す"""
+    api_key = api_key or os.environ.get('GEMINI_API_KEY')
+    upload_url = start_upload(path, mime_type, api_key, base_url)
+    file_info = upload_chunks(upload_url, path, chunk_size)
+    return wait_until_active(file_info, api_key, base_url, poll_interval)
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from ffmpeg_utils import run_ffmpeg
+from instrumentation import measure
+from media_index import open_index, lookup_frames, store_frames, frame_entries, forget_frames, DEFAULT_INDEX_PATH
+
+DEFAULT_FRAME_CACHE_DIR = '.cache/frames'
+# 縮小フレームのキャッシュの容量上限（超えた分は最後に使われた時刻が古いものから削除）
+DEFAULT_FRAME_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# 縮小フレームを取り出す間隔（1秒あたりの枚数）
+FRAME_SAMPLE_FPS = 2
+# 保存する縮小フレームの種類（事前フィルタ・重複検出は gray、コンタクトシートは rgb を使う）
+# every は FRAME_SAMPLE_FPS のフレームから何枚ごとに残すか（rgb はコンタクトシートのタイルにしか使わないので
+# 間引いて小さく保つ。1時間あたり gray は約 100MB、rgb は約 400MB）
+FRAME_VARIANTS = dict(
+    gray=dict(width=160, pix_fmt='gray', channels=1, every=1),
+    rgb=dict(width=256, pix_fmt='rgb24', channels=3, every=2),
+)
+
+
+def thumbnail_height(sample_width, width=None, height=None):
+    """縦横比を保った縮小後の高さ（偶数、解像度が分からなければ 16:9）"""
+    if width and height:
+        return max(2, int(round(height * sample_width / width / 2)) * 2)
+    return sample_width * 9 // 16
+
+
+def frame_shape(info, variant):
+    """1フレームの配列の形（gray は (高さ, 幅)、rgb は (高さ, 幅, 3)）"""
+    spec = FRAME_VARIANTS[variant]
+    shape = (thumbnail_height(spec['width'], info.width, info.height), spec['width'])
+    return shape if spec['channels'] == 1 else (*shape, spec['channels'])
+
+
+def decode_thumbnails(info, store_paths, sample_fps=FRAME_SAMPLE_FPS):
+    """元動画を1回だけデコードし、種類ごとの縮小フレームを保存先のファイルに直接書き出す"""
+    variants = list(store_paths)
+    labels = ''.join(f'[s{i}]' for i in range(len(variants)))
+    chains = [f'[0:v:0]fps={sample_fps},split={len(variants)}{labels}']
+    outputs = []
+    for i, variant in enumerate(variants):
+        spec = FRAME_VARIANTS[variant]
+        height = frame_shape(info, variant)[0]
+        step = f"framestep={spec['every']}," if spec['every'] > 1 else ''
+        chains.append(f"[s{i}]{step}scale={spec['width']}:{height},format={spec['pix_fmt']}[o{i}]")
+        outputs += ['-map', f'[o{i}]', '-f', 'rawvideo', store_paths[variant]]
+    run_ffmpeg(['-i', info.path, '-filter_complex', ';'.join(chains), *outputs])
+
+
+def open_frames(store_path, shape):
+    """保存したフレームを (枚数, *shape) の読み取り専用の memmap で開く（途中で切れた最後のフレームは使わない）"""
+    count = os.path.getsize(store_path) // int(np.prod(shape))
+    if count == 0:
+        # 空のファイルは memmap できない
+        return np.empty((0, *shape), dtype=np.uint8)
+    return np.memmap(store_path, dtype=np.uint8, mode='r', shape=(count, *shape))
+
+
+class FrameCache:
+    """元動画ごとの縮小フレームを raw のまま保存し、メタデータインデックスから引くLRUキャッシュ
+
+    ffmpeg が保存先に直接書き出したファイルを np.memmap で開き、各パスは必要なフレームだけを読む
+    """
+
+    def __init__(self, cache_dir=DEFAULT_FRAME_CACHE_DIR, index_path=DEFAULT_INDEX_PATH,
+                 sample_fps=FRAME_SAMPLE_FPS, max_bytes=DEFAULT_FRAME_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.index_path = index_path
+        self.sample_fps = sample_fps
+        self.max_bytes = max_bytes
+
+    def settings(self, variant):
+        return json.dumps(dict(FRAME_VARIANTS[variant], sample_fps=self.sample_fps), sort_keys=True)
+
+    def variant_fps(self, variant):
+        """保存したフレームの1秒あたりの枚数"""
+        return self.sample_fps / FRAME_VARIANTS[variant]['every']
+
+    def store_path(self, info, variant):
+        payload = json.dumps([info.path, info.size, info.mtime_ns, self.settings(variant)])
+        return self.cache_dir / f'{hashlib.sha256(payload.encode("utf-8")).hexdigest()}.{variant}.raw'
+
+    def lookup(self, conn, info, variant):
+        store_path = lookup_frames(conn, info, variant, self.settings(variant))
+        if not store_path:
+            return None
+        try:
+            # 使用時刻を更新してLRUの順序に反映
+            os.utime(store_path)
+        except FileNotFoundError:
+            return None
+        return store_path
+
+    def ensure(self, info, variants=('gray',)):
+        """足りない種類の縮小フレームをまとめて作り、{種類: 保存先のパス} を返す"""
+        conn = open_index(self.index_path)
+        try:
+            paths = {variant: self.lookup(conn, info, variant) for variant in variants}
+            missing = [variant for variant, path in paths.items() if path is None]
+            if not missing:
+                return paths
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_paths = {variant: self.store_path(info, variant).with_suffix('.tmp') for variant in missing}
+            try:
+                with measure('frame_decode', byte_count=info.size) as counters:
+                    decode_thumbnails(info, tmp_paths, self.sample_fps)
+                    for variant, tmp_path in tmp_paths.items():
+                        store_path = self.store_path(info, variant)
+                        os.replace(tmp_path, store_path)
+                        count = len(open_frames(store_path, frame_shape(info, variant)))
+                        counters['frames'] = count
+                        stale_path = store_frames(conn, info, variant, self.settings(variant), store_path, count)
+                        if stale_path:
+                            # 元動画が変わる前の縮小フレームは使わないので削除
+                            Path(stale_path).unlink(missing_ok=True)
+                        paths[variant] = str(store_path)
+            finally:
+                for tmp_path in tmp_paths.values():
+                    tmp_path.unlink(missing_ok=True)
+            self.evict(conn, keep=paths.values())
+            return paths
+        finally:
+            conn.close()
+
+    def ensure_all(self, timeline, variants=('gray',), jobs=4):
+        """タイムラインの全ファイルの縮小フレームを並列に用意する"""
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(lambda info: self.ensure(info, variants), timeline))
+
+    def frames(self, info, variant='gray'):
+        """縮小フレームを (枚数, 高さ, 幅[, 3]) の読み取り専用の memmap で返す"""
+        return open_frames(self.ensure(info, (variant,))[variant], frame_shape(info, variant))
+
+    def evict(self, conn, keep=()):
+        """元動画が消えた縮小フレームを削除し、残りは最後に使われた時刻が古いものから容量上限以内に収める"""
+        keep = {str(path) for path in keep}
+        removed = [store_path for path, store_path in frame_entries(conn)
+                   if not os.path.exists(path) and store_path not in keep]
+        for store_path in removed:
+            Path(store_path).unlink(missing_ok=True)
+
+        entries = []
+        for path in self.cache_dir.glob('*.raw'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # 別のスレッドが先に削除した
+                continue
+            entries.append((stat.st_mtime, stat.st_size, str(path)))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            print(f'縮小フレームのキャッシュを削除: {Path(path).name}')
+            Path(path).unlink(missing_ok=True)
+            removed.append(path)
+            total -= size
+        forget_frames(conn, removed)
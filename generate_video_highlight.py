@@ -1,230 +1,922 @@
-import base64
 import json
 from pathlib import Path
-from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip, concatenate_videoclips
-from pydantic import BaseModel, Field
-from litellm import completion
 import argparse
+import asyncio
+import multiprocessing
 import os
-from tqdm import tqdm
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from proxy_cache import ProxyCache, proxy_cache_key, DEFAULT_CACHE_DIR
+from ffmpeg_utils import concat_copy
+from media_index import scan_media, DEFAULT_INDEX_PATH
+from decoder_pool import DecoderPool, split_on_timeline, pooled_subclip, DEFAULT_MAX_OPEN, DEFAULT_FPS
+from smart_cut import create_smart_highlight_video
+from subtitles import narration_cues, write_subtitles, mux_subtitles, SUBTITLE_FORMATS
+from analysis_cache import AnalysisCache, DEFAULT_ANALYSIS_CACHE_DIR
+from highlight_analysis import MODEL, PROMPT_PATH
+from chunked_analysis import DEFAULT_WINDOW_SECONDS, DEFAULT_OVERLAP_SECONDS, check_windows
+from model_client import ModelClient, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_MAX_RETRIES, DEFAULT_REQUEST_TIMEOUT
+from proxy_planner import plan_for_timeline, total_bitrate_for, keeps_quality, DEFAULT_TOKEN_BUDGET
+from ffmpeg_proxy import proxy_size
+from instrumentation import (
+    measure, start_run, write_json_report, write_prometheus_report, STAGES as METRIC_STAGES
+)
+from pipeline_state import PipelineState, stage_fingerprint, timeline_sources
+from segment_manifest import (
+    segment_dir_for, segment_name, load_manifest, save_manifest, manifest_entry, is_reusable, previous_settings
+)
 
-def merge_videos_with_timestamp(input_dir, output_path, refresh=False):
-    FPS = None
-    # 入力ディレクトリから全ての動画ファイルを取得
+# 秒数テキストの描画設定
+TIMESTAMP_STYLE = dict(fontsize=24, color='white', bg_color='rgba(0,0,0,0.7)')
+# ハイライトのセグメントの書き出し設定（無劣化で連結できるよう全セグメントで同じにする）
+SEGMENT_ENCODE_OPTIONS = dict(codec='libx264', preset='medium', audio_codec='aac', audio_fps=44100, audio_bitrate='192k')
+# ナレーションのフォントの候補（macOS・Linux・Windows の順に探す）
+NARRATION_FONT_CANDIDATES = (
+    '/System/Library/Fonts/ヒラギノ角ゴシック W5.ttc',
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc',
+    'C:/Windows/Fonts/meiryo.ttc',
+)
+
+def kept_subclips(clip, spans):
+    """事前フィルタで残した区間だけをつなげる（spans が None なら全体）"""
+    if spans is None:
+        return clip
+    from moviepy.editor import concatenate_videoclips
+    return concatenate_videoclips([clip.subclip(start, end) for start, end in spans])
+
+def fit_proxy_size(clip, size):
+    """全ファイルで揃えるプロキシの解像度に縮小し、縦横比の違うファイルは余白を付ける（ffmpeg の scale と pad と同じ）
+
+    セグメントを再エンコードせずに連結するので、途中で解像度が変わらないようにする
+    """
+    if size is None:
+        return clip
+    width, height = size
+    if (clip.w, clip.h) == (width, height):
+        return clip
+    scale = min(width / clip.w, height / clip.h)
+    fitted = clip.resize(newsize=(max(2, int(clip.w * scale) // 2 * 2), max(2, int(clip.h * scale) // 2 * 2)))
+    if (fitted.w, fitted.h) == (width, height):
+        return fitted
+    return fitted.on_color(size=(width, height), color=(0, 0, 0), pos='center')
+
+def encode_proxy_segment(video_path, segment_path, offset, fps, bitrate, audio_bitrate, codec, preset,
+                         size=None, spans=None):
+    """1ファイル分のプロキシを書き出す（秒数表示は offset から開始、audio_bitrate が None なら音声なし）"""
+    from moviepy.editor import VideoFileClip
+    from timestamp_overlay import build_glyph_atlas, add_timestamp_overlay
+    clip = VideoFileClip(str(video_path))
+    try:
+        atlas = build_glyph_atlas(**TIMESTAMP_STYLE)
+        clip_with_text = add_timestamp_overlay(fit_proxy_size(kept_subclips(clip, spans), size), atlas, offset)
+        if audio_bitrate is not None and clip_with_text.audio is None:
+            # 音声のないファイルは無音を入れて、連結時に全セグメントのストリーム構成を揃える
+            clip_with_text = clip_with_text.set_audio(silent_audio(clip_with_text.duration))
+        clip_with_text.write_videofile(
+            str(segment_path),
+            codec=codec,
+            audio=audio_bitrate is not None,
+            audio_codec='aac',
+            audio_bitrate=audio_bitrate,
+            threads=1,
+            preset=preset,
+            fps=fps,
+            bitrate=bitrate,
+            logger=None
+        )
+    finally:
+        clip.close()
+    return segment_path
+
+def encode_proxy_segments(tasks, jobs, **encode_options):
+    """ファイルごとのプロキシをプロセスプールで並列に書き出す
+
+    tasks は (元動画のパス, セグメントのパス, 秒数表示のオフセット, 残す区間) のリスト
+    """
+    if not tasks:
+        return
+    from tqdm import tqdm
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(encode_proxy_segment, video_path, segment_path, offset, spans=spans, **encode_options)
+            for video_path, segment_path, offset, spans in tasks
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='プロキシ書き出し'):
+            future.result()
+
+def bitrate_bps(bitrate):
+    """'32k' のようなビットレートを bps にする（None は 0）"""
+    return int(bitrate.rstrip('k')) * 1000 if bitrate else 0
+
+def update_proxy_segments(video_files, durations, segment_dir, jobs, byte_budget, plan, file_spans=None,
+                          **encode_options):
+    """新規・変更されたファイルだけを書き出し、全セグメントのパスを返す
+
+    書き出し済みのセグメントがあれば同じフレームレート・高さ・音声で続きを書き、
+    容量は再利用するセグメントの実際のサイズを引いた残りだけを新しいファイルに割り当てる。
+    残りでは画質が保てない場合は、全てのファイルを plan で書き出し直す。
+    file_spans を渡した場合、durations は残す区間の合計（プロキシ上の長さ）
+    """
+    segment_dir = Path(segment_dir)
+    segment_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(segment_dir)
+    planned = dict(encode_options, overlay=TIMESTAMP_STYLE)
+
+    files = []
+    offset = 0
+    for i, (video_path, duration) in enumerate(zip(video_files, durations)):
+        spans = file_spans[i] if file_spans is not None else None
+        if spans == []:
+            # 事前フィルタで全て除外したファイル
+            continue
+        key = str(Path(video_path).resolve())
+        files.append((video_path, key, segment_dir / segment_name(video_path), offset, duration, spans))
+        offset += duration
+
+    def split(settings):
+        """(再利用できるファイル, 書き出すファイル)"""
+        reused, tasks = [], []
+        for file in files:
+            video_path, key, _, offset, _, spans = file
+            file_settings = settings if spans is None else dict(settings, spans=spans)
+            if is_reusable(manifest.get(key), video_path, segment_dir, offset, file_settings):
+                reused.append(file)
+            else:
+                tasks.append(file)
+        return reused, tasks
+
+    # 元動画が変わっていないセグメントがあれば、その時の計画で続きを書く
+    kept = [
+        manifest[key] for video_path, key, _, offset, _, _ in files
+        if key in manifest and is_reusable(manifest[key], video_path, segment_dir, offset, manifest[key]['settings'])
+    ]
+    settings = previous_settings(kept, planned) or planned
+    if settings['audio_bitrate'] and not planned['audio_bitrate']:
+        # トークンの上限などで今回の計画が音声を落とした場合は合わせる
+        settings = planned
+    reused, tasks = split(settings)
+    reused_bytes = sum(os.path.getsize(segment_path) for _, _, segment_path, _, _, _ in reused)
+    new_duration = sum(duration for _, _, _, _, duration, _ in tasks)
+    video_bitrate = total_bitrate_for(new_duration, byte_budget - reused_bytes) - bitrate_bps(settings['audio_bitrate'])
+    width, height = settings['size']
+    if tasks and not keeps_quality(video_bitrate, settings['fps'], height, width):
+        # 残りの容量では画質が保てないので、全て今回の計画で書き出し直す
+        settings, reused, tasks = planned, [], files
+        video_bitrate = plan.video_bitrate
+    elif reused and settings is not planned:
+        print(f"書き出し済みのセグメントに合わせます: {width}x{height} {settings['fps']:g}fps")
+    bitrate = f'{video_bitrate // 1000}k'
+
+    segments = {}
+    task_keys = {key for _, key, _, _, _, _ in tasks}
+    for video_path, key, segment_path, offset, _, spans in files:
+        entry = manifest.get(key)
+        if key in task_keys:
+            file_settings = settings if spans is None else dict(settings, spans=spans)
+            entry = manifest_entry(video_path, segment_path, offset, video_bitrate, file_settings)
+        segments[key] = entry
+
+    print(f'セグメント: 再利用 {len(reused)} / 新規書き出し {len(tasks)}')
+    encode_options = {key: value for key, value in settings.items() if key != 'overlay'}
+    encode_proxy_segments(
+        [(video_path, segment_path, offset, spans) for video_path, _, segment_path, offset, _, spans in tasks],
+        jobs, bitrate=bitrate, **encode_options
+    )
+    save_manifest(segment_dir, segments)
+
+    # 入力から消えたファイルのセグメントを削除
+    used_names = {entry['segment'] for entry in segments.values()}
+    for stale_path in segment_dir.glob('*.mp4'):
+        if stale_path.name not in used_names:
+            stale_path.unlink()
+    return [segment_path for _, _, segment_path, _, _, _ in files]
+
+def ffmpeg_proxy_problem(font=None):
+    """ffmpegだけでプロキシを書き出せない理由（書き出せる場合は None）"""
+    from ffmpeg_proxy import available_filters
+    if 'drawtext' not in available_filters():
+        return 'ffmpegにdrawtextフィルタがない'
+    fontfile = find_narration_font(font)
+    if fontfile is None or not Path(fontfile).is_file():
+        return '秒数テキストのフォントファイルが見つからない'
+    return None
+
+def resolve_proxy_engine(proxy_engine, font=None):
+    """実際にプロキシを書き出すエンジン（ffmpeg が使えなければ moviepy）
+
+    キャッシュキーと実行状態の指紋は、指定されたエンジンではなくこの結果で作る
+    """
+    if proxy_engine == 'ffmpeg':
+        problem = ffmpeg_proxy_problem(font)
+        if problem is None:
+            return 'ffmpeg'
+        print(f'{problem}ため、MoviePyでプロキシを書き出します')
+    return 'moviepy'
+
+def encode_ffmpeg_proxy(timeline, output_path, plan, file_spans=None, font=None, codec='libx264',
+                        preset='ultrafast'):
+    """ffmpegのフィルタグラフ1つでプロキシを書き出す（使えない・失敗した場合は False を返す）"""
+    from ffmpeg_proxy import encode_proxy, proxy_size
+    problem = ffmpeg_proxy_problem(font)
+    if problem:
+        print(f'{problem}ため、MoviePyでプロキシを書き出します')
+        return False
+    fontfile = find_narration_font(font)
+    print('ffmpegで動画を書き出し中...')
+    try:
+        encode_proxy(
+            timeline, output_path, proxy_size(timeline, plan.height), plan.fps, plan.bitrate_str,
+            plan.audio_bitrate_str, codec, preset, file_spans, fontfile, TIMESTAMP_STYLE
+        )
+    except RuntimeError as e:
+        print(f'ffmpegでの書き出しに失敗したため、MoviePyで書き出します: {e}')
+        return False
+    return True
+
+def dedup_stage(timeline, output_file, file_spans=None, frame_cache=None, jobs=1):
+    """重複したファイルを残す区間から除き、代表との対応表を保存する"""
+    from dedup import find_duplicates, drop_duplicates, save_dedup_map
+    with measure('dedup', byte_count=sum(info.size for info in timeline)):
+        # 事前フィルタで残した区間だけで比べる
+        groups = find_duplicates(timeline, frame_cache=frame_cache, jobs=max(jobs, 4), file_spans=file_spans)
+    map_path = save_dedup_map(output_file, timeline, groups)
+    skipped = sum(len(group['duplicates']) for group in groups)
+    if skipped:
+        print(f'重複: {skipped}ファイルを除外します（対応表: {map_path}）')
+    return drop_duplicates(timeline, file_spans, groups)
+
+def list_video_files(input_dir):
+    """入力ディレクトリから全ての動画ファイルを取得"""
     input_dir = Path(input_dir).resolve()
-    video_files = list(input_dir.glob('**/*.MP4'))
+    return sorted(input_dir.glob('**/*.MP4'))
+
+def merge_videos_with_timestamp(input_dir, output_path, refresh=False, cache=None, jobs=1, incremental=False,
+                                index_path=DEFAULT_INDEX_PATH, target_size=10 * 1024 * 1024, prefilter=False,
+                                token_budget=DEFAULT_TOKEN_BUDGET, proxy_engine='moviepy', font=None, dedup=False):
+    """Gemini用のプロキシ動画を作成し、(出力パス, タイムライン, 秒数の対応表) を返す
+
+    フレームレート・解像度・音声は target_size（バイト）と token_budget（入力トークン）から決める。
+    prefilter=True の場合は静止・不良な区間を除いてプロキシを作り、
+    プロキシ上の秒数を元のタイムラインに戻すための対応表を返す（それ以外は None）
+    dedup=True の場合は撮り直しなどの重複したファイルを除き、代表との対応を <出力>.dedup.json に保存する
+    proxy_engine='ffmpeg' の場合はフレームを Python に通さず ffmpeg だけで書き出す（使えなければ MoviePy）
+    """
+    from frame_cache import FrameCache
+    from prefilter import detect_spans, build_remap, remap_duration, PREFILTER_SETTINGS
+    with measure('discover') as counters:
+        video_files = list_video_files(input_dir)
+        # 合計ファイルサイズを計算
+        total_size = sum(os.path.getsize(f) for f in video_files)
+        counters['bytes'] = total_size
     if not video_files:
         print('動画ファイルが見つかりませんでした。')
         return None, None, None
-    video_files.sort()
-
-    # 合計ファイルサイズを計算
-    total_size = sum(os.path.getsize(f) for f in video_files)
 
-    # 動画クリップのリストを作成
-    video_clips = []
-    original_clips = []  # 圧縮前のクリップを保持
-    for video_path in video_files:
-        print(f'読み込み中: {video_path.name}')
-        try:
-            clip = VideoFileClip(str(video_path))
-            original_clips.append(clip)  # 元のクリップを保存
-            # clip = clip.resize(height=240)
-            video_clips.append(clip)
-        except Exception as e:
-            print(f'エラー: {video_path.name} の読み込みに失敗しました - {str(e)}')
-            continue
+    # 入力ファイルと圧縮設定からプロキシのキャッシュキーを作成
+    if cache is None:
+        cache = ProxyCache()
+    proxy_engine = resolve_proxy_engine(proxy_engine, font)
+    proxy_settings = dict(
+        target_size=target_size,
+        token_budget=token_budget,
+        codec='libx264',
+        preset='ultrafast',
+        overlay=TIMESTAMP_STYLE,
+        prefilter=PREFILTER_SETTINGS if prefilter else None,
+    )
+    if dedup:
+        # 既存のキャッシュキーを変えないよう、使う時だけ含める
+        from dedup import DEDUP_SETTINGS
+        proxy_settings['dedup'] = DEDUP_SETTINGS
+    # 書き出し方で秒数テキストの見た目が変わるので、実際に書き出したエンジンごとに別のキャッシュにする
+    moviepy_cache_key = proxy_cache_key(video_files, proxy_settings)
+    cache_key = moviepy_cache_key
+    if proxy_engine != 'moviepy':
+        cache_key = proxy_cache_key(video_files, dict(proxy_settings, proxy_engine=proxy_engine))
 
-    if not video_clips:
+    # メタデータインデックスからタイムラインを作成（デコーダは開かない）
+    with measure('probe'):
+        timeline = scan_media(video_files, index_path)
+    if not timeline:
         print('処理可能な動画がありませんでした。')
         return None, None, None
+    loaded_files = [Path(info.path) for info in timeline]
+    durations = [info.duration for info in timeline]
 
-    # 動画を連結
-    try:
-        original_final_clip = concatenate_videoclips(original_clips)  # 圧縮前の連結クリップ
-        if not refresh:
-            final_clip_with_text = VideoFileClip(output_path)
+    file_spans = None
+    remap = None
+    frame_cache = FrameCache(index_path=index_path)
+    if prefilter:
+        # 縮小したフレームで動き・露出・ピンぼけ・シーンの切り替わりを調べ、残す区間を決める
+        with measure('prefilter', byte_count=total_size):
+            file_spans = detect_spans(timeline, jobs=max(jobs, 4), frame_cache=frame_cache)
+    if dedup:
+        file_spans = dedup_stage(timeline, output_path, file_spans, frame_cache, jobs)
+    if file_spans is not None:
+        remap = build_remap(timeline, file_spans)
+        if remap:
+            durations = [sum(end - start for start, end in spans) for spans in file_spans]
+            print(f'事前フィルタ: {sum(info.duration for info in timeline):.1f}秒 -> {remap_duration(remap):.1f}秒')
         else:
-            final_clip = concatenate_videoclips(video_clips)
-            if FPS is None:
-                FPS = final_clip.fps
+            print('事前フィルタで全ての区間が除外されたため、全体を使用します')
+            file_spans = None
+            remap = None
+    total_duration = sum(durations)
 
-            target_size = 10 * 1024 * 1024
+    try:
+        if not refresh and cache.get(cache_key, output_path):
+            print(f'キャッシュ済みのプロキシ動画を使用します: {cache_key[:12]}')
+        else:
             print(f"{total_size} -> {target_size}")
-            target_bitrate = int((target_size * 8) / final_clip.duration)
-            target_bitrate_str = f"{target_bitrate//1000}k"
-            audio_bitrate = "32k"  # 音声ビットレートを低く設定
-
-            # 秒数テキストを追加
-            def make_text_clip(t):
-                return TextClip(
-                    f"{t:.0f}秒", fontsize=24, color='white', bg_color='rgba(0,0,0,0.7)'
-                ).set_position(("right", "top")).set_duration(1/FPS).set_start(t)
-
-            print(f"秒数テキストを追加")
-            text_clips = [make_text_clip(t/FPS) for t in range(0, int(final_clip.duration * FPS), 1)]
-            print(len(text_clips))
-            # デバッグ情報の出力
-            print(f"動画の長さ: {final_clip.duration}秒")
-            print(f"テキストクリップの数: {len(text_clips)}")
-            print(f"最後のテキストクリップの開始時間: {text_clips[-1].start if text_clips else 'なし'}")
-
-            # テキストクリップの時間が動画の長さを超えていないか確認
-            if text_clips and text_clips[-1].start + text_clips[-1].duration > final_clip.duration:
-                print("警告: テキストクリップが動画の長さを超えています")
-                # 超過分を削除
-                text_clips = [clip for clip in text_clips if clip.start + clip.duration <= final_clip.duration]
-
-            final_clip_with_text = CompositeVideoClip([final_clip] + text_clips)
-
-            # Gemini用の圧縮動画を書き出し
-            print('動画を書き出し中...')
-            final_clip_with_text.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                audio_bitrate=audio_bitrate,  # 音声ビットレートを指定
-                threads=4,
-                preset='ultrafast',
-                fps=FPS,
-                bitrate=target_bitrate_str
+            # 容量とトークンの上限に合わせてフレームレート・解像度・音声を決める
+            plan = plan_for_timeline(timeline, total_duration, target_size, token_budget)
+            audio_label = plan.audio_bitrate_str or 'なし'
+            print(f"プロキシ: {plan.height}p {plan.fps:g}fps 映像{plan.bitrate_str} 音声{audio_label} "
+                  f"（約{plan.tokens:,}トークン）")
+            if not plan.fits_token_budget:
+                print('トークンの上限を超えるため、--analysis-mode chunked の使用をおすすめします')
+            target_bitrate_str = plan.bitrate_str
+
+            encode_options = dict(
+                fps=plan.fps,
+                # JSON（マニフェスト）に保存しても同じ値になるようリストにする
+                size=list(proxy_size(timeline, plan.height)),
+                audio_bitrate=plan.audio_bitrate_str,
+                codec=proxy_settings['codec'],
+                preset=proxy_settings['preset'],
             )
+            encoded = False
+            if proxy_engine == 'ffmpeg':
+                with measure('proxy_encode', frames=int(total_duration * plan.fps)) as counters:
+                    encoded = encode_ffmpeg_proxy(
+                        timeline, output_path, plan, file_spans, font,
+                        proxy_settings['codec'], proxy_settings['preset']
+                    )
+                    if encoded:
+                        counters['bytes'] = os.path.getsize(output_path)
+            if not encoded:
+                # ffmpeg を使わない・使えなかった場合は MoviePy で書き出し、MoviePy の結果としてキャッシュする
+                cache_key = moviepy_cache_key
+                if incremental:
+                    # 書き出し済みのセグメントを再利用し、新規・変更分だけを書き出して連結
+                    with measure('proxy_encode', frames=int(total_duration * plan.fps)) as counters:
+                        segment_paths = update_proxy_segments(
+                            loaded_files, durations, segment_dir_for(output_path), jobs,
+                            target_size, plan, file_spans, **encode_options
+                        )
+                        concat_copy(segment_paths, output_path)
+                        counters['bytes'] = os.path.getsize(output_path)
+                elif jobs > 1:
+                    # ファイルごとに並列で書き出し、再エンコードせずに連結
+                    print(f'{jobs}プロセスで動画を書き出し中...')
+                    # 事前フィルタを使う場合はプロキシ上の秒数を表示
+                    offsets = [sum(durations[:i]) for i in range(len(durations))]
+                    spans = file_spans or [None] * len(loaded_files)
+                    with tempfile.TemporaryDirectory(dir=Path(output_path).parent) as segment_dir:
+                        tasks = [
+                            (video_path, Path(segment_dir) / f'segment_{i:05d}.mp4', offset, video_spans)
+                            for i, (video_path, offset, video_spans) in enumerate(zip(loaded_files, offsets, spans))
+                            if video_spans != []
+                        ]
+                        segment_paths = [segment_path for _, segment_path, _, _ in tasks]
+                        # ワーカーの中は計測できないので、プール全体の時間を記録する
+                        with measure('proxy_encode', frames=int(total_duration * plan.fps)) as counters:
+                            encode_proxy_segments(
+                                tasks,
+                                jobs,
+                                bitrate=target_bitrate_str,
+                                **encode_options
+                            )
+                            concat_copy(segment_paths, output_path)
+                            counters['bytes'] = os.path.getsize(output_path)
+                else:
+                    # 動画クリップを読み込んで連結
+                    from moviepy.editor import VideoFileClip, concatenate_videoclips
+                    from timestamp_overlay import build_glyph_atlas, add_timestamp_overlay
+                    video_clips = []
+                    with measure('clip_load'):
+                        for video_path in loaded_files:
+                            print(f'読み込み中: {video_path.name}')
+                            video_clips.append(VideoFileClip(str(video_path)))
+                    try:
+                        spans = file_spans or [None] * len(video_clips)
+                        final_clip = concatenate_videoclips([
+                            fit_proxy_size(kept_subclips(clip, clip_spans), encode_options['size'])
+                            for clip, clip_spans in zip(video_clips, spans) if clip_spans != []
+                        ])
+
+                        # 秒数テキストを追加（グリフアトラスから毎フレーム描画）
+                        print(f"秒数テキストを追加")
+                        with measure('overlay'):
+                            atlas = build_glyph_atlas(**TIMESTAMP_STYLE)
+                            final_clip_with_text = add_timestamp_overlay(final_clip, atlas)
+                        print(f"動画の長さ: {final_clip.duration}秒")
+
+                        # Gemini用の圧縮動画を書き出し
+                        print('動画を書き出し中...')
+                        with measure('proxy_encode', frames=int(total_duration * plan.fps)) as counters:
+                            final_clip_with_text.write_videofile(
+                                output_path,
+                                codec=proxy_settings['codec'],
+                                audio=plan.audio_bitrate is not None,
+                                audio_codec='aac',
+                                audio_bitrate=plan.audio_bitrate_str,  # 音声ビットレートを指定
+                                threads=4,
+                                preset=proxy_settings['preset'],
+                                fps=plan.fps,
+                                bitrate=target_bitrate_str
+                            )
+                            counters['bytes'] = os.path.getsize(output_path)
+                    finally:
+                        for clip in video_clips:
+                            clip.close()
+            cache.put(cache_key, output_path)
             print('動画の処理が完了しました。')
-        return output_path, final_clip_with_text, original_final_clip
+        return output_path, timeline, remap
     except Exception as e:
         print(f"エラーが発生しました: {e}")
         return None, None, None
 
-def create_highlight_video(video_clip, output_path, highlights):
-    clips = []
-    for highlight in highlights:
-        start = highlight.start_second
-        end = highlight.end_second
-        if start > video_clip.duration:
-            continue
-        if end > video_clip.duration:
-            end = video_clip.duration
-        clip = video_clip.subclip(start, end)
-        clips.append(clip)
+def highlight_output_path(output_path):
+    """出力パスを生成（元のファイル名から_highlightを付加）"""
+    return str(Path(output_path).with_suffix(".mp4").with_stem(Path(output_path).stem + "_highlight"))
+
+def find_narration_font(font=None):
+    """指定されたフォント、なければ候補の中で最初に見つかったフォント（ない場合は ImageMagick の既定）"""
+    if font:
+        return font
+    for candidate in NARRATION_FONT_CANDIDATES:
+        if Path(candidate).exists():
+            return candidate
+    print('ナレーション用のフォントが見つからないため、既定のフォントを使います（--font で指定できます）')
+    return None
+
+def highlight_segment_dir(output_path):
+    """ハイライトごとのセグメントの保存先（例: videos/tokyo_highlight.segments）"""
+    return Path(highlight_output_path(output_path)).with_suffix('.segments')
+
+def output_format(timeline):
+    """セグメントを無劣化で連結できるよう、全セグメントで揃える解像度・フレームレート・音声の有無"""
+    sizes = [(info.width, info.height) for info in timeline]
+    size = max(set(sizes), key=sizes.count)
+    # フレームレートが取得できなかったファイルは除いて決める
+    fps = max((info.fps for info in timeline if info.fps), default=DEFAULT_FPS)
+    return dict(size=size, fps=fps, audio=any(info.has_audio for info in timeline))
+
+def silent_audio(duration):
+    import numpy as np
+    from moviepy.editor import AudioClip
+    return AudioClip(
+        lambda t: np.zeros((len(t), 2)) if isinstance(t, np.ndarray) else [0, 0],
+        duration=duration, fps=44100
+    )
+
+def render_highlight_segment(pool, timeline, highlight, segment_path, size, fps, audio, burn_in=True, font=None,
+                             threads=None):
+    """ハイライト1つ分を書き出す（途中で止まっても壊れたファイルが残らないよう一時ファイル経由）"""
+    from moviepy.editor import TextClip, CompositeVideoClip, concatenate_videoclips
+    total_duration = timeline[-1].end
+    end = min(highlight.end_second, total_duration)
+    pieces = []
+    for info, piece_start, piece_end in split_on_timeline(timeline, highlight.start_second, end):
+        piece = pooled_subclip(pool, info, piece_start, piece_end)
+        # concatenate_videoclips は最初のクリップの大きさで書き出すので、ファイルごとに揃えてから連結する
+        if tuple(piece.size) != tuple(size):
+            piece = piece.resize(newsize=size)
+        if audio and piece.audio is None:
+            # 音声のないファイルは無音を入れて、連結時のストリーム構成を揃える
+            piece = piece.set_audio(silent_audio(piece.duration))
+        pieces.append(piece)
+    clip = pieces[0] if len(pieces) == 1 else concatenate_videoclips(pieces)
 
-    final_video = concatenate_videoclips(clips)
     text_clips = []
-    current_time = 0
+    cues = narration_cues([highlight], total_duration) if burn_in else []
+    for relative_start, relative_end, text in cues:
+        text_clip = TextClip(
+            text,
+            fontsize=24,
+            font=font,
+            color='white',
+            bg_color='rgba(0,0,0,0.5)',
+            size=(clip.w, None),
+            method='caption'
+        ).set_position(
+            ('center', 'bottom')
+        ).set_duration(
+            relative_end - relative_start
+        ).set_start(relative_start)
+        text_clips.append(text_clip)
+    if text_clips:
+        clip = CompositeVideoClip([clip] + text_clips)
+
+    tmp_path = Path(segment_path).with_suffix('.tmp.mp4')
+    with measure('render', frames=int(clip.duration * fps)) as counters:
+        clip.write_videofile(str(tmp_path), fps=fps, audio=audio, threads=threads, **SEGMENT_ENCODE_OPTIONS)
+        counters['bytes'] = os.path.getsize(tmp_path)
+    os.replace(tmp_path, segment_path)
+    return segment_path
+
+def render_segment_job(timeline, highlight, segment_path, size, fps, audio, burn_in, font, max_open, threads):
+    """プロセスプールで実行する1セグメント分の書き出し（デコーダはワーカーごとに開く）"""
+    pool = DecoderPool(max_open)
+    try:
+        return render_highlight_segment(
+            pool, timeline, highlight, segment_path, size, fps, audio, burn_in, font, threads
+        )
+    finally:
+        pool.close()
+
+def render_segments_in_pool(timeline, jobs, state, settings, burn_in, font, max_open, render_jobs):
+    """セグメントをプロセスプールで並列に書き出し、終わったものから実行状態に記録する
+
+    失敗したセグメントがあっても書き終わったものは全て記録し、最初の失敗を送出する
+    jobs は (フィンガープリント, ハイライト, セグメントのパス) のリスト
+    """
+    from tqdm import tqdm
+    workers = min(render_jobs, len(jobs))
+    # エンコーダのスレッドをワーカー間で分け合う
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    frames = sum(int((min(h.end_second, timeline[-1].end) - h.start_second) * settings['fps']) for _, h, _ in jobs)
+    # ワーカーの中は計測できないので、プール全体の時間を記録する
+    with measure('render', frames=frames) as counters:
+        # 解析やデコーダのスレッドが残っていても安全なように fork ではなく spawn で起動
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {
+                executor.submit(
+                    render_segment_job, timeline, highlight, segment_path, settings['size'], settings['fps'],
+                    settings['audio'], burn_in, font, max_open, threads
+                ): (fingerprint, segment_path)
+                for fingerprint, highlight, segment_path in jobs
+            }
+            first_error = None
+            for future in tqdm(as_completed(futures), total=len(futures), desc='ハイライト書き出し'):
+                try:
+                    future.result()
+                except Exception as e:
+                    # 失敗しても他のセグメントは書き終わるまで待ち、再実行時に使えるよう記録してから伝える
+                    first_error = first_error or e
+                    continue
+                fingerprint, segment_path = futures[future]
+                state.add_segment(fingerprint, segment_path)
+                counters['bytes'] += os.path.getsize(segment_path)
+            if first_error is not None:
+                raise first_error
+
+def render_highlight_segments(timeline, output_path, highlights, max_open=DEFAULT_MAX_OPEN, burn_in=True,
+                              font=None, state=None, render_jobs=1):
+    """ハイライトごとにセグメントを書き出す（書き出し済みで内容が同じものは再利用）
+
+    render_jobs が2以上なら、ハイライトごとの書き出しをプロセスプールで並列に行う
+    """
+    state = state or PipelineState(output_path)
+    segment_dir = highlight_segment_dir(output_path)
+    segment_dir.mkdir(parents=True, exist_ok=True)
+    total_duration = timeline[-1].end
+    settings = dict(output_format(timeline), burn_in=burn_in, font=font, encode=SEGMENT_ENCODE_OPTIONS)
+    sources = timeline_sources(timeline)
+
+    fingerprints = []
+    segment_paths = []
+    jobs = []
     for highlight in highlights:
-        if highlight.start_second > video_clip.duration:
+        if not split_on_timeline(timeline, highlight.start_second, min(highlight.end_second, total_duration)):
+            # 動画の範囲外や長さ 0 の区間は書き出すものがない
             continue
-        end = min(highlight.end_second, video_clip.duration)
-        clip_duration = end - highlight.start_second
-
-        for narration in highlight.narration:
-            # ナレーションの相対時間を計算
-            relative_start = current_time + (narration.start_second - highlight.start_second)
-            relative_end = relative_start + (narration.end_second - narration.start_second)
-            text_clip = TextClip(
-                narration.narration,
-                fontsize=24,
-                font='/System/Library/Fonts/ヒラギノ角ゴシック W5.ttc',
-                color='white',
-                bg_color='rgba(0,0,0,0.5)',
-                size=(final_video.w, None),
-                method='caption'
-            ).set_position(
-                ('center', 'bottom')
-            ).set_duration(
-                relative_end - relative_start
-            ).set_start(relative_start)
-            text_clips.append(text_clip)
-        current_time += clip_duration
-
-    final_video = CompositeVideoClip([final_video] + text_clips)
-    # 出力パスを生成（元のファイル名から_highlightを付加）
-    output_path = str(Path(output_path).with_suffix(".mp4").with_stem(Path(output_path).stem + "_highlight"))
-    minutes = int(final_video.duration // 60)
-    seconds = int(final_video.duration % 60)
-    print(f"ハイライト動画の長さ: {minutes:02d}:{seconds:02d}")
-    final_video.write_videofile(output_path)
-    # メモリリーク防止のためにクリップを閉じる
-    for clip in clips:
-        clip.close()
-    return output_path
+        fingerprint = stage_fingerprint(sources, highlight.model_dump(), settings)
+        segment_path = state.segment(fingerprint)
+        if segment_path is None:
+            segment_path = segment_dir / f'highlight_{fingerprint[:16]}.mp4'
+            jobs.append((fingerprint, highlight, segment_path))
+        fingerprints.append(fingerprint)
+        segment_paths.append(segment_path)
+    print(f'ハイライトのセグメント: 再利用 {len(segment_paths) - len(jobs)} / 新規書き出し {len(jobs)}')
+
+    if render_jobs > 1 and len(jobs) > 1:
+        render_segments_in_pool(timeline, jobs, state, settings, burn_in, font, max_open, render_jobs)
+    else:
+        # ハイライトの秒数を元動画ファイルとファイル内の秒数に対応付け、
+        # 必要なファイルのデコーダだけをプールから開く
+        pool = DecoderPool(max_open)
+        try:
+            for fingerprint, highlight, segment_path in jobs:
+                render_highlight_segment(
+                    pool, timeline, highlight, segment_path,
+                    settings['size'], settings['fps'], settings['audio'], burn_in, font
+                )
+                state.add_segment(fingerprint, segment_path)
+        finally:
+            # メモリリーク防止のためにデコーダを閉じる
+            pool.close()
+    state.prune_segments(keep=set(fingerprints))
+    return segment_paths, fingerprints
+
+def create_highlight_video(timeline, output_path, highlights, max_open=DEFAULT_MAX_OPEN, burn_in=True, font=None,
+                           render_jobs=1):
+    segment_paths, _ = render_highlight_segments(
+        timeline, output_path, highlights, max_open, burn_in, font, render_jobs=render_jobs
+    )
+    return concat_copy(segment_paths, highlight_output_path(output_path))
 
-class Narration(BaseModel):
-    narration: str = Field(..., description="ナレーション")
-    start_second: float = Field(..., description="開始秒数")
-    end_second: float = Field(..., description="終了秒数")
+def remap_path(output_file):
+    """事前フィルタの結果（秒数の対応表と残す区間）の保存先"""
+    return Path(output_file).with_suffix('.remap.json')
 
-class VideoHighlight(BaseModel):
-    start_second: float = Field(..., description="開始秒数")
-    end_second: float = Field(..., description="終了秒数")
-    narration: list[Narration] = Field(..., description="複数のナレーション")
+def save_remap(output_file, remap, file_spans):
+    with open(remap_path(output_file), 'w', encoding='utf-8') as f:
+        json.dump({'remap': remap, 'file_spans': file_spans}, f)
 
-class VideoHighlights(BaseModel):
-    highlights: list[VideoHighlight] = Field(..., description="5~10秒のハイライトのリスト")
+def load_remap(output_file):
+    path = remap_path(output_file)
+    if not path.exists():
+        return None, None
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    remap = [tuple(entry) for entry in data['remap']] if data['remap'] else None
+    return remap, data['file_spans']
 
-def main(input_directory, output_file, target_minutes=None, highlight_ratio=0.3, refresh=False):
+def load_highlights(output_file):
+    """保存済みのハイライト情報（JSON）を読み込む"""
+    from highlight_models import VideoHighlights
+    with open(Path(output_file).with_suffix('.json'), 'r', encoding='utf-8') as f:
+        return VideoHighlights.model_validate(json.load(f))
+
+def probe_stage(input_directory, index_path=DEFAULT_INDEX_PATH):
+    """入力ディレクトリの動画をメタデータインデックスに登録し、タイムラインを返す"""
+    with measure('discover'):
+        video_files = list_video_files(input_directory)
+    if not video_files:
+        return []
+    with measure('probe'):
+        return scan_media(video_files, index_path)
+
+def proxy_stage(input_directory, output_file, refresh=False, cache_dir=DEFAULT_CACHE_DIR, cache_max_gb=5,
+                jobs=1, incremental=False, index_path=DEFAULT_INDEX_PATH, proxy_size_mb=10, prefilter=False,
+                analysis_input='video', analysis_mode='single', token_budget=DEFAULT_TOKEN_BUDGET,
+                proxy_engine='moviepy', font=None, dedup=False):
+    """Geminiに送るプロキシ動画を作成し、(タイムライン, 秒数の対応表, 残す区間) を返す（失敗時は None）"""
+    from frame_cache import FrameCache
+    from prefilter import detect_spans
+    file_spans = None
+    remap = None
+    if analysis_input == 'contact-sheet':
+        # コンタクトシートは元動画から直接作るので、プロキシは書き出さない
+        timeline = probe_stage(input_directory, index_path)
+        if not timeline:
+            print('処理可能な動画がありませんでした。')
+            return None
+        frame_cache = FrameCache(index_path=index_path)
+        if prefilter:
+            file_spans = detect_spans(timeline, jobs=max(jobs, 4), frame_cache=frame_cache)
+        if dedup:
+            file_spans = dedup_stage(timeline, output_file, file_spans, frame_cache, jobs)
+    else:
+        cache = ProxyCache(cache_dir, max_bytes=int(cache_max_gb * 1024 * 1024 * 1024))
+        merged_path, timeline, remap = merge_videos_with_timestamp(
+            input_directory, str(output_file), refresh, cache, jobs, incremental, index_path,
+            int(proxy_size_mb * 1024 * 1024), prefilter,
+            # chunked では区間ごとに送るので、全体のトークン数は制限しない
+            token_budget if analysis_mode == 'single' else None,
+            proxy_engine, font, dedup
+        )
+        if merged_path is None:
+            return None
+    save_remap(output_file, remap, file_spans)
+    return timeline, remap, file_spans
+
+async def analysis_stage_async(timeline, output_file, client, remap=None, file_spans=None, target_minutes=None,
+                               highlight_ratio=0.3, jobs=1, upload='inline',
+                               analysis_cache_dir=DEFAULT_ANALYSIS_CACHE_DIR, refresh_analysis=False,
+                               analysis_mode='single', analysis_input='video',
+                               window_minutes=DEFAULT_WINDOW_SECONDS / 60, window_overlap=DEFAULT_OVERLAP_SECONDS,
+                               index_path=DEFAULT_INDEX_PATH, audio_score=False, max_windows=None):
+    """Geminiでハイライトを抽出し、元のタイムラインの秒数でJSONに保存する"""
+    # 解析の依存（litellm・NumPy・Pillow）は解析を行う時だけ読み込む
+    from contact_sheet import analyze_contact_sheets_async
+    from frame_cache import FrameCache
+    from chunked_analysis import analyze_in_windows_async
+    from highlight_analysis import load_prompt, analyze_video_async
+    from highlight_models import VideoHighlights
+    from prefilter import remap_duration, remap_highlights
     output_path = Path(output_file)
-    merged_video_path = output_path
-    json_path = output_path.with_suffix('.json')
 
-    merged_path, preview_clip, original_clip = merge_videos_with_timestamp(input_directory, str(merged_video_path), refresh)
-    if merged_path is None:
-        return
+    # 動画の長さを取得（メタデータインデックスの値を使用）
+    duration_minutes = int(sum(info.duration for info in timeline)) // 60
+    if target_minutes:
+        target_duration = min(target_minutes, duration_minutes)
+    else:
+        target_duration = int(duration_minutes * highlight_ratio)
+
+    # プロンプトの読み込みと動的な値の設定
+    duration_seconds = int(duration_minutes * 60)
+    target_duration_seconds = int(target_duration * 60)
+    proxy_duration = sum(info.duration for info in timeline)
+    if remap:
+        # モデルに渡すのは事前フィルタ後のプロキシなので、その長さを使う
+        proxy_duration = remap_duration(remap)
+        duration_seconds = int(proxy_duration)
+        target_duration_seconds = min(target_duration_seconds, duration_seconds)
+    print(f"{duration_seconds} -> {target_duration_seconds}")
+    prompt = load_prompt(duration_seconds, target_duration_seconds)
+
+    analysis_cache = AnalysisCache(analysis_cache_dir)
+    if analysis_input == 'contact-sheet':
+        # シーンごとの代表フレームを並べた画像だけを送る（秒数は元のタイムラインのまま）
+        highlights = await analyze_contact_sheets_async(
+            timeline, prompt, analysis_cache, client, output_path.with_suffix('.sheets'), file_spans,
+            max(jobs, 4), refresh_analysis, frame_cache=FrameCache(index_path=index_path)
+        )
+    elif analysis_mode == 'chunked':
+        # 重なりのある区間に分けて並列に解析し、結果を全体の秒数でまとめる
+        track = None
+        if audio_score or max_windows:
+            # 元動画の音声から1秒ごとのスコアを作り（インデックスに保存）、プロキシの秒数に並べ直す
+            from audio_score import timeline_audio_track, proxy_track
+            track = await asyncio.to_thread(timeline_audio_track, timeline, index_path, max(jobs, 4))
+            track = proxy_track(track, remap, proxy_duration)
+        highlights = await analyze_in_windows_async(
+            output_path, proxy_duration, target_duration_seconds, analysis_cache, client, upload,
+            window_minutes * 60, window_overlap, refresh_analysis, track=track, max_windows=max_windows
+        )
+    else:
+        highlights = await analyze_video_async(output_path, prompt, analysis_cache, client, upload, refresh_analysis)
+    if remap:
+        # プロキシ上の秒数を元のタイムラインの秒数に戻す
+        highlights = VideoHighlights(highlights=remap_highlights(highlights.highlights, remap))
+    # ハイライトをJSONファイルとして保存
+    output_json_path = output_path.with_suffix('.json')
+    with open(output_json_path, 'w', encoding='utf-8') as f:
+            json.dump(highlights.model_dump(), f, ensure_ascii=False, indent=2)
+    print(f"ハイライト情報をJSONに保存しました: {output_json_path}")
+    print(highlights.highlights)
+    return highlights
+
+def analysis_stage(timeline, output_file, remap=None, file_spans=None, analysis_jobs=4,
+                   requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                   max_retries=DEFAULT_MAX_RETRIES, **options):
+    client = ModelClient(
+        MODEL, concurrency=analysis_jobs, requests_per_minute=requests_per_minute,
+        timeout=request_timeout, max_retries=max_retries
+    )
+    with measure('analysis'):
+        return asyncio.run(analysis_stage_async(timeline, output_file, client, remap, file_spans, **options))
+
+def render_stage(timeline, output_file, highlights, render_mode='moviepy', subtitles='burn',
+                 max_open_decoders=DEFAULT_MAX_OPEN, font=None, render_jobs=1):
+    """ハイライトをセグメントごとに書き出し（render）、連結して字幕を追加する（mux）
+
+    どちらのステージも成果物を記録し、再実行時は書き出し済みの部分を飛ばす
+    """
+    state = PipelineState(output_file)
+    burn_in = subtitles == 'burn'
+    highlight_video = highlight_output_path(output_file)
+    sources = timeline_sources(timeline)
+    segment_paths = None
+    if render_mode == 'smart':
+        # キーフレーム間をストリームコピーする高速モード（ナレーションは焼き込まない）
+        if burn_in:
+            print('高速モードではナレーションを焼き込みません（--subtitles で字幕として出力できます）')
+        fingerprints = [stage_fingerprint(sources, highlights.model_dump(), 'smart')]
+        smart_path = state.segment(fingerprints[0])
+        if smart_path is None:
+            segment_dir = highlight_segment_dir(output_file)
+            segment_dir.mkdir(parents=True, exist_ok=True)
+            with measure('render'):
+                smart_path = create_smart_highlight_video(
+                    timeline, segment_dir / f'smart_{fingerprints[0][:16]}.mp4', highlights.highlights
+                )
+            if smart_path is not None:
+                state.add_segment(fingerprints[0], smart_path)
+        if smart_path is not None:
+            segment_paths = [smart_path]
+    if segment_paths is None:
+        font = find_narration_font(font) if burn_in else None
+        segment_paths, fingerprints = render_highlight_segments(
+            timeline, output_file, highlights.highlights, max_open_decoders, burn_in, font, state, render_jobs
+        )
+    if not segment_paths:
+        print('ハイライトの区間がありませんでした。')
+        return None
+    render_fingerprint = stage_fingerprint(fingerprints)
+    state.complete('render', render_fingerprint, segment_paths)
+
+    mux_fingerprint = stage_fingerprint(render_fingerprint, subtitles)
+    if state.is_complete('mux', mux_fingerprint):
+        print(f"ハイライト動画は作成済みです: {highlight_video}")
+        return highlight_video
+    artifacts = [highlight_video]
+    with measure('mux') as counters:
+        # セグメントは同じ形式で書き出しているので、再エンコードせずに連結できる
+        concat_copy(segment_paths, highlight_video)
+        cues = narration_cues(highlights.highlights, timeline[-1].end) if not burn_in else []
+        if cues:
+            # ナレーションを字幕ファイルとして書き出し、ソフトサブとして動画に追加（空の字幕は ffmpeg が読めない）
+            subtitle_path = write_subtitles(cues, Path(highlight_video).with_suffix(f'.{subtitles}'))
+            mux_subtitles(highlight_video, subtitle_path)
+            artifacts.append(subtitle_path)
+            print(f"字幕を保存しました: {subtitle_path}")
+        counters['bytes'] = os.path.getsize(highlight_video)
+    state.complete('mux', mux_fingerprint, artifacts)
+    duration = sum(
+        min(h.end_second, timeline[-1].end) - h.start_second
+        for h in highlights.highlights if h.start_second <= timeline[-1].end
+    )
+    print(f"ハイライト動画の長さ: {int(duration // 60):02d}:{int(duration % 60):02d}")
+    print(f"ハイライト動画を保存しました: {highlight_video}")
+    return highlight_video
 
+def prompt_sources():
+    """プロンプトのテンプレートを変えたら解析をやり直す"""
+    return {str(path): path.read_text(encoding='utf-8') for path in sorted(Path(PROMPT_PATH).parent.glob('*.md'))}
+
+def main(input_directory, output_file, target_minutes=None, highlight_ratio=0.3, refresh=False,
+         cache_dir=DEFAULT_CACHE_DIR, cache_max_gb=5, jobs=1, incremental=False,
+         index_path=DEFAULT_INDEX_PATH, max_open_decoders=DEFAULT_MAX_OPEN, render_mode='moviepy',
+         subtitles='burn', upload='inline', proxy_size_mb=10,
+         analysis_cache_dir=DEFAULT_ANALYSIS_CACHE_DIR, refresh_analysis=False,
+         analysis_mode='single', window_minutes=DEFAULT_WINDOW_SECONDS / 60,
+         window_overlap=DEFAULT_OVERLAP_SECONDS, analysis_jobs=4,
+         requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, request_timeout=DEFAULT_REQUEST_TIMEOUT,
+         max_retries=DEFAULT_MAX_RETRIES, prefilter=False, analysis_input='video',
+         token_budget=DEFAULT_TOKEN_BUDGET, font=None, profile=(), prometheus_textfile=None, render_jobs=1,
+         proxy_engine='moviepy', dedup=False, audio_score=False, max_windows=None):
+    # ステージごとの時間・メモリ・処理量を記録し、実行ごとにレポートを書き出す
+    recorder = start_run(profile)
     try:
-        # 動画の長さを取得
-        duration_minutes = int(preview_clip.duration) // 60
-        if target_minutes:
-            target_duration = min(target_minutes, duration_minutes)
+        state = PipelineState(output_file)
+        timeline = probe_stage(input_directory, index_path)
+        if not timeline:
+            print('処理可能な動画がありませんでした。')
+            return
+
+        # proxy: 元動画とプロキシの設定が同じで、プロキシと対応表が残っていれば作り直さない
+        if analysis_input == 'video':
+            # 指紋は実際に書き出すエンジンで作る（ffmpeg が使えなければ MoviePy の結果と同じ）
+            proxy_engine = resolve_proxy_engine(proxy_engine, font)
+        proxy_fingerprint = stage_fingerprint(timeline_sources(timeline), dict(
+            proxy_size_mb=proxy_size_mb, prefilter=prefilter, analysis_input=analysis_input,
+            analysis_mode=analysis_mode, token_budget=token_budget, dedup=dedup, proxy_engine=proxy_engine
+        ))
+        if refresh:
+            state.invalidate('proxy')
+        if state.is_complete('proxy', proxy_fingerprint):
+            print('プロキシ動画は作成済みのため再利用します')
+            remap, file_spans = load_remap(output_file)
         else:
-            target_duration = int(duration_minutes * highlight_ratio)
-
-        # プロンプトの読み込みと動的な値の設定
-        duration_seconds = int(duration_minutes * 60)
-        target_duration_seconds = int(target_duration * 60)
-        print(f"{duration_seconds} -> {target_duration_seconds}")
-        with open("prompts/prompt.md", "r") as f:
-            prompt = f.read()
-            prompt = prompt.format(
-                duration=duration_seconds,
-                target_duration=target_duration_seconds
+            result = proxy_stage(
+                input_directory, output_file, refresh, cache_dir, cache_max_gb, jobs, incremental, index_path,
+                proxy_size_mb, prefilter, analysis_input, analysis_mode, token_budget, proxy_engine, font, dedup
             )
+            if result is None:
+                return
+            timeline, remap, file_spans = result
+            artifacts = [remap_path(output_file)]
+            if analysis_input == 'video':
+                artifacts.append(output_file)
+            if dedup:
+                from dedup import dedup_map_path
+                artifacts.append(dedup_map_path(output_file))
+            state.complete('proxy', proxy_fingerprint, artifacts)
 
-        # Geminiで動画解析（圧縮・秒数入れ後の動画を使用）
-        print(f"Geminiで動画解析")
-        video_bytes = Path(output_path).read_bytes()
-        encoded_data = base64.b64encode(video_bytes).decode("utf-8")
-        response = completion(
-            model="gemini/gemini-2.0-flash-exp",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": "data:video/mp4;base64,{}".format(encoded_data),
-                        },
-                    ],
-                }
-            ],
-            response_format=VideoHighlights,
+        # analysis: 保存済みのハイライト情報（JSON）が読めれば再解析しない
+        analysis_options = dict(
+            target_minutes=target_minutes, highlight_ratio=highlight_ratio,
+            analysis_mode=analysis_mode, analysis_input=analysis_input,
+            window_minutes=window_minutes, window_overlap=window_overlap,
+            audio_score=audio_score, max_windows=max_windows
+        )
+        analysis_fingerprint = stage_fingerprint(proxy_fingerprint, MODEL, prompt_sources(), analysis_options)
+        if refresh_analysis:
+            state.invalidate('analysis')
+        highlights = None
+        if state.is_complete('analysis', analysis_fingerprint):
+            try:
+                highlights = load_highlights(output_file)
+                print('ハイライト情報は作成済みのため再利用します')
+            except (OSError, ValueError) as e:
+                print(f'保存済みのハイライト情報を読み込めませんでした（再解析します）: {e}')
+        if highlights is None:
+            highlights = analysis_stage(
+                timeline, output_file, remap, file_spans, analysis_jobs,
+                requests_per_minute, request_timeout, max_retries,
+                upload=upload, jobs=jobs, analysis_cache_dir=analysis_cache_dir,
+                refresh_analysis=refresh_analysis, index_path=index_path, **analysis_options
+            )
+            state.complete('analysis', analysis_fingerprint, [Path(output_file).with_suffix('.json')])
+
+        # render / mux: ハイライトごとのセグメントと連結後の動画を再利用する
+        render_stage(
+            timeline, output_file, highlights, render_mode, subtitles, max_open_decoders, font, render_jobs
         )
-        # ハイライト動画の作成（圧縮前の元動画を使用）
-        highlights = VideoHighlights.model_validate(json.loads(response.choices[0].message.content))
-        # ハイライトをJSONファイルとして保存
-        output_json_path = Path(output_file).with_suffix('.json')
-        with open(output_json_path, 'w', encoding='utf-8') as f:
-                json.dump(highlights.model_dump(), f, ensure_ascii=False, indent=2)
-        print(f"ハイライト情報をJSONに保存しました: {output_json_path}")
-        print(highlights.highlights)
-        highlight_video = create_highlight_video(original_clip, output_file, highlights.highlights)
-        print(f"ハイライト動画を保存しました: {highlight_video}")
     finally:
-        # 最後にクリップをクローズ
-        if preview_clip:
-            preview_clip.close()
-        if original_clip:
-            original_clip.close()
+        report = recorder.report()
+        report_path = write_json_report(report, Path(output_file).with_suffix('.metrics.json'))
+        print(f"計測結果を保存しました: {report_path}")
+        if prometheus_textfile:
+            write_prometheus_report(report, prometheus_textfile, labels=dict(output=Path(output_file).stem))
+        for profile_path in recorder.dump_profiles(Path(output_file).with_suffix('')):
+            print(f"プロファイルを保存しました: {profile_path}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='動画のハイライト作成')
@@ -246,14 +938,172 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         '--refresh', '-f', action='store_true',
-        help='ハイライトを再生成するかどうか'
+        help='キャッシュを使わずにプロキシ動画を再生成するかどうか'
+    )
+    parser.add_argument(
+        '--cache-dir', default=DEFAULT_CACHE_DIR,
+        help=f'プロキシ動画のキャッシュディレクトリ（デフォルト: {DEFAULT_CACHE_DIR}）'
+    )
+    parser.add_argument(
+        '--cache-max-gb', type=float, default=5,
+        help='プロキシ動画キャッシュの容量上限（GB、デフォルト: 5）'
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='並列処理のプロセス数（2以上でファイルごとにプロキシを並列書き出し）'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='ファイルごとのセグメントを保存し、新規・変更されたファイルだけを書き出す'
+    )
+    parser.add_argument(
+        '--proxy-engine', choices=['moviepy', 'ffmpeg'], default='moviepy',
+        help='プロキシ動画の書き出し方法（ffmpeg: 連結・縮小・秒数表示を1つのフィルタグラフで処理。'
+             'drawtext が使えない場合は moviepy）'
+    )
+    parser.add_argument(
+        '--index-path', default=DEFAULT_INDEX_PATH,
+        help=f'動画メタデータのインデックス（デフォルト: {DEFAULT_INDEX_PATH}）'
+    )
+    parser.add_argument(
+        '--max-open-decoders', type=int, default=DEFAULT_MAX_OPEN,
+        help=f'ハイライト作成時に同時に開く元動画の上限（デフォルト: {DEFAULT_MAX_OPEN}）'
+    )
+    parser.add_argument(
+        '--render-mode', choices=['moviepy', 'smart'], default='moviepy',
+        help='ハイライト動画の作成方法（smart: キーフレーム間をストリームコピーする高速モード）'
+    )
+    parser.add_argument(
+        '--render-jobs', type=int, default=1,
+        help='ハイライト動画の書き出しのプロセス数（2以上でハイライトごとに並列に書き出して無劣化で連結）'
+    )
+    parser.add_argument(
+        '--subtitles', choices=['burn', *SUBTITLE_FORMATS], default='burn',
+        help='ナレーションの出力方法（burn: 映像に焼き込み、srt/vtt/ass: 字幕ファイルとソフトサブ）'
+    )
+    parser.add_argument(
+        '--font',
+        help='焼き込むナレーションのフォント（デフォルト: ヒラギノ角ゴシック・Noto Sans CJK などから自動で選択）'
+    )
+    parser.add_argument(
+        '--upload', choices=['inline', 'files'], default='inline',
+        help='動画の渡し方（inline: base64でリクエストに埋め込み、files: Files APIでアップロード）'
+    )
+    parser.add_argument(
+        '--proxy-size-mb', type=float, default=10,
+        help='Gemini用の圧縮動画の目標サイズ（MB、デフォルト: 10）'
+    )
+    parser.add_argument(
+        '--analysis-cache-dir', default=DEFAULT_ANALYSIS_CACHE_DIR,
+        help=f'解析結果のキャッシュディレクトリ（デフォルト: {DEFAULT_ANALYSIS_CACHE_DIR}）'
+    )
+    parser.add_argument(
+        '--refresh-analysis', action='store_true',
+        help='キャッシュを使わずにGeminiで再解析するかどうか'
+    )
+    parser.add_argument(
+        '--analysis-mode', choices=['single', 'chunked'], default='single',
+        help='解析方法（chunked: 重なりのある区間に分けて並列に解析）'
+    )
+    parser.add_argument(
+        '--window-minutes', type=float, default=DEFAULT_WINDOW_SECONDS / 60,
+        help=f'chunked で1回の解析に渡す区間の長さ（分、デフォルト: {DEFAULT_WINDOW_SECONDS // 60}）'
+    )
+    parser.add_argument(
+        '--window-overlap', type=float, default=DEFAULT_OVERLAP_SECONDS,
+        help=f'chunked で隣り合う区間の重なり（秒、デフォルト: {DEFAULT_OVERLAP_SECONDS}）'
+    )
+    parser.add_argument(
+        '--analysis-jobs', type=int, default=4,
+        help='chunked で同時に解析する区間の数（デフォルト: 4）'
+    )
+    parser.add_argument(
+        '--audio-score', action='store_true',
+        help='chunked で元動画の音量・音の立ち上がりから1秒ごとのスコアを作り、同じ条件のハイライトの選定に使う'
+    )
+    parser.add_argument(
+        '--max-windows', type=int,
+        help='chunked で音声のスコアが高い区間をこの数だけGeminiに送る（--audio-score も有効になる）'
+    )
+    parser.add_argument(
+        '--requests-per-minute', type=float, default=DEFAULT_REQUESTS_PER_MINUTE,
+        help=f'Geminiへの1分あたりの最大リクエスト数（デフォルト: {DEFAULT_REQUESTS_PER_MINUTE}）'
+    )
+    parser.add_argument(
+        '--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+        help=f'解析リクエスト1回あたりのタイムアウト（秒、デフォルト: {DEFAULT_REQUEST_TIMEOUT}）'
+    )
+    parser.add_argument(
+        '--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+        help=f'レート制限・タイムアウト・サーバーエラー時の再試行回数（デフォルト: {DEFAULT_MAX_RETRIES}）'
+    )
+    parser.add_argument(
+        '--token-budget', type=int, default=DEFAULT_TOKEN_BUDGET,
+        help=f'プロキシ動画の入力トークン数の上限（超える場合は音声を省く、デフォルト: {DEFAULT_TOKEN_BUDGET:,}）'
+    )
+    parser.add_argument(
+        '--analysis-input', choices=['video', 'contact-sheet'], default='video',
+        help='Geminiに送る内容（contact-sheet: シーンごとの代表フレームを並べた画像。プロキシ動画は作らない）'
+    )
+    parser.add_argument(
+        '--profile', action='append', choices=METRIC_STAGES, default=[],
+        help='cProfile で計測するステージ（複数指定可、結果は <出力ファイル名>.<ステージ>.prof）'
+    )
+    parser.add_argument(
+        '--prometheus-textfile',
+        help='計測結果を Prometheus の textfile collector 形式でも書き出すパス（例: /var/lib/node_exporter/video_highlight.prom）'
+    )
+    parser.add_argument(
+        '--prefilter', action='store_true',
+        help='静止・露出不良・ピンぼけの区間を除いてからGeminiに送るかどうか'
+    )
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='撮り直しなどの重複したファイルを最も画質の良い1本にまとめてからGeminiに送るかどうか'
+             '（対応表は <出力ファイル名>.dedup.json）'
     )
 
     args = parser.parse_args()
+    try:
+        check_windows(args.window_minutes * 60, args.window_overlap)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.max_windows is not None and args.max_windows < 1:
+        parser.error('--max-windows は1以上を指定してください')
     main(
         input_directory=args.input_dir,
         output_file=args.output_file,
         target_minutes=args.target_minutes,
         highlight_ratio=args.highlight_ratio,
-        refresh=args.refresh
+        refresh=args.refresh,
+        cache_dir=args.cache_dir,
+        cache_max_gb=args.cache_max_gb,
+        jobs=args.jobs,
+        incremental=args.incremental,
+        index_path=args.index_path,
+        max_open_decoders=args.max_open_decoders,
+        render_mode=args.render_mode,
+        subtitles=args.subtitles,
+        upload=args.upload,
+        proxy_size_mb=args.proxy_size_mb,
+        analysis_cache_dir=args.analysis_cache_dir,
+        refresh_analysis=args.refresh_analysis,
+        analysis_mode=args.analysis_mode,
+        window_minutes=args.window_minutes,
+        window_overlap=args.window_overlap,
+        analysis_jobs=args.analysis_jobs,
+        requests_per_minute=args.requests_per_minute,
+        request_timeout=args.request_timeout,
+        max_retries=args.max_retries,
+        prefilter=args.prefilter,
+        analysis_input=args.analysis_input,
+        token_budget=args.token_budget,
+        font=args.font,
+        profile=args.profile,
+        proxy_engine=args.proxy_engine,
+        dedup=args.dedup,
+        audio_score=args.audio_score,
+        max_windows=args.max_windows,
+        prometheus_textfile=args.prometheus_textfile,
+        render_jobs=args.render_jobs
     )
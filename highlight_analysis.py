@@ -0,0 +1,54 @@
+import asyncio
+import base64
+from pathlib import Path
+from analysis_cache import analysis_cache_key, file_sha256
+from file_upload import upload_file
+from highlight_models import VideoHighlights, SCHEMA_VERSION
+from instrumentation import measure
+from model_client import ModelClient
+
+# 解析に使うモデル
+MODEL = "gemini/gemini-2.0-flash-exp"
+PROMPT_PATH = "prompts/prompt.md"
+
+
+def load_prompt(duration, target_duration, path=PROMPT_PATH):
+    """プロンプトの読み込みと動的な値の設定"""
+    with open(path, "r") as f:
+        return f.read().format(duration=duration, target_duration=target_duration)
+
+
+def video_part(video_path, upload='inline'):
+    """リクエストに含める動画（base64埋め込み、またはアップロード済みファイルのURI）"""
+    size = Path(video_path).stat().st_size
+    if upload == 'files':
+        # ディスクからチャンクごとにアップロードし、リクエストではファイルのURIだけを参照
+        with measure('upload', byte_count=size):
+            file_info = upload_file(video_path, 'video/mp4')
+        print(f"動画をアップロードしました: {file_info['uri']}")
+        return {"url": file_info['uri'], "format": "video/mp4"}
+    with measure('media_encode', byte_count=size):
+        video_bytes = Path(video_path).read_bytes()
+        encoded_data = base64.b64encode(video_bytes).decode("utf-8")
+    return "data:video/mp4;base64,{}".format(encoded_data)
+
+
+async def analyze_video_async(video_path, prompt, cache, client, upload='inline', refresh=False):
+    """動画を解析（同じ動画・プロンプト・モデルの結果があれば再利用）"""
+    content_hash = await asyncio.to_thread(file_sha256, video_path)
+    key = analysis_cache_key(content_hash, prompt, client.model, SCHEMA_VERSION)
+    cached_result = None if refresh else cache.get(key)
+    if cached_result is not None:
+        print(f"キャッシュ済みの解析結果を使用します: {key[:12]}")
+        return VideoHighlights.model_validate(cached_result)
+    # Geminiで動画解析（圧縮・秒数入れ後の動画を使用）
+    print(f"Geminiで動画解析")
+    media_part = await asyncio.to_thread(video_part, video_path, upload)
+    highlights = await client.request_highlights(prompt, media_part)
+    cache.put(key, highlights.model_dump())
+    return highlights
+
+
+def analyze_video(video_path, prompt, cache, upload='inline', refresh=False, model=MODEL, **client_options):
+    client = ModelClient(model, **client_options)
+    return asyncio.run(analyze_video_async(video_path, prompt, cache, client, upload, refresh))
@@ -0,0 +1,17 @@
+from pydantic import BaseModel, Field
+
+# VideoHighlights の構造を変えたら上げる（解析結果のキャッシュを無効化する）
+SCHEMA_VERSION = 1
+
+class Narration(BaseModel):
+    narration: str = Field(..., description="ナレーション")
+    start_second: float = Field(..., description="開始秒数")
+    end_second: float = Field(..., description="終了秒数")
+
+class VideoHighlight(BaseModel):
+    start_second: float = Field(..., description="開始秒数")
+    end_second: float = Field(..., description="終了秒数")
+    narration: list[Narration] = Field(..., description="複数のナレーション")
+
+class VideoHighlights(BaseModel):
+    highlights: list[VideoHighlight] = Field(..., description="5~10秒のハイライトのリスト")
@@ -0,0 +1,185 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows では最大RSSを記録しない
+    resource = None
+
+METRIC_PREFIX = 'video_highlight'
+# 計測するステージ（--profile で cProfile を有効にできる）
+STAGES = (
+    'discover', 'probe', 'frame_decode', 'prefilter', 'dedup', 'audio_score', 'clip_load', 'overlay', 'proxy_encode',
+    'media_encode', 'upload', 'model_request', 'analysis', 'render', 'mux',
+)
+
+
+def peak_rss_bytes(who='self'):
+    """プロセスの最大RSS（children は終了済みの子プロセス: ffmpeg やワーカー）"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # Linux は KB、macOS はバイト単位
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+
+class Recorder:
+    """ステージごとの処理時間・最大RSS・フレーム数・バイト数を集計する"""
+
+    def __init__(self, profile_stages=()):
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.profile_stages = set(profile_stages)
+        self.profilers = {}
+        self.profiling = None
+
+    @contextmanager
+    def stage(self, name, frames=0, byte_count=0):
+        """with 内で counters['frames'] / counters['bytes'] に処理量を足せる"""
+        counters = dict(frames=frames, bytes=byte_count)
+        profiler = self.start_profile(name)
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = None
+            self.add(name, elapsed, counters['frames'], counters['bytes'])
+
+    def start_profile(self, name):
+        # cProfile は同時に1つしか有効にできないので、他のステージの計測中は行わない
+        if name not in self.profile_stages or self.profiling is not None:
+            return None
+        profiler = self.profilers.setdefault(name, cProfile.Profile())
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+        self.profiling = name
+        return profiler
+
+    def add(self, name, seconds, frames=0, byte_count=0):
+        with self.lock:
+            entry = self.stages.setdefault(name, dict(calls=0, seconds=0.0, max_seconds=0.0, frames=0, bytes=0))
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['frames'] += frames
+            entry['bytes'] += byte_count
+            entry['peak_rss_bytes'] = peak_rss_bytes()
+
+    def report(self):
+        stages = {}
+        for name, entry in self.stages.items():
+            stages[name] = dict(
+                entry,
+                frames_per_second=rate(entry['frames'], entry['seconds']),
+                bytes_per_second=rate(entry['bytes'], entry['seconds']),
+            )
+        return dict(
+            started_at=self.started_at,
+            wall_seconds=time.perf_counter() - self.started,
+            peak_rss_bytes=peak_rss_bytes(),
+            children_peak_rss_bytes=peak_rss_bytes('children'),
+            stages=stages,
+        )
+
+    def dump_profiles(self, prefix):
+        """ステージごとの cProfile の結果を <prefix>.<ステージ>.prof に保存"""
+        paths = []
+        for name, profiler in self.profilers.items():
+            path = Path(f'{prefix}.{name}.prof')
+            profiler.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+def write_atomic(path, text):
+    # node_exporter などが書き込み途中のファイルを読まないよう、一時ファイル経由で置き換える
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_json_report(report, path):
+    return write_atomic(path, json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def prometheus_text(report, labels=None):
+    """Prometheus の textfile collector 形式"""
+    base_labels = dict(labels or {})
+
+    def format_labels(**extra):
+        items = {**base_labels, **extra}
+        if not items:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in items.values())
+        return '{' + ','.join(f'{k}="{v}"' for k, v in zip(items, escaped)) + '}'
+
+    lines = []
+
+    def gauge(name, help_text, samples):
+        lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+        for sample_labels, value in samples:
+            if value is not None:
+                lines.append(f'{METRIC_PREFIX}_{name}{format_labels(**sample_labels)} {value}')
+
+    gauge('run_wall_seconds', 'Wall time of the whole run.', [({}, report['wall_seconds'])])
+    gauge('run_peak_rss_bytes', 'Peak RSS of the main process.', [({}, report['peak_rss_bytes'])])
+    gauge('run_children_peak_rss_bytes', 'Peak RSS of finished child processes.',
+          [({}, report['children_peak_rss_bytes'])])
+    gauge('run_started_at_seconds', 'Unix time the run started.', [({}, report['started_at'])])
+    stages = report['stages']
+    for key, help_text in [
+        ('calls', 'Number of times the stage ran.'),
+        ('seconds', 'Total time spent in the stage.'),
+        ('max_seconds', 'Longest single call of the stage.'),
+        ('frames', 'Frames processed by the stage.'),
+        ('bytes', 'Bytes processed by the stage.'),
+        ('frames_per_second', 'Frame throughput of the stage.'),
+        ('bytes_per_second', 'Byte throughput of the stage.'),
+        ('peak_rss_bytes', 'Peak RSS of the main process when the stage finished.'),
+    ]:
+        gauge(f'stage_{key}', help_text, [(dict(stage=name), entry.get(key)) for name, entry in stages.items()])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_report(report, path, labels=None):
+    return write_atomic(path, prometheus_text(report, labels))
+
+
+# 実行中の計測（start_run で新しい実行を始める）
+_recorder = Recorder()
+
+
+def start_run(profile_stages=()):
+    global _recorder
+    _recorder = Recorder(profile_stages)
+    return _recorder
+
+
+def current_recorder():
+    return _recorder
+
+
+def measure(name, frames=0, byte_count=0):
+    return _recorder.stage(name, frames, byte_count)
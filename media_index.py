@@ -0,0 +1,229 @@
+import os
+import re
+import sqlite3
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydantic import BaseModel, Field
+from ffmpeg_utils import ffmpeg_binary
+
+DEFAULT_INDEX_PATH = '.cache/media_index.sqlite3'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    fps REAL,
+    width INTEGER,
+    height INTEGER,
+    codec TEXT,
+    pix_fmt TEXT,
+    profile TEXT,
+    has_audio INTEGER NOT NULL,
+    offset REAL NOT NULL DEFAULT 0
+)
+'''
+
+# 元動画ごとの縮小フレームの保存先（frame_cache.py）
+FRAMES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    settings TEXT NOT NULL,
+    store_path TEXT NOT NULL,
+    frame_count INTEGER NOT NULL,
+    PRIMARY KEY (path, variant)
+)
+'''
+
+# 元動画ごとの1秒単位の音声スコア（audio_score.py、float32 の (秒数, 3) 配列）
+AUDIO_SCORES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS audio_scores (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    settings TEXT NOT NULL,
+    scores BLOB NOT NULL
+)
+'''
+
+
+class MediaInfo(BaseModel):
+    path: str = Field(..., description="動画ファイルのパス")
+    size: int = Field(..., description="ファイルサイズ")
+    mtime_ns: int = Field(..., description="更新時刻（ナノ秒）")
+    duration: float = Field(..., description="長さ（秒）")
+    fps: float | None = Field(None, description="フレームレート")
+    width: int | None = Field(None, description="幅")
+    height: int | None = Field(None, description="高さ")
+    codec: str | None = Field(None, description="映像コーデック")
+    pix_fmt: str | None = Field(None, description="画素フォーマット（例: yuv420p）")
+    profile: str | None = Field(None, description="コーデックのプロファイル（例: High）")
+    has_audio: bool = Field(False, description="音声の有無")
+    offset: float = Field(0, description="連結後のタイムライン上の開始秒数")
+
+    @property
+    def end(self):
+        return self.offset + self.duration
+
+
+def probe_media(video_path):
+    """ffmpeg -i の出力から長さ・fps・解像度・コーデック・画素フォーマット・プロファイル・音声の有無を取得"""
+    cmd = [ffmpeg_binary(), '-hide_banner', '-i', str(video_path)]
+    stderr = subprocess.run(cmd, capture_output=True, text=True, errors='replace').stderr
+    duration = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', stderr)
+    if not duration:
+        raise ValueError(f'長さを取得できませんでした: {video_path}')
+    hours, minutes, seconds = duration.groups()
+    # 例: Video: h264 (High) (avc1 / 0x31637661), yuv420p(progressive), 1920x1080 [SAR 1:1 DAR 16:9], 29.97 fps
+    video = re.search(
+        r'Stream #\S+.*?: Video: (\w+)(?: \(([^)/]+)\))?[^,]*, (\w+)(?:\([^)]*\))?.*?, (\d{2,5})x(\d{2,5})(.*)', stderr
+    )
+    fps = None
+    if video:
+        rate = re.search(r'([\d.]+)(k?) (?:fps|tbr)', video.group(6))
+        if rate:
+            fps = float(rate.group(1)) * (1000 if rate.group(2) else 1)
+    stat = os.stat(video_path)
+    return MediaInfo(
+        path=str(Path(video_path).resolve()),
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        duration=int(hours) * 3600 + int(minutes) * 60 + float(seconds),
+        fps=fps,
+        width=int(video.group(4)) if video else None,
+        height=int(video.group(5)) if video else None,
+        codec=video.group(1) if video else None,
+        pix_fmt=video.group(3) if video else None,
+        profile=video.group(2) if video else None,
+        has_audio=re.search(r'Stream #\S+.*?: Audio:', stderr) is not None,
+    )
+
+
+def open_index(index_path=DEFAULT_INDEX_PATH):
+    Path(index_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(index_path)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(media)')]
+    if columns and columns != list(MediaInfo.model_fields):
+        # 列の違う古いインデックスは作り直す（元動画を調べ直すだけで済む）
+        conn.execute('DROP TABLE media')
+    conn.execute(SCHEMA)
+    conn.execute(FRAMES_SCHEMA)
+    conn.execute(AUDIO_SCORES_SCHEMA)
+    return conn
+
+
+def lookup_media(conn, video_path):
+    """サイズと更新時刻が一致する場合のみインデックスの結果を返す"""
+    path = str(Path(video_path).resolve())
+    stat = os.stat(path)
+    row = conn.execute(
+        'SELECT path, size, mtime_ns, duration, fps, width, height, codec, pix_fmt, profile, has_audio, offset '
+        'FROM media WHERE path = ? AND size = ? AND mtime_ns = ?',
+        (path, stat.st_size, stat.st_mtime_ns)
+    ).fetchone()
+    if row is None:
+        return None
+    return MediaInfo(**dict(zip(MediaInfo.model_fields, row)))
+
+
+def store_media(conn, info):
+    conn.execute(
+        'INSERT OR REPLACE INTO media '
+        '(path, size, mtime_ns, duration, fps, width, height, codec, pix_fmt, profile, has_audio, offset) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (info.path, info.size, info.mtime_ns, info.duration, info.fps, info.width,
+         info.height, info.codec, info.pix_fmt, info.profile, int(info.has_audio), info.offset)
+    )
+
+
+def lookup_frames(conn, info, variant, settings):
+    """元動画と設定が一致する縮小フレームの保存先（ない場合は None）"""
+    row = conn.execute(
+        'SELECT store_path FROM frames WHERE path = ? AND variant = ? AND size = ? AND mtime_ns = ? AND settings = ?',
+        (info.path, variant, info.size, info.mtime_ns, settings)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def store_frames(conn, info, variant, settings, store_path, frame_count):
+    """縮小フレームの保存先を記録し、置き換えた古い保存先を返す"""
+    row = conn.execute('SELECT store_path FROM frames WHERE path = ? AND variant = ?', (info.path, variant)).fetchone()
+    conn.execute(
+        'INSERT OR REPLACE INTO frames (path, variant, size, mtime_ns, settings, store_path, frame_count) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (info.path, variant, info.size, info.mtime_ns, settings, str(store_path), frame_count)
+    )
+    conn.commit()
+    return row[0] if row and row[0] != str(store_path) else None
+
+
+def frame_entries(conn):
+    """記録済みの縮小フレームの (元動画のパス, 保存先) の一覧"""
+    return conn.execute('SELECT path, store_path FROM frames').fetchall()
+
+
+def forget_frames(conn, store_paths):
+    """削除した縮小フレームの記録を消す"""
+    conn.executemany('DELETE FROM frames WHERE store_path = ?', [(str(path),) for path in store_paths])
+    conn.commit()
+
+
+def lookup_audio_scores(conn, info, settings):
+    row = conn.execute(
+        'SELECT scores FROM audio_scores WHERE path = ? AND size = ? AND mtime_ns = ? AND settings = ?',
+        (info.path, info.size, info.mtime_ns, settings)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def store_audio_scores(conn, info, settings, scores):
+    conn.execute(
+        'INSERT OR REPLACE INTO audio_scores (path, size, mtime_ns, settings, scores) VALUES (?, ?, ?, ?, ?)',
+        (info.path, info.size, info.mtime_ns, settings, scores)
+    )
+    conn.commit()
+
+
+def scan_media(video_files, index_path=DEFAULT_INDEX_PATH, jobs=None):
+    """インデックスにない（または変更された）ファイルだけを並列に調べ、タイムラインを返す"""
+    conn = open_index(index_path)
+    try:
+        infos = {}
+        missing = []
+        for video_path in video_files:
+            info = lookup_media(conn, video_path)
+            if info is None:
+                missing.append(video_path)
+            else:
+                infos[video_path] = info
+
+        if missing:
+            print(f'メタデータを取得中: {len(missing)}ファイル')
+            with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+                futures = {video_path: executor.submit(probe_media, video_path) for video_path in missing}
+                for video_path, future in futures.items():
+                    try:
+                        infos[video_path] = future.result()
+                    except Exception as e:
+                        print(f'エラー: {Path(video_path).name} の読み込みに失敗しました - {str(e)}')
+
+        # 並び順どおりに連結したときの開始秒数を記録
+        timeline = []
+        offset = 0
+        for video_path in video_files:
+            info = infos.get(video_path)
+            if info is None or info.duration <= 0:
+                continue
+            info.offset = offset
+            offset += info.duration
+            store_media(conn, info)
+            timeline.append(info)
+        conn.commit()
+        return timeline
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import random
+from instrumentation import measure
+
+DEFAULT_CONCURRENCY = 4
+# Gemini の無料枠（gemini-2.0-flash-exp）は 10 RPM
+DEFAULT_REQUESTS_PER_MINUTE = 10
+DEFAULT_MAX_RETRIES = 5
+# 動画の解析は数分かかることがあるので長めにする
+DEFAULT_REQUEST_TIMEOUT = 600
+BACKOFF_BASE = 2
+BACKOFF_MAX = 120
+
+
+def retryable_errors():
+    """待てば成功する可能性のあるエラーだけ再試行する"""
+    import litellm
+    return (
+        asyncio.TimeoutError,
+        litellm.RateLimitError,
+        litellm.Timeout,
+        litellm.APIConnectionError,
+        litellm.ServiceUnavailableError,
+        litellm.InternalServerError,
+    )
+
+
+class TokenBucket:
+    """1秒あたり rate 個のトークンが補充され、最大 capacity 個まで貯まるレート制限"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """指数バックオフ（full jitter）の待ち時間"""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class ModelClient:
+    """同時実行数・レート・タイムアウト・再試行を制御する非同期の解析クライアント"""
+
+    def __init__(self, model, concurrency=DEFAULT_CONCURRENCY,
+                 requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, max_retries=DEFAULT_MAX_RETRIES,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, api_base=None, api_key=None):
+        self.model = model
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.api_base = api_base
+        self.api_key = api_key
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(requests_per_minute / 60, capacity=concurrency)
+
+    async def _complete_once(self, messages, response_format):
+        # litellm はモデル一覧などの読み込みに時間がかかるので、最初のリクエストで読み込む
+        import litellm
+        kwargs = {}
+        if self.api_base:
+            kwargs['api_base'] = self.api_base
+        if self.api_key:
+            kwargs['api_key'] = self.api_key
+        # 再試行はこちらで行うので、litellm 側の再試行は無効にする
+        with measure('model_request'):
+            response = await asyncio.wait_for(
+                litellm.acompletion(
+                    model=self.model, messages=messages, response_format=response_format,
+                    max_retries=0, **kwargs
+                ),
+                timeout=self.timeout,
+            )
+        return response.choices[0].message.content
+
+    async def complete(self, messages, response_format=None):
+        """レート制限を守りつつリクエストし、一時的なエラーは待ってから再試行する"""
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                try:
+                    return await self._complete_once(messages, response_format)
+                except retryable_errors() as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = backoff_delay(attempt)
+                    print(f"解析リクエストを再試行します（{attempt + 1}/{self.max_retries}、{delay:.1f}秒後）: {type(e).__name__}")
+                    await asyncio.sleep(delay)
+
+    async def request_highlights(self, prompt, media_part):
+        """media_part は動画1つ、またはコンタクトシートなど複数の画像のリスト"""
+        from highlight_models import VideoHighlights
+        media_parts = media_part if isinstance(media_part, list) else [media_part]
+        messages = [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": prompt}] + [
+                    {
+                        "type": "image_url",
+                        "image_url": part,
+                    }
+                    for part in media_parts
+                ],
+            }
+        ]
+        content = await self.complete(messages, response_format=VideoHighlights)
+        return VideoHighlights.model_validate(json.loads(content))
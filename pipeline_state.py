@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# 1回の実行のステージ（前のステージの結果が変わると後ろのステージもやり直す）
+STAGES = ('proxy', 'analysis', 'render', 'mux')
+
+
+def state_path(output_file):
+    """ステージの進み具合の保存先（例: videos/tokyo.state.json）"""
+    return Path(output_file).with_suffix('.state.json')
+
+
+def stage_fingerprint(*parts):
+    """ステージの入力（元動画・設定・前のステージの結果）からフィンガープリントを作成"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def timeline_sources(timeline):
+    """元動画の一覧（パス・サイズ・更新時刻）。ファイルが変わるとフィンガープリントも変わる"""
+    return [[info.path, info.size, info.mtime_ns] for info in timeline]
+
+
+def artifact_record(path):
+    stat = os.stat(path)
+    return dict(path=str(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def is_valid_artifact(record):
+    """成果物が記録した時のまま残っているかどうか（途中で止まった書き出しや上書きを検出）"""
+    try:
+        stat = os.stat(record['path'])
+    except OSError:
+        return False
+    return stat.st_size == record['size'] and stat.st_mtime_ns == record['mtime_ns'] and stat.st_size > 0
+
+
+class PipelineState:
+    """ステージごとのフィンガープリントと成果物を記録し、再実行時に完了済みのステージを飛ばす"""
+
+    def __init__(self, output_file):
+        self.path = state_path(output_file)
+        self.stages, self.segments = self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return {}, {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data.get('stages', {}), data.get('segments', {})
+        except (OSError, ValueError) as e:
+            print(f'実行状態の読み込みに失敗しました（最初から実行します）: {e}')
+            return {}, {}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'stages': self.stages, 'segments': self.segments}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def is_complete(self, stage, fingerprint):
+        entry = self.stages.get(stage)
+        return (
+            entry is not None
+            and entry['fingerprint'] == fingerprint
+            and all(is_valid_artifact(record) for record in entry['artifacts'])
+        )
+
+    def complete(self, stage, fingerprint, artifacts):
+        self.stages[stage] = dict(
+            fingerprint=fingerprint,
+            artifacts=[artifact_record(path) for path in artifacts],
+        )
+        self.save()
+
+    def invalidate(self, stage):
+        """指定したステージ以降の記録を消す"""
+        for name in STAGES[STAGES.index(stage):]:
+            self.stages.pop(name, None)
+        self.save()
+
+    def segment(self, fingerprint):
+        """書き出し済みのセグメントのパス（なければ None）"""
+        record = self.segments.get(fingerprint)
+        if record is None or not is_valid_artifact(record):
+            return None
+        return record['path']
+
+    def add_segment(self, fingerprint, path):
+        self.segments[fingerprint] = artifact_record(path)
+        self.save()
+
+    def prune_segments(self, keep):
+        """今回使わなかったセグメントの記録とファイルを削除"""
+        for fingerprint in list(self.segments):
+            if fingerprint in keep:
+                continue
+            record = self.segments.pop(fingerprint)
+            Path(record['path']).unlink(missing_ok=True)
+        self.save()
@@ -0,0 +1,242 @@
+import bisect
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from analysis_cache import AnalysisCache
+from ffmpeg_utils import ffmpeg_binary
+from frame_cache import FrameCache, FRAME_SAMPLE_FPS, FRAME_VARIANTS
+from highlight_models import Narration, VideoHighlight
+from media_index import DEFAULT_INDEX_PATH
+
+DEFAULT_PREFILTER_CACHE_DIR = '.cache/prefilter'
+
+# フレームの間引き方（スコアのキャッシュキーに含める、フレームキャッシュの gray と同じ）
+SAMPLE_SETTINGS = dict(sample_fps=FRAME_SAMPLE_FPS, width=FRAME_VARIANTS['gray']['width'])
+
+# 残す区間の判定基準（プロキシのキャッシュキーに含める）
+PREFILTER_SETTINGS = dict(
+    motion_min=2.0,          # 前のフレームとの輝度差の平均（0-255）がこれ未満なら静止
+    dark_max=30,             # 平均輝度がこれ未満なら露出不足
+    bright_min=235,          # 平均輝度がこれより大きければ白飛び
+    blur_min=20.0,           # ラプラシアンの分散がこれ未満ならピンぼけ・手ブレ
+    cut_min=0.4,             # 輝度ヒストグラムの差（0-1）がこれ以上ならシーンの切り替わり
+    static_keep_seconds=2,   # 静止した区間は先頭のこの秒数だけ残す
+    cut_keep_seconds=2,      # シーンの切り替わりの後はこの秒数を残す
+    min_gap_seconds=2,       # これより短い除外区間は残す側に含める
+    min_span_seconds=1,      # これより短い区間は残さない
+)
+
+
+def sample_frames(video_path, width=None, height=None, sample_fps=2, sample_width=160):
+    """ffmpeg で間引き・縮小したグレースケールのフレームを (枚数, 高さ, 幅) の配列で読み込む"""
+    if width and height:
+        sample_height = max(2, int(round(height * sample_width / width / 2)) * 2)
+    else:
+        sample_height = sample_width * 9 // 16
+    cmd = [
+        ffmpeg_binary(), '-v', 'error', '-i', str(video_path), '-an',
+        '-vf', f'fps={sample_fps},scale={sample_width}:{sample_height},format=gray',
+        '-f', 'rawvideo', '-',
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', errors='replace').strip())
+    frames = np.frombuffer(result.stdout, dtype=np.uint8)
+    frames = frames[:len(frames) // (sample_width * sample_height) * sample_width * sample_height]
+    return frames.reshape(-1, sample_height, sample_width)
+
+
+def frame_scores(frames):
+    """動き・明るさ・シャープさ・シーンの切り替わりをフレームごとにまとめて計算"""
+    frames = frames.astype(np.float32)
+    count = len(frames)
+    if count == 0:
+        return dict(motion=[], exposure=[], blur=[], cut=[])
+
+    # 動き: 前のフレームとの差の平均（先頭は次のフレームとの差で代用）
+    diff = np.abs(np.diff(frames, axis=0)).mean(axis=(1, 2))
+    motion = np.concatenate([diff[:1], diff]) if count > 1 else np.zeros(1)
+
+    exposure = frames.mean(axis=(1, 2))
+
+    # ピンぼけ: ラプラシアンの分散
+    laplacian = (
+        4 * frames[:, 1:-1, 1:-1]
+        - frames[:, :-2, 1:-1] - frames[:, 2:, 1:-1]
+        - frames[:, 1:-1, :-2] - frames[:, 1:-1, 2:]
+    )
+    blur = laplacian.var(axis=(1, 2))
+
+    # シーンの切り替わり: 16階調の輝度ヒストグラムの差
+    bins = (frames.astype(np.int64) >> 4) + 16 * np.arange(count)[:, None, None]
+    hist = np.bincount(bins.ravel(), minlength=16 * count).reshape(count, 16)
+    hist = hist / hist.sum(axis=1, keepdims=True)
+    cut = np.concatenate([[0.0], np.abs(np.diff(hist, axis=0)).sum(axis=1) / 2])
+
+    return dict(motion=motion.tolist(), exposure=exposure.tolist(), blur=blur.tolist(), cut=cut.tolist())
+
+
+def find_runs(mask):
+    """True が続く区間の (開始インデックス, 終了インデックス) の配列"""
+    padded = np.concatenate([[0], np.asarray(mask, dtype=np.int8), [0]])
+    edges = np.flatnonzero(np.diff(padded))
+    return edges.reshape(-1, 2)
+
+
+def keep_mask(scores, sample_fps, settings=PREFILTER_SETTINGS):
+    """残すフレームを判定（不良な区間は除き、静止した区間は先頭だけ残す）"""
+    motion = np.asarray(scores['motion'])
+    exposure = np.asarray(scores['exposure'])
+    blur = np.asarray(scores['blur'])
+    cut = np.asarray(scores['cut']) >= settings['cut_min']
+
+    defective = (exposure < settings['dark_max']) | (exposure > settings['bright_min']) | (blur < settings['blur_min'])
+    static = motion < settings['motion_min']
+    keep = ~defective & ~static
+
+    # 静止した区間は単調なので先頭だけに圧縮
+    static_keep = int(settings['static_keep_seconds'] * sample_fps)
+    for start, end in find_runs(static & ~defective):
+        keep[start:min(end, start + static_keep)] = True
+
+    # シーンが切り替わった直後は新しい場面なので残す
+    cut_keep = int(settings['cut_keep_seconds'] * sample_fps)
+    for index in np.flatnonzero(cut):
+        keep[index:index + cut_keep] |= ~defective[index:index + cut_keep]
+
+    # 短い除外区間は埋め、短すぎる区間は捨てる
+    min_gap = int(settings['min_gap_seconds'] * sample_fps)
+    for start, end in find_runs(~keep):
+        if 0 < start and end < len(keep) and end - start < min_gap:
+            keep[start:end] = True
+    min_span = int(settings['min_span_seconds'] * sample_fps)
+    for start, end in find_runs(keep):
+        if end - start < min_span:
+            keep[start:end] = False
+    return keep
+
+
+def mask_to_spans(keep, sample_fps, duration):
+    """残すフレームをファイル内の (開始秒数, 終了秒数) に変換"""
+    return [
+        [float(start / sample_fps), float(min(end / sample_fps, duration))]
+        for start, end in find_runs(keep)
+    ]
+
+
+def scores_cache_key(video_path, sample_settings):
+    stat = os.stat(video_path)
+    payload = json.dumps({
+        'file': [str(Path(video_path).resolve()), stat.st_size, stat.st_mtime_ns],
+        'settings': sample_settings,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cached_variant(frame_cache, sample_settings):
+    """sample_settings と同じ間引き方のグレースケールの縮小フレームの種類（フレームキャッシュにない場合は None）"""
+    if frame_cache is None or frame_cache.sample_fps != sample_settings['sample_fps']:
+        return None
+    for variant, spec in FRAME_VARIANTS.items():
+        if spec['channels'] == 1 and spec['width'] == sample_settings['width']:
+            return variant
+    return None
+
+
+def score_media(info, cache, sample_settings=SAMPLE_SETTINGS, frame_cache=None):
+    """1ファイル分のスコア（ファイルが変わらなければキャッシュを使う）
+
+    frame_cache に sample_settings と同じ縮小フレームがあれば、元動画をデコードせずにそこから計算する
+    """
+    key = scores_cache_key(info.path, sample_settings)
+    scores = cache.get(key)
+    if scores is None:
+        variant = cached_variant(frame_cache, sample_settings)
+        if variant is not None:
+            frames = frame_cache.frames(info, variant)
+        else:
+            frames = sample_frames(
+                info.path, info.width, info.height,
+                sample_settings['sample_fps'], sample_settings['width']
+            )
+        scores = frame_scores(frames)
+        cache.put(key, scores)
+    return scores
+
+
+def detect_spans(timeline, settings=PREFILTER_SETTINGS, cache_dir=DEFAULT_PREFILTER_CACHE_DIR, jobs=4,
+                 sample_settings=SAMPLE_SETTINGS, frame_cache=None, index_path=DEFAULT_INDEX_PATH):
+    """ファイルごとに残す区間（ファイル内の秒数）を返す"""
+    cache = AnalysisCache(cache_dir)
+    frame_cache = frame_cache or FrameCache(index_path=index_path)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        all_scores = list(executor.map(
+            lambda info: score_media(info, cache, sample_settings, frame_cache), timeline
+        ))
+    sample_fps = sample_settings['sample_fps']
+    return [
+        mask_to_spans(keep_mask(scores, sample_fps, settings), sample_fps, info.duration)
+        for info, scores in zip(timeline, all_scores)
+    ]
+
+
+def build_remap(timeline, file_spans):
+    """プロキシ上の秒数から元のタイムラインの秒数への対応表 [(プロキシの開始秒数, 元の開始秒数, 長さ)]"""
+    remap = []
+    proxy_time = 0
+    for info, spans in zip(timeline, file_spans):
+        for start, end in spans:
+            remap.append((proxy_time, info.offset + start, end - start))
+            proxy_time += end - start
+    return remap
+
+
+def remap_duration(remap):
+    if not remap:
+        return 0
+    proxy_start, _, duration = remap[-1]
+    return proxy_start + duration
+
+
+def to_original(t, remap):
+    """プロキシ上の秒数を元のタイムラインの秒数に変換"""
+    index = max(0, bisect.bisect_right([entry[0] for entry in remap], t) - 1)
+    proxy_start, original_start, duration = remap[index]
+    return original_start + min(max(t - proxy_start, 0), duration)
+
+
+def remap_highlights(highlights, remap):
+    """プロキシ上のハイライトを元のタイムラインに戻す（除外した区間をまたぐものは分割）"""
+    remapped = []
+    for highlight in highlights:
+        pieces = []
+        for proxy_start, original_start, duration in remap:
+            start = max(highlight.start_second, proxy_start)
+            end = min(highlight.end_second, proxy_start + duration)
+            if end <= start:
+                continue
+            piece_start = original_start + start - proxy_start
+            piece_end = original_start + end - proxy_start
+            narration = []
+            for n in highlight.narration:
+                # ナレーションは開始位置を含む区間に付ける
+                anchor = max(n.start_second, highlight.start_second)
+                if start <= anchor < end:
+                    n_start = original_start + anchor - proxy_start
+                    n_end = min(n_start + n.end_second - n.start_second, piece_end)
+                    narration.append(Narration(narration=n.narration, start_second=n_start, end_second=n_end))
+            if pieces and abs(pieces[-1].end_second - piece_start) < 1e-6:
+                # 元のタイムラインで続いている区間（ファイルの境目など）はつなげる
+                previous = pieces[-1]
+                pieces[-1] = VideoHighlight(
+                    start_second=previous.start_second, end_second=piece_end,
+                    narration=previous.narration + narration,
+                )
+            else:
+                pieces.append(VideoHighlight(start_second=piece_start, end_second=piece_end, narration=narration))
+        remapped.extend(pieces)
+    return remapped
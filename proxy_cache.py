@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+# キャッシュの保存先と容量上限のデフォルト値
+DEFAULT_CACHE_DIR = '.cache/proxy'
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024 * 1024
+
+
+def proxy_cache_key(video_files, settings):
+    """入力ファイル一覧（パス・サイズ・更新時刻）と圧縮設定からキャッシュキーを作成"""
+    files = []
+    for video_path in video_files:
+        stat = os.stat(video_path)
+        files.append([str(Path(video_path).resolve()), stat.st_size, stat.st_mtime_ns])
+    payload = json.dumps({'files': files, 'settings': settings}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ProxyCache:
+    """圧縮済み動画（プロキシ）をキーごとに保存するLRUキャッシュ"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def path_for(self, key):
+        return self.cache_dir / f'{key}.mp4'
+
+    def get(self, key, output_path):
+        """キャッシュがあれば output_path にコピーして True を返す"""
+        cached_path = self.path_for(key)
+        if not cached_path.exists():
+            return False
+        # 使用時刻を更新してLRUの順序に反映
+        os.utime(cached_path)
+        if cached_path.resolve() != Path(output_path).resolve():
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(cached_path, output_path)
+        return True
+
+    def put(self, key, source_path):
+        """書き出し済みのプロキシをキャッシュに登録し、容量上限を超えた分を削除"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cached_path = self.path_for(key)
+        tmp_path = cached_path.with_suffix('.tmp')
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, cached_path)
+        self.evict(keep=key)
+        return cached_path
+
+    def evict(self, keep=None):
+        """最後に使われた時刻が古いものから削除して容量上限以内に収める"""
+        entries = []
+        for path in self.cache_dir.glob('*.mp4'):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path.stem == keep:
+                continue
+            print(f'キャッシュを削除: {path.name}')
+            path.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,119 @@
+from pydantic import BaseModel, Field
+
+# Gemini は動画を1秒1フレームで読み込み、1フレーム258トークン、音声は1秒32トークン
+VIDEO_TOKENS_PER_SECOND = 258
+AUDIO_TOKENS_PER_SECOND = 32
+# Gemini の入力トークンの上限
+MODEL_INPUT_TOKENS = 1_000_000
+# プロンプトと出力のために残しておくトークン数
+RESERVED_TOKENS = 50_000
+# プロキシ動画に使えるトークン数（入力の上限からプロンプトと出力の分を引いた値）
+DEFAULT_TOKEN_BUDGET = MODEL_INPUT_TOKENS - RESERVED_TOKENS
+
+# 候補は大きい順。Gemini 側で縮小されるので 720p より大きくはしない
+HEIGHT_CANDIDATES = (720, 540, 480, 360, 288, 240, 180, 144)
+FPS_CANDIDATES = (30, 15, 10, 5, 2, 1)
+AUDIO_BITRATE_CANDIDATES = (32, 24, 16)
+# 画質を保つための 1画素あたりのビット数の下限（x264 ultrafast）
+MIN_BITS_PER_PIXEL = 0.06
+# 音声に使う容量の上限（全体に対する割合）
+MAX_AUDIO_SHARE = 0.25
+# コンテナなどのオーバーヘッド分の余裕
+CONTAINER_OVERHEAD = 0.03
+
+
+class ProxyPlan(BaseModel):
+    fps: float = Field(..., description="書き出すフレームレート")
+    height: int = Field(..., description="書き出す高さ（幅は縦横比から決める）")
+    video_bitrate: int = Field(..., description="映像のビットレート（bps）")
+    audio_bitrate: int | None = Field(None, description="音声のビットレート（bps、None なら音声なし）")
+    tokens: int = Field(..., description="Gemini の入力トークン数の見積もり")
+    fits_token_budget: bool = Field(True, description="トークンの上限に収まるかどうか")
+
+    @property
+    def bitrate_str(self):
+        return f'{self.video_bitrate // 1000}k'
+
+    @property
+    def audio_bitrate_str(self):
+        return f'{self.audio_bitrate // 1000}k' if self.audio_bitrate else None
+
+
+def estimate_tokens(duration, audio=True):
+    return int(duration * (VIDEO_TOKENS_PER_SECOND + (AUDIO_TOKENS_PER_SECOND if audio else 0)))
+
+
+def width_for(height, source_width=None, source_height=None):
+    if source_width and source_height:
+        return max(2, int(round(height * source_width / source_height / 2)) * 2)
+    return height * 16 // 9
+
+
+def total_bitrate_for(duration, byte_budget):
+    """容量に収まる映像と音声の合計のビットレート（bps）"""
+    return int(byte_budget * 8 * (1 - CONTAINER_OVERHEAD) / max(duration, 1))
+
+
+def keeps_quality(video_bitrate, fps, height, width=None):
+    """1画素あたりのビット数が画質の下限以上かどうか"""
+    return video_bitrate / ((width or width_for(height)) * height * fps) >= MIN_BITS_PER_PIXEL
+
+
+def plan_audio(total_bitrate, has_audio, tokens_allow_audio):
+    """容量の割合の上限以内で最も高い音声ビットレートを選ぶ（入らなければ音声なし）"""
+    if not has_audio or not tokens_allow_audio:
+        return None
+    for kbps in AUDIO_BITRATE_CANDIDATES:
+        if kbps * 1000 <= total_bitrate * MAX_AUDIO_SHARE:
+            return kbps * 1000
+    return None
+
+
+def plan_proxy(duration, byte_budget, token_budget=DEFAULT_TOKEN_BUDGET, source_fps=None,
+               source_width=None, source_height=None, has_audio=True):
+    """容量とトークンの上限から、プロキシのフレームレート・高さ・音声を決める
+
+    Gemini は1秒1フレームしか見ないので、解像度を優先し、余った分でフレームレートを上げる
+    """
+    duration = max(duration, 1)
+    total_bitrate = total_bitrate_for(duration, byte_budget)
+
+    # 音声を含めるとトークンの上限を超える場合は音声を落とす
+    tokens_allow_audio = token_budget is None or estimate_tokens(duration, audio=True) <= token_budget
+    audio_bitrate = plan_audio(total_bitrate, has_audio, tokens_allow_audio)
+    video_bitrate = total_bitrate - (audio_bitrate or 0)
+
+    max_height = min(HEIGHT_CANDIDATES[0], source_height or HEIGHT_CANDIDATES[0])
+    heights = [h for h in HEIGHT_CANDIDATES if h <= max_height] or [max_height]
+    max_fps = source_fps or FPS_CANDIDATES[0]
+    fps_candidates = [f for f in FPS_CANDIDATES if f <= max_fps] or [max_fps]
+
+    height, fps = heights[-1], fps_candidates[-1]
+    for candidate_height in heights:
+        width = width_for(candidate_height, source_width, source_height)
+        fitting = [f for f in fps_candidates if keeps_quality(video_bitrate, f, candidate_height, width)]
+        if fitting:
+            height, fps = candidate_height, fitting[0]
+            break
+
+    tokens = estimate_tokens(duration, audio=audio_bitrate is not None)
+    return ProxyPlan(
+        fps=fps,
+        height=height,
+        video_bitrate=video_bitrate,
+        audio_bitrate=audio_bitrate,
+        tokens=tokens,
+        fits_token_budget=token_budget is None or tokens <= token_budget,
+    )
+
+
+def plan_for_timeline(timeline, duration, byte_budget, token_budget=DEFAULT_TOKEN_BUDGET):
+    """タイムラインの元動画の中で最大の解像度・フレームレートを上限にして計画する"""
+    largest = max(timeline, key=lambda info: (info.height or 0) * (info.width or 0))
+    return plan_proxy(
+        duration, byte_budget, token_budget,
+        source_fps=max((info.fps for info in timeline if info.fps), default=None),
+        source_width=largest.width,
+        source_height=largest.height,
+        has_audio=any(info.has_audio for info in timeline),
+    )
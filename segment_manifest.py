@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+MANIFEST_NAME = 'manifest.json'
+# プロキシの計画で決まる設定（ファイルを追加しても、書き出し済みのセグメントと同じ値で続きを書く）
+PLAN_KEYS = ('fps', 'size', 'audio_bitrate')
+
+
+def segment_dir_for(output_path):
+    """出力動画ごとのセグメント保存ディレクトリ（例: videos/tokyo.segments）"""
+    return Path(output_path).with_suffix('.segments')
+
+
+def segment_name(video_path):
+    digest = hashlib.sha1(str(Path(video_path).resolve()).encode('utf-8')).hexdigest()[:12]
+    return f'{Path(video_path).stem}_{digest}.mp4'
+
+
+def load_manifest(segment_dir):
+    manifest_path = Path(segment_dir) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('segments', {})
+    except (OSError, ValueError) as e:
+        print(f'マニフェストの読み込みに失敗しました（全て再作成します）: {e}')
+        return {}
+
+
+def save_manifest(segment_dir, segments):
+    manifest_path = Path(segment_dir) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'segments': segments}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def manifest_entry(video_path, segment_path, offset, bitrate, settings):
+    stat = os.stat(video_path)
+    return dict(
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        offset=offset,
+        bitrate=bitrate,
+        settings=settings,
+        segment=Path(segment_path).name,
+    )
+
+
+def is_reusable(entry, video_path, segment_dir, offset, settings):
+    """書き出し済みのセグメントがそのまま使えるかどうか
+
+    ビットレートは見ない（容量は再利用するセグメントの実際のサイズを引いて、残りを新しいファイルに割り当てる）
+    """
+    if not entry:
+        return False
+    stat = os.stat(video_path)
+    return (
+        entry['size'] == stat.st_size
+        and entry['mtime_ns'] == stat.st_mtime_ns
+        and abs(entry['offset'] - offset) < 1e-3
+        and entry['settings'] == settings
+        and (Path(segment_dir) / entry['segment']).exists()
+    )
+
+
+def previous_settings(entries, settings):
+    """書き出し済みのセグメントの計画の設定（計画以外の設定が今回と違うものは使わない、なければ None）"""
+    fixed = {key: value for key, value in settings.items() if key not in PLAN_KEYS}
+    for entry in entries:
+        previous = {key: value for key, value in entry['settings'].items() if key != 'spans'}
+        if set(previous) == set(settings) and {key: previous[key] for key in fixed} == fixed:
+            return previous
+    return None
@@ -0,0 +1,113 @@
+import re
+import tempfile
+from pathlib import Path
+from ffmpeg_utils import run_ffmpeg, concat_copy
+from decoder_pool import split_on_timeline
+
+# 頭と尻の再エンコード部分の画質（元映像との差が目立たない設定）
+REENCODE_OPTIONS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18']
+# ffmpeg -i が表示する H.264 のプロファイル名と libx264 の -profile:v の対応
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444',
+}
+# 音声は短い区間でも正確に切れるよう常に再エンコードする（映像に比べて十分軽い）
+AUDIO_OPTIONS = ['-c:a', 'aac', '-ar', '48000', '-ac', '2', '-b:a', '128k']
+# キーフレーム位置の比較に使う誤差
+EPSILON = 1e-3
+
+
+def keyframe_times(video_path):
+    """キーフレームだけをデコードしてその時刻を取得"""
+    result = run_ffmpeg([
+        '-skip_frame', 'nokey', '-i', video_path,
+        '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-',
+    ], loglevel='info')
+    return sorted(float(t) for t in re.findall(r'pts_time:([\d.]+)', result.stderr))
+
+
+def reencode_options(info):
+    """再エンコードする部分の設定（コピーする部分と連結できるよう、画素フォーマットとプロファイルを元動画に揃える）"""
+    options = REENCODE_OPTIONS + ['-pix_fmt', info.pix_fmt or 'yuv420p']
+    if info.profile in X264_PROFILES:
+        options += ['-profile:v', X264_PROFILES[info.profile]]
+    if info.fps:
+        options += ['-r', f'{info.fps}']
+    return options
+
+
+def write_piece(info, start, end, output_path, copy_video):
+    """元動画の [start, end] をMPEG-TSとして書き出す（映像はコピーまたは再エンコード）"""
+    duration = end - start
+    args = ['-ss', f'{start:.6f}', '-i', info.path]
+    if info.has_audio:
+        audio_map = '0:a:0'
+    else:
+        # 音声がないファイルは無音を入れて、連結時のストリーム構成を揃える
+        args += ['-f', 'lavfi', '-i', 'anullsrc=r=48000:cl=stereo']
+        audio_map = '1:a:0'
+    args += ['-t', f'{duration:.6f}', '-map', '0:v:0', '-map', audio_map]
+    if copy_video:
+        # -t はデコード順で切るため、Bフレームがあると次の GOP のキーフレームまで入ってしまう。
+        # 映像はキーフレーム間のフレーム数で切る
+        args += ['-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb', '-frames:v', str(round(duration * info.fps))]
+    else:
+        args += reencode_options(info)
+    args += AUDIO_OPTIONS + ['-f', 'mpegts', output_path]
+    run_ffmpeg(args)
+    return output_path
+
+
+def smart_cut_piece(info, start, end, work_dir, prefix, keyframes):
+    """キーフレーム間はストリームコピーし、GOP途中の頭と尻だけを再エンコード"""
+    inner = [k for k in keyframes if start - EPSILON <= k <= end + EPSILON]
+    if info.codec != 'h264' or not info.fps or len(inner) < 2:
+        # コピーできる区間がない場合（フレームレートが分からずコピーするフレーム数を決められない場合も）は全体を再エンコード
+        return [write_piece(info, start, end, Path(work_dir) / f'{prefix}_full.ts', False)]
+
+    first_key, last_key = inner[0], inner[-1]
+    paths = []
+    if first_key - start > EPSILON:
+        paths.append(write_piece(info, start, first_key, Path(work_dir) / f'{prefix}_head.ts', False))
+    paths.append(write_piece(info, first_key, last_key, Path(work_dir) / f'{prefix}_copy.ts', True))
+    if end - last_key > EPSILON:
+        paths.append(write_piece(info, last_key, end, Path(work_dir) / f'{prefix}_tail.ts', False))
+    return paths
+
+
+def can_smart_cut(pieces):
+    """連結するとストリーム構成が揃わない場合は高速モードを使わない"""
+    formats = {(info.codec, info.width, info.height, info.pix_fmt, info.profile) for info, _, _ in pieces}
+    return len(formats) == 1
+
+
+def create_smart_highlight_video(timeline, output_path, highlights):
+    """ハイライト動画を再エンコード最小限で作成（ナレーションの焼き込みはしない）"""
+    total_duration = timeline[-1].end
+    pieces = []
+    for highlight in highlights:
+        if highlight.start_second > total_duration:
+            continue
+        end = min(highlight.end_second, total_duration)
+        pieces.extend(split_on_timeline(timeline, highlight.start_second, end))
+    if not pieces:
+        print('ハイライトの区間がありませんでした。')
+        return None
+    if not can_smart_cut(pieces):
+        print('元動画のコーデック・解像度・画素フォーマット・プロファイルが揃っていないため、高速モードは使えません。')
+        return None
+
+    keyframes = {}
+    with tempfile.TemporaryDirectory(dir=Path(output_path).parent) as work_dir:
+        segment_paths = []
+        for i, (info, start, end) in enumerate(pieces):
+            if info.path not in keyframes:
+                keyframes[info.path] = keyframe_times(info.path)
+            segment_paths.extend(smart_cut_piece(info, start, end, work_dir, f'piece_{i:05d}', keyframes[info.path]))
+        concat_copy(segment_paths, output_path)
+    return output_path
@@ -0,0 +1,93 @@
+import os
+from pathlib import Path
+from ffmpeg_utils import run_ffmpeg
+
+SUBTITLE_FORMATS = ('srt', 'vtt', 'ass')
+
+ASS_HEADER = '''[Script Info]
+ScriptType: v4.00+
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Sans,24,&H00FFFFFF,&H00FFFFFF,&H80000000,&H80000000,0,0,0,0,100,100,0,0,3,1,0,2,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+'''
+
+
+def narration_cues(highlights, total_duration):
+    """ハイライト動画上でのナレーションの (開始秒数, 終了秒数, テキスト) を計算"""
+    cues = []
+    current_time = 0
+    for highlight in highlights:
+        if highlight.start_second > total_duration:
+            continue
+        end = min(highlight.end_second, total_duration)
+        clip_duration = end - highlight.start_second
+
+        for narration in highlight.narration:
+            # ナレーションの相対時間を計算
+            relative_start = current_time + (narration.start_second - highlight.start_second)
+            relative_end = relative_start + (narration.end_second - narration.start_second)
+            cues.append((relative_start, relative_end, narration.narration))
+        current_time += clip_duration
+    return cues
+
+
+def format_time(seconds, fmt):
+    millis = max(0, int(round(seconds * 1000)))
+    hours, millis = divmod(millis, 3600 * 1000)
+    minutes, millis = divmod(millis, 60 * 1000)
+    secs, millis = divmod(millis, 1000)
+    if fmt == 'srt':
+        return f'{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}'
+    if fmt == 'vtt':
+        return f'{hours:02d}:{minutes:02d}:{secs:02d}.{millis:03d}'
+    return f'{hours:d}:{minutes:02d}:{secs:02d}.{millis // 10:02d}'
+
+
+def render_subtitles(cues, fmt):
+    if fmt == 'srt':
+        blocks = [
+            f'{i}\n{format_time(start, fmt)} --> {format_time(end, fmt)}\n{text}\n'
+            for i, (start, end, text) in enumerate(cues, 1)
+        ]
+        return '\n'.join(blocks)
+    if fmt == 'vtt':
+        blocks = ['WEBVTT\n']
+        for start, end, text in cues:
+            text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            blocks.append(f'{format_time(start, fmt)} --> {format_time(end, fmt)}\n{text}\n')
+        return '\n'.join(blocks)
+    if fmt == 'ass':
+        lines = [ASS_HEADER]
+        for start, end, text in cues:
+            text = text.replace('{', '(').replace('}', ')').replace('\n', '\\N')
+            lines.append(f'Dialogue: 0,{format_time(start, fmt)},{format_time(end, fmt)},Default,,0,0,0,,{text}\n')
+        return ''.join(lines)
+    raise ValueError(f'未対応の字幕形式です: {fmt}')
+
+
+def write_subtitles(cues, output_path, fmt=None):
+    """字幕ファイルを書き出す（形式は拡張子から判定）"""
+    fmt = fmt or Path(output_path).suffix.lstrip('.').lower()
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(render_subtitles(cues, fmt))
+    return output_path
+
+
+def mux_subtitles(video_path, subtitle_path, language='jpn'):
+    """映像・音声はコピーのまま、字幕をソフトサブ（mov_text）として動画に追加"""
+    video_path = Path(video_path)
+    tmp_path = video_path.with_stem(video_path.stem + '_subtitled')
+    run_ffmpeg([
+        '-i', video_path, '-i', subtitle_path,
+        '-map', '0:v', '-map', '0:a?', '-map', '1:0',
+        '-c', 'copy', '-c:s', 'mov_text', '-metadata:s:s:0', f'language={language}',
+        '-movflags', '+faststart', tmp_path,
+    ])
+    os.replace(tmp_path, video_path)
+    return str(video_path)
@@ -0,0 +1,22 @@
+from analysis_cache import AnalysisCache, analysis_cache_key, file_sha256
+
+
+def test_key_depends_on_every_input(tmp_path):
+    proxy = tmp_path / 'proxy.mp4'
+    proxy.write_bytes(b'proxy')
+    content_hash = file_sha256(proxy)
+    key = analysis_cache_key(content_hash, 'prompt', 'model', 1)
+    assert key == analysis_cache_key(file_sha256(proxy), 'prompt', 'model', 1)
+    assert key != analysis_cache_key(content_hash, 'prompt 2', 'model', 1)
+    assert key != analysis_cache_key(content_hash, 'prompt', 'model 2', 1)
+    assert key != analysis_cache_key(content_hash, 'prompt', 'model', 2)
+    proxy.write_bytes(b'other proxy')
+    assert key != analysis_cache_key(file_sha256(proxy), 'prompt', 'model', 1)
+
+
+def test_round_trip(tmp_path):
+    cache = AnalysisCache(tmp_path)
+    assert cache.get('key') is None
+    result = {'highlights': [{'start_second': 1, 'end_second': 2, 'narration': []}]}
+    cache.put('key', result)
+    assert cache.get('key') == result
@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import audio_score
+from audio_score import (
+    media_audio_scores, timeline_audio_track, proxy_track, rank_windows, per_second_scores,
+    AUDIO_SETTINGS, ONSETS, SCORE
+)
+from chunked_analysis import audio_tiebreak_score, reduce_highlights
+from ffmpeg_utils import run_ffmpeg
+from highlight_models import VideoHighlight
+from media_index import open_index, lookup_audio_scores, scan_media
+
+# 3〜4秒目だけ大きな音が1秒に4回鳴る（それ以外は小さな音）
+LOUD_SECOND = "if(between(t,3,4), 0.8*sin(2*PI*440*t)*lt(mod(t*4,1),0.5), 0.01*sin(2*PI*220*t))"
+
+
+def test_per_second_scores_prefers_loud_bursts():
+    frames_per_second = 20
+    power = np.full(6 * frames_per_second, 1e-4)
+    power[2 * frames_per_second:3 * frames_per_second:5] = 0.5
+    scores = per_second_scores(power)
+    assert scores.shape == (6, 3)
+    assert scores[2, ONSETS] == 4
+    assert scores[:, SCORE].argmax() == 2 and scores[0, SCORE] == 0
+
+
+def test_scores_are_stored_in_index(tmp_path, monkeypatch):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    run_ffmpeg([
+        '-f', 'lavfi', '-i', 'color=s=64x36:r=10:d=6', '-f', 'lavfi', '-i', f"aevalsrc='{LOUD_SECOND}':s=48000:d=6",
+        '-pix_fmt', 'yuv420p', '-shortest', video_dir / 'A.MP4',
+    ])
+    run_ffmpeg(['-f', 'lavfi', '-i', 'color=s=64x36:r=10:d=2', '-pix_fmt', 'yuv420p', video_dir / 'B.MP4'])
+    index_path = tmp_path / 'index.sqlite3'
+    timeline = scan_media(sorted(video_dir.glob('*.MP4')), index_path)
+
+    scores = media_audio_scores(timeline[0], index_path)
+    assert scores[:, SCORE].argmax() == 3
+    assert scores[3, ONSETS] >= 3
+
+    # 2回目はデコードせずにインデックスから読む
+    monkeypatch.setattr(audio_score, 'decode_frame_power', None)
+    track = timeline_audio_track(timeline, index_path)
+    assert len(track) == 8
+    np.testing.assert_array_equal(track[:6], scores[:6, SCORE])
+    assert (track[6:] == 0).all()
+
+
+def test_track_ranks_windows_and_breaks_ties():
+    track = np.zeros(30, dtype=np.float32)
+    track[22:25] = 1.0
+    # 事前フィルタで 10〜20秒を除いたプロキシ上では 12〜15秒
+    assert proxy_track(track, [(0, 0, 10), (10, 20, 10)], 20)[12:15].tolist() == [1.0] * 3
+    assert rank_windows([(0, 10), (10, 20), (20, 30)], track, 1) == [(20, 30)]
+
+    quiet = VideoHighlight(start_second=0, end_second=5, narration=[])
+    loud = VideoHighlight(start_second=21, end_second=26, narration=[])
+    assert reduce_highlights([quiet, loud], 5, audio_tiebreak_score(track)) == [loud]
+
+
+def test_failed_decode_is_not_stored(tmp_path):
+    video_path = tmp_path / 'A.MP4'
+    run_ffmpeg([
+        '-f', 'lavfi', '-i', 'color=s=64x36:r=10:d=3', '-f', 'lavfi', '-i', 'sine=d=3',
+        '-pix_fmt', 'yuv420p', '-shortest', video_path,
+    ])
+    index_path = tmp_path / 'index.sqlite3'
+    info = scan_media([video_path], index_path)[0]
+    # 大きさと更新時刻はそのままで、中身が読めないファイルにする
+    stat = video_path.stat()
+    video_path.write_bytes(b'\0' * stat.st_size)
+    os.utime(video_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    with pytest.raises(RuntimeError):
+        audio_score.decode_frame_power(video_path)
+
+    assert (media_audio_scores(info, index_path) == 0).all()
+    conn = open_index(index_path)
+    try:
+        assert lookup_audio_scores(conn, info, json.dumps(AUDIO_SETTINGS, sort_keys=True)) is None
+    finally:
+        conn.close()
+
+
+def test_chatty_stderr_does_not_block(tmp_path, monkeypatch):
+    # パイプの容量を超える警告を出してから音声を書く ffmpeg の代わり
+    fake_ffmpeg = tmp_path / 'ffmpeg'
+    fake_ffmpeg.write_text(
+        f'#!{sys.executable}\n'
+        'import sys\n'
+        'sys.stderr.write("warning\\n" * 200_000)\n'
+        'sys.stdout.buffer.write(bytes(8000 * 2 * 3))\n'
+    )
+    fake_ffmpeg.chmod(0o755)
+    monkeypatch.setattr(audio_score, 'ffmpeg_binary', lambda: str(fake_ffmpeg))
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(audio_score.decode_frame_power, tmp_path / 'A.MP4')
+    power = future.result(timeout=30)
+    executor.shutdown()
+    # 3秒分の無音（0.05秒の窓が60個）
+    assert len(power) == 60 and (power == 0).all()
@@ -0,0 +1,100 @@
+import asyncio
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import batch_highlights
+from batch_highlights import open_queue, enqueue, expand_input_dirs, recover, pending_jobs, run_job, default_options
+
+
+def make_dirs(tmp_path, *names):
+    for name in names:
+        (tmp_path / name).mkdir(parents=True)
+    return tmp_path
+
+
+def test_enqueue_expands_globs_and_keeps_state(tmp_path):
+    make_dirs(tmp_path, 'trips/tokyo', 'trips/osaka', 'other/tokyo')
+    conn = open_queue(tmp_path / 'queue.sqlite3')
+    input_dirs = expand_input_dirs([str(tmp_path / 'trips/*'), str(tmp_path / 'other/tokyo')])
+    assert enqueue(conn, input_dirs, tmp_path / 'out') == 3
+    assert enqueue(conn, input_dirs, tmp_path / 'out') == 0
+    outputs = sorted(row['output_file'] for row in conn.execute('SELECT output_file FROM jobs'))
+    # 同じディレクトリ名は出力ファイル名が重ならないようにする
+    assert len(set(outputs)) == 3
+    assert all(job['stage'] == 'probe' for job in pending_jobs(conn))
+
+
+def run_jobs(conn, options):
+    async def run_all():
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            return await asyncio.gather(*(run_job(conn, pool, None, job, options) for job in pending_jobs(conn)))
+    return asyncio.run(run_all())
+
+
+def test_resume_from_failed_stage(tmp_path, monkeypatch):
+    make_dirs(tmp_path, 'trips/tokyo', 'trips/osaka')
+    conn = open_queue(tmp_path / 'queue.sqlite3')
+    enqueue(conn, expand_input_dirs([str(tmp_path / 'trips/*')]), tmp_path / 'out')
+    calls = []
+    fail = {'osaka'}
+
+    def fake_cpu_stage(stage, input_dir, output_file, options):
+        calls.append((stage, input_dir.rsplit('/', 1)[-1]))
+        if stage == 'render' and input_dir.endswith(tuple(fail)):
+            raise RuntimeError('フォントがありません')
+
+    async def fake_analysis(input_dir, output_file, client, options):
+        calls.append(('analysis', input_dir.rsplit('/', 1)[-1]))
+
+    monkeypatch.setattr(batch_highlights, 'run_cpu_stage', fake_cpu_stage)
+    monkeypatch.setattr(batch_highlights, 'run_analysis_stage', fake_analysis)
+
+    assert sorted(run_jobs(conn, default_options())) == [False, True]
+    rows = {row['input_dir'].rsplit('/', 1)[-1]: dict(row) for row in conn.execute('SELECT * FROM jobs')}
+    assert (rows['tokyo']['stage'], rows['tokyo']['status']) == ('done', 'done')
+    assert (rows['osaka']['stage'], rows['osaka']['status']) == ('render', 'failed')
+    assert 'フォント' in rows['osaka']['error']
+
+    # 失敗したジョブだけを失敗したステージから再実行する
+    calls.clear()
+    fail.clear()
+    assert recover(conn) == 0
+    assert recover(conn, retry_failed=True) == 1
+    assert run_jobs(conn, default_options()) == [True]
+    assert calls == [('render', 'osaka')]
+
+
+def test_interrupted_job_resumes_at_running_stage(tmp_path):
+    make_dirs(tmp_path, 'trips/tokyo')
+    conn = open_queue(tmp_path / 'queue.sqlite3')
+    enqueue(conn, [str(tmp_path / 'trips/tokyo')], tmp_path / 'out')
+    batch_highlights.update_job(conn, str(tmp_path / 'trips/tokyo'), 'analysis', 'running')
+    assert pending_jobs(conn) == []
+    assert recover(conn) == 1
+    assert [job['stage'] for job in pending_jobs(conn)] == ['analysis']
+
+
+def test_run_batch_passes_client_options(tmp_path, monkeypatch):
+    conn = open_queue(tmp_path / 'queue.sqlite3')
+    enqueue(conn, expand_input_dirs([str(make_dirs(tmp_path, 'trip') / 'trip')]), tmp_path / 'out')
+    clients = []
+
+    class FakeClient:
+        def __init__(self, model, **options):
+            clients.append(options)
+
+    async def skip_job(conn, pool, client, job, options):
+        return job
+
+    monkeypatch.setattr(batch_highlights, 'ModelClient', FakeClient)
+    monkeypatch.setattr(batch_highlights, 'run_job', skip_job)
+    asyncio.run(batch_highlights.run_batch(conn, default_options(), request_timeout=30, max_retries=2))
+    assert clients[0]['timeout'] == 30 and clients[0]['max_retries'] == 2
+
+
+def test_cli_accepts_client_options(tmp_path):
+    result = subprocess.run([
+        sys.executable, batch_highlights.__file__, '--status', '--queue-path', str(tmp_path / 'queue.sqlite3'),
+        '--request-timeout', '30', '--max-retries', '2',
+    ], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
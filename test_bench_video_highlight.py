@@ -0,0 +1,46 @@
+import subprocess
+import sys
+from bench_video_highlight import generate_inputs, stub_highlights, measure_startup
+from media_index import scan_media
+
+
+def test_generate_inputs_is_reusable(tmp_path):
+    case = dict(files=2, seconds=1, width=64, height=48, fps=10)
+    input_dir = generate_inputs(tmp_path, case)
+    paths = sorted(input_dir.glob('*.MP4'))
+    assert [p.name for p in paths] == ['C0001.MP4', 'C0002.MP4']
+    timeline = scan_media(paths, tmp_path / 'index.sqlite3')
+    assert (timeline[0].width, timeline[0].height) == (64, 48)
+    assert all(info.has_audio for info in timeline)
+
+    # 作成済みの入力はそのまま使う
+    mtimes = [p.stat().st_mtime_ns for p in paths]
+    generate_inputs(tmp_path, case)
+    assert [p.stat().st_mtime_ns for p in paths] == mtimes
+
+
+def test_stub_highlights_stay_within_duration():
+    highlights = stub_highlights(10, count=4, seconds=3).highlights
+    assert len(highlights) == 4
+    assert all(0 <= h.start_second < h.end_second <= 10 for h in highlights)
+    assert highlights[-1].narration[0].end_second == highlights[-1].end_second
+
+
+def test_startup_does_not_load_moviepy_or_litellm():
+    # --help やキャッシュ済みの実行では重いモジュールを読み込まない
+    check = (
+        'import sys, generate_video_highlight, batch_highlights; '
+        'print(",".join(m for m in ("moviepy.editor", "litellm") if m in sys.modules))'
+    )
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ''
+
+
+def test_measure_startup_from_another_directory(tmp_path, monkeypatch):
+    # リポジトリの外から起動しても、計測するコマンドはリポジトリのモジュールを読み込む
+    monkeypatch.chdir(tmp_path)
+    startup = measure_startup(repeat=1)
+    assert set(startup['commands']) == {
+        'import generate_video_highlight', 'import batch_highlights', 'generate_video_highlight.py --help'
+    }
+    assert 'moviepy.editor' not in startup['heavy_modules_loaded']
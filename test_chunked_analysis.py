@@ -0,0 +1,121 @@
+import asyncio
+import pytest
+import chunked_analysis
+from analysis_cache import AnalysisCache
+from chunked_analysis import (
+    plan_windows, shift_highlights, merge_overlapping, reduce_highlights, analyze_in_windows
+)
+from highlight_models import Narration, VideoHighlight, VideoHighlights
+
+
+def highlight(start, end, narrations=0):
+    return VideoHighlight(start_second=start, end_second=end, narration=[
+        Narration(narration=f'n{i}', start_second=start + i, end_second=start + i + 1)
+        for i in range(narrations)
+    ])
+
+
+def total(highlights):
+    return sum(h.end_second - h.start_second for h in highlights)
+
+
+def test_plan_windows_overlap_and_cover_timeline():
+    assert plan_windows(100, 200, 10) == [(0, 100)]
+    assert plan_windows(250, 100, 10) == [(0, 100), (90, 190), (180, 250)]
+
+
+def test_plan_windows_rejects_overlap_not_shorter_than_window():
+    for window_seconds, overlap_seconds in [(60, 60), (60, 90), (0, 0), (60, -1)]:
+        with pytest.raises(ValueError):
+            plan_windows(250, window_seconds, overlap_seconds)
+
+
+def test_analyze_in_windows_limits_windows_in_flight(tmp_path, monkeypatch):
+    proxy = tmp_path / 'proxy.mp4'
+    proxy.write_bytes(b'proxy')
+    active = []
+    peak = []
+
+    def fake_cut(proxy_path, start, end, output_path):
+        active.append(start)
+        peak.append(len(active))
+        output_path.write_bytes(b'window')
+        return output_path
+
+    class FakeClient:
+        model = 'fake'
+        concurrency = 2
+
+        async def request_highlights(self, prompt, media_part):
+            await asyncio.sleep(0.01)
+            active.pop()
+            return VideoHighlights(highlights=[])
+
+    monkeypatch.setattr(chunked_analysis, 'cut_window', fake_cut)
+    cache = AnalysisCache(tmp_path / 'cache')
+    analyze_in_windows(proxy, 1000, 30, cache, window_seconds=100, overlap_seconds=10, client=FakeClient())
+    # 切り出しからリクエストの完了まで、同時に処理する区間はクライアントの同時実行数まで
+    assert len(peak) == 11 and max(peak) == 2
+
+
+def test_shift_highlights_to_global_time():
+    shifted = shift_highlights([highlight(5, 15, narrations=2), highlight(50, 60)], offset=100, window_end=110)
+    assert [(h.start_second, h.end_second) for h in shifted] == [(105, 110)]
+    assert [(n.start_second, n.end_second) for n in shifted[0].narration] == [(105, 106), (106, 107)]
+
+
+def test_merge_overlapping_keeps_longer_duplicate():
+    merged = merge_overlapping([highlight(100, 108), highlight(101, 110), highlight(200, 205)])
+    assert [(h.start_second, h.end_second) for h in merged] == [(101, 110), (200, 205)]
+
+
+def test_merge_overlapping_trims_small_overlaps():
+    merged = merge_overlapping([highlight(100, 110), highlight(108, 120, narrations=3)])
+    # 重なりが半分未満でも、後ろのハイライトの頭を切って重ならないようにする
+    assert [(h.start_second, h.end_second) for h in merged] == [(100, 110), (110, 120)]
+    assert [(n.start_second, n.end_second) for n in merged[1].narration] == [(110, 111)]
+
+    # 長い方に入れ替えた場合も、前のハイライトとは重ならない
+    merged = merge_overlapping([highlight(0, 10), highlight(8, 20), highlight(9, 25)])
+    assert [(h.start_second, h.end_second) for h in merged] == [(0, 10), (10, 25)]
+
+
+def test_reduce_fits_target_budget():
+    candidates = [highlight(0, 10), highlight(20, 30, narrations=2), highlight(40, 50, narrations=1)]
+    reduced = reduce_highlights(candidates, target_seconds=25)
+    assert total(reduced) == 25
+    # ナレーションの多い順に選ばれ、時系列順に並ぶ
+    assert [(h.start_second, h.end_second) for h in reduced] == [(0, 5), (20, 30), (40, 50)]
+
+
+def test_reduce_skips_too_short_remainder():
+    reduced = reduce_highlights([highlight(0, 10), highlight(20, 30)], target_seconds=12)
+    assert [(h.start_second, h.end_second) for h in reduced] == [(0, 10)]
+
+
+def test_analyze_in_windows_merges_windows(tmp_path, monkeypatch):
+    proxy = tmp_path / 'proxy.mp4'
+    proxy.write_bytes(b'proxy')
+    requests = []
+
+    def fake_cut(proxy_path, start, end, output_path):
+        output_path.write_bytes(f'{start}-{end}'.encode())
+        return output_path
+
+    class FakeClient:
+        model = 'fake'
+
+        async def request_highlights(self, prompt, media_part):
+            requests.append(prompt)
+            # どの区間でも先頭から10秒後の区間を選ぶ
+            return VideoHighlights(highlights=[highlight(10, 20, narrations=1)])
+
+    monkeypatch.setattr(chunked_analysis, 'cut_window', fake_cut)
+    cache = AnalysisCache(tmp_path / 'cache')
+    result = analyze_in_windows(proxy, 250, 30, cache, window_seconds=100, overlap_seconds=10, client=FakeClient())
+    assert [(h.start_second, h.end_second) for h in result.highlights] == [(10, 20), (100, 110), (190, 200)]
+    assert len(requests) == 3
+
+    # 2回目は区間ごとのキャッシュを使う
+    analyze_in_windows(proxy, 250, 30, cache, window_seconds=100, overlap_seconds=10, client=FakeClient())
+    assert len(requests) == 3
@@ -0,0 +1,68 @@
+import numpy as np
+from analysis_cache import AnalysisCache
+from contact_sheet import scene_frames, tile_sheet, build_contact_sheets, analyze_contact_sheets
+from ffmpeg_utils import run_ffmpeg
+from frame_cache import FrameCache
+from highlight_models import VideoHighlight, VideoHighlights
+from media_index import scan_media
+
+
+def test_scene_frames_picks_sharpest_frame_per_scene():
+    scores = dict(
+        blur=[10, 50, 20, 30, 90, 40, 5, 60],
+        exposure=[128] * 8,
+        cut=[0, 0, 0, 1, 0, 0, 0, 0],
+    )
+    assert scene_frames(scores, sample_fps=1, max_scene_seconds=100) == [1, 4]
+    # 長いシーンは一定の秒数ごとに代表フレームを選ぶ
+    assert scene_frames(scores, sample_fps=1, max_scene_seconds=3) == [1, 4, 7]
+
+
+def test_scene_frames_skips_dark_frames_and_dropped_spans():
+    scores = dict(blur=[90, 10, 20, 30], exposure=[5, 128, 128, 128], cut=[0, 0, 0, 0])
+    assert scene_frames(scores, sample_fps=1, max_scene_seconds=100) == [3]
+    assert scene_frames(scores, sample_fps=1, spans=[[0, 3]], max_scene_seconds=100) == [2]
+
+
+def test_tile_sheet_layout():
+    tiles = [(i * 10, np.full((36, 64, 3), i * 40, dtype=np.uint8)) for i in range(5)]
+    sheet = tile_sheet(tiles, columns=4)
+    assert sheet.size == (256, 72)
+
+
+def test_analyze_contact_sheets(tmp_path):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    for name, source in [('A.MP4', 'testsrc2'), ('B.MP4', 'smptebars')]:
+        run_ffmpeg(['-f', 'lavfi', '-i', f'{source}=s=320x180:r=30:d=3', '-pix_fmt', 'yuv420p', video_dir / name])
+    timeline = scan_media(sorted(video_dir.glob('*.MP4')), tmp_path / 'index.sqlite3')
+
+    frame_cache = FrameCache(tmp_path / 'frames', tmp_path / 'index.sqlite3')
+    sheets = build_contact_sheets(timeline, cache_dir=tmp_path / 'scores', frame_cache=frame_cache)
+    assert len(sheets) == 1
+
+    requests = []
+
+    class FakeClient:
+        model = 'fake'
+
+        async def request_highlights(self, prompt, media_part):
+            requests.append((prompt, media_part))
+            return VideoHighlights(highlights=[VideoHighlight(start_second=1, end_second=4, narration=[])])
+
+    cache = AnalysisCache(tmp_path / 'analysis')
+    highlights = analyze_contact_sheets(
+        timeline, 'prompt', cache, tmp_path / 'sheets', scores_cache_dir=tmp_path / 'scores', client=FakeClient(),
+        frame_cache=frame_cache
+    )
+    assert highlights.highlights[0].end_second == 4
+    prompt, parts = requests[0]
+    assert 'コンタクトシート' in prompt
+    assert len(parts) == 1 and parts[0].startswith('data:image/jpeg;base64,')
+    assert len(list((tmp_path / 'sheets').glob('sheet_*.jpg'))) == 1
+
+    # 同じシートなら解析結果を再利用する
+    analyze_contact_sheets(
+        timeline, 'prompt', cache, scores_cache_dir=tmp_path / 'scores', client=FakeClient(), frame_cache=frame_cache
+    )
+    assert len(requests) == 1
@@ -0,0 +1,58 @@
+import numpy as np
+import decoder_pool
+from decoder_pool import DecoderPool, split_on_timeline, pooled_subclip, DEFAULT_FPS
+from media_index import MediaInfo
+
+
+class FakeClip:
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_timeline(durations):
+    timeline = []
+    offset = 0
+    for i, duration in enumerate(durations):
+        timeline.append(MediaInfo(path=f'{i}.MP4', size=1, mtime_ns=1, duration=duration, offset=offset))
+        offset += duration
+    return timeline
+
+
+def test_split_on_timeline_maps_to_source_offsets():
+    timeline = make_timeline([10, 5, 20])
+    pieces = split_on_timeline(timeline, 8, 17)
+    assert [(info.path, start, end) for info, start, end in pieces] == [
+        ('0.MP4', 8, 10), ('1.MP4', 0, 5), ('2.MP4', 0, 2)
+    ]
+    assert split_on_timeline(timeline, 40, 50) == []
+
+
+def test_pool_closes_least_recently_used(monkeypatch):
+    monkeypatch.setattr(decoder_pool, 'open_clip', FakeClip)
+    pool = DecoderPool(max_open=2)
+    a = pool.get('a')
+    b = pool.get('b')
+    assert pool.get('a') is a
+    c = pool.get('c')
+    assert b.closed and not a.closed and not c.closed
+    # 閉じたファイルは必要になった時に開き直す
+    assert pool.get('b') is not b
+    pool.close()
+    assert a.closed or c.closed
+
+
+def test_pooled_subclip_without_fps_uses_default():
+    class FramePool:
+        def get(self, path):
+            return FramePool()
+
+        def get_frame(self, t):
+            return np.zeros((4, 4, 3), dtype=np.uint8)
+
+    info = make_timeline([10])[0]
+    assert info.fps is None
+    assert pooled_subclip(FramePool(), info, 2, 3).fps == DEFAULT_FPS
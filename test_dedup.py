@@ -0,0 +1,76 @@
+import json
+import numpy as np
+import dedup
+from dedup import phash_frames, match_matrix, group_duplicates, find_duplicates, drop_duplicates, save_dedup_map
+from ffmpeg_utils import run_ffmpeg
+from frame_cache import FrameCache
+from media_index import scan_media
+
+
+def test_phash_tolerates_scale_and_brightness():
+    rng = np.random.default_rng(0)
+    scene = rng.integers(0, 256, size=(9, 16)).repeat(10, axis=0).repeat(10, axis=1).astype(np.float32)
+    other = rng.integers(0, 256, size=(9, 16)).repeat(10, axis=0).repeat(10, axis=1).astype(np.float32)
+    retake = np.clip(scene * 0.9 + 20 + rng.normal(0, 5, scene.shape), 0, 255)
+    hashes = phash_frames(np.stack([scene, retake, other]))
+    assert hashes.dtype == np.uint64
+    distance = np.bitwise_count(hashes[:, None] ^ hashes[None, :])
+    assert distance[0, 1] <= 4
+    assert distance[0, 2] > 16
+
+
+def test_group_keeps_clips_not_covered_by_representative():
+    hashes = [
+        np.array([0, 1, 2, 3], dtype=np.uint64),
+        np.array([0, 3], dtype=np.uint64),
+        # 代表の場面を全て含むが、大半は別の内容
+        np.array([0, 1, 2, 3, 2**64 - 1, 2**64 - 2**32, 2**32 - 1, 2**48 - 1, 2**64 - 2**16], dtype=np.uint64),
+    ]
+    matrix = match_matrix(hashes, max_distance=1)
+    assert matrix[1, 0] == 1.0
+    assert matrix[0, 2] == 1.0 and matrix[2, 0] < 0.5
+    groups = group_duplicates(matrix, [(100, 1, 4), (50, 1, 2), (90, 1, 9)])
+    assert groups == [(0, [(1, 1.0)])]
+
+
+def test_match_matrix_chunks_both_sides(monkeypatch):
+    rng = np.random.default_rng(0)
+    hashes = [rng.integers(0, 2**63, size=n, dtype=np.uint64) for n in (5, 0, 3, 7)]
+    hashes[2][:2] = hashes[0][:2] ^ 1
+    hashes[3][:5] = hashes[0]
+    expected = match_matrix(hashes, max_distance=1)
+    # 区切りがクリップの途中にかかっても同じ結果
+    monkeypatch.setattr(dedup, 'SEARCH_CHUNK', 2)
+    np.testing.assert_array_equal(match_matrix(hashes, max_distance=1), expected)
+    assert expected[0, 3] == 1.0 and expected[2, 0] == 2 / 3 and expected[3, 0] == 5 / 7
+
+
+def test_find_duplicates_collapses_retakes(tmp_path):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=s=320x180:r=30:d=4', '-pix_fmt', 'yuv420p', video_dir / 'A.MP4'])
+    # 低い解像度・明るさ違いの撮り直し
+    run_ffmpeg(['-i', video_dir / 'A.MP4', '-vf', 'scale=160:90,eq=brightness=0.05', '-t', '3', video_dir / 'B.MP4'])
+    run_ffmpeg(['-f', 'lavfi', '-i', 'smptebars=s=320x180:r=30:d=4', '-pix_fmt', 'yuv420p', video_dir / 'C.MP4'])
+    timeline = scan_media(sorted(video_dir.glob('*.MP4')), tmp_path / 'index.sqlite3')
+    a, b, c = (info.path for info in timeline)
+
+    frame_cache = FrameCache(tmp_path / 'frames', tmp_path / 'index.sqlite3')
+    groups = find_duplicates(timeline, frame_cache=frame_cache, scores_cache_dir=tmp_path / 'scores')
+    assert [group['representative'] for group in groups] == [a]
+    assert [duplicate['path'] for duplicate in groups[0]['duplicates']] == [b]
+
+    # 事前フィルタで代表の区間が全て除かれた場合は、撮り直しの方を残す
+    file_spans = [[], [[0.0, 3.0]], [[0.0, 4.0]]]
+    assert find_duplicates(
+        timeline, frame_cache=frame_cache, scores_cache_dir=tmp_path / 'scores', file_spans=file_spans
+    ) == []
+
+    assert drop_duplicates(timeline, None, groups) == [[[0.0, 4.0]], [], [[0.0, 4.0]]]
+    assert drop_duplicates(timeline, [[[1, 2]], [[0, 1]], []], groups) == [[[1, 2]], [], []]
+
+    # 除いたファイルは代表と元のタイムライン上の位置から辿れる
+    saved = json.loads(save_dedup_map(tmp_path / 'trip.mp4', timeline, groups).read_text())
+    assert saved[0]['representative_timeline'] == [0.0, 4.0]
+    assert saved[0]['duplicates'][0]['path'] == b
+    assert saved[0]['duplicates'][0]['timeline'] == [4.0, 7.0]
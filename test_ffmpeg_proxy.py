@@ -0,0 +1,124 @@
+import re
+import shutil
+import numpy as np
+import pytest
+import ffmpeg_proxy
+import generate_video_highlight
+import timestamp_overlay
+from ffmpeg_proxy import ffmpeg_color, proxy_command, proxy_size, timestamp_drawtext
+from ffmpeg_utils import run_ffmpeg
+from media_index import scan_media
+from proxy_cache import ProxyCache
+from proxy_planner import ProxyPlan
+from timestamp_overlay import GlyphAtlas, TIMESTAMP_GLYPHS
+
+
+@pytest.fixture
+def timeline(tmp_path):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    for name, source, audio in [('A.MP4', 'testsrc2=s=160x90', True), ('B.MP4', 'smptebars=s=120x120', False),
+                                ('C.MP4', 'testsrc=s=160x90', True)]:
+        args = ['-f', 'lavfi', '-i', f'{source}:r=10:d=2']
+        if audio:
+            args += ['-f', 'lavfi', '-i', 'sine=d=2', '-shortest']
+        run_ffmpeg([*args, '-pix_fmt', 'yuv420p', video_dir / name])
+    return scan_media(sorted(video_dir.glob('*.MP4')), tmp_path / 'index.sqlite3')
+
+
+def probe(video_path):
+    result = run_ffmpeg(['-i', video_path, '-f', 'null', '-'], loglevel='info')
+    return dict(
+        frames=int(re.findall(r'frame=\s*(\d+)', result.stderr)[-1]),
+        size=re.search(r'Video: .*?, (\d+x\d+)', result.stderr).group(1),
+        audio='Audio:' in result.stderr,
+    )
+
+
+def test_drawtext_style():
+    assert ffmpeg_color('rgba(0,0,0,0.7)') == '0x000000@0.7'
+    assert ffmpeg_color('white') == 'white'
+    drawtext = timestamp_drawtext("/fonts/it's.ttc", fontsize=24)
+    assert "fontfile='/fonts/it'\\''s.ttc'" in drawtext
+    assert "text='%{eif\\:floor(t+0.5)\\:d}秒'" in drawtext
+    assert 'boxcolor=0x000000@0.7' in drawtext
+
+
+def test_proxy_command_joins_scales_and_trims(timeline, tmp_path):
+    size = proxy_size(timeline, 46)
+    assert size == (82, 46)
+    output_path = tmp_path / 'proxy.mp4'
+    # 1本目は 0.5〜1.5秒だけ、2本目（音声なし・縦横比違い）は全体、3本目は除外
+    run_ffmpeg(proxy_command(
+        timeline, output_path, size, 5, '100k', '32k', file_spans=[[(0.5, 1.5)], None, []]
+    ))
+    assert probe(output_path) == dict(frames=15, size='82x46', audio=True)
+
+
+def test_falls_back_without_drawtext(timeline, tmp_path, monkeypatch):
+    monkeypatch.setattr(ffmpeg_proxy, 'available_filters', lambda: {'concat', 'scale', 'fps'})
+    plan = ProxyPlan(fps=5, height=46, video_bitrate=100_000, tokens=0)
+    assert not generate_video_highlight.encode_ffmpeg_proxy(timeline, str(tmp_path / 'proxy.mp4'), plan)
+
+
+def test_proxy_cache_is_keyed_by_engine(timeline, tmp_path, monkeypatch):
+    monkeypatch.setattr(ffmpeg_proxy, 'available_filters', lambda: {'concat', 'scale', 'fps'})
+    # ImageMagick がなくても動くよう、グリフは単色の矩形にする
+    glyphs = {char: (np.full((4, 2, 3), 255, dtype=np.uint8), np.ones((4, 2), dtype=np.float32))
+              for char in TIMESTAMP_GLYPHS}
+    monkeypatch.setattr(timestamp_overlay, 'build_glyph_atlas', lambda **style: GlyphAtlas(glyphs))
+    cache = ProxyCache(tmp_path / 'cache')
+
+    def merge(proxy_engine, name):
+        merged_path, _, _ = generate_video_highlight.merge_videos_with_timestamp(
+            tmp_path / 'trip', str(tmp_path / name), cache=cache, index_path=tmp_path / 'index.sqlite3',
+            target_size=2 * 1024 * 1024, proxy_engine=proxy_engine
+        )
+        assert merged_path is not None
+
+    merge('moviepy', 'moviepy.mp4')
+    # drawtext がなければ ffmpeg を指定しても MoviePy で書き出すので、MoviePy の結果としてキャッシュを共有する
+    merge('ffmpeg', 'missing.mp4')
+    assert len(list(cache.cache_dir.glob('*.mp4'))) == 1
+
+    # ffmpeg での書き出しが途中で失敗した場合も、MoviePy の結果としてキャッシュする
+    monkeypatch.setattr(ffmpeg_proxy, 'available_filters', lambda: {'concat', 'scale', 'fps', 'drawtext'})
+    monkeypatch.setattr(generate_video_highlight, 'find_narration_font', lambda font=None: __file__)
+
+    def fail(*args):
+        raise RuntimeError('ffmpegの実行に失敗しました')
+
+    monkeypatch.setattr(ffmpeg_proxy, 'encode_proxy', fail)
+    merge('ffmpeg', 'failed.mp4')
+    assert len(list(cache.cache_dir.glob('*.mp4'))) == 1
+
+    # ffmpeg で書き出せた場合だけ別のキャッシュにする
+    monkeypatch.setattr(ffmpeg_proxy, 'encode_proxy', lambda timeline, output_path, *args: shutil.copyfile(
+        tmp_path / 'moviepy.mp4', output_path
+    ))
+    merge('ffmpeg', 'ffmpeg.mp4')
+    assert len(list(cache.cache_dir.glob('*.mp4'))) == 2
+
+
+def first_frame(video_path, tmp_path):
+    raw_path = tmp_path / f'{video_path.stem}.gray'
+    run_ffmpeg(['-i', video_path, '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'gray', raw_path])
+    return raw_path.read_bytes()
+
+
+def test_drawtext_proxy_burns_timestamp(timeline, tmp_path):
+    if 'drawtext' not in ffmpeg_proxy.available_filters():
+        pytest.skip('ffmpeg に drawtext フィルタがありません')
+    font = generate_video_highlight.find_narration_font()
+    if font is None:
+        pytest.skip('秒数テキストのフォントがありません')
+    plan = ProxyPlan(fps=5, height=46, video_bitrate=100_000, audio_bitrate=32_000, tokens=0)
+    spans = [[(0.5, 1.5)], None, []]
+    output_path = tmp_path / 'proxy.mp4'
+    assert generate_video_highlight.encode_ffmpeg_proxy(timeline, str(output_path), plan, spans, font)
+    assert probe(output_path) == dict(frames=15, size='82x46', audio=True)
+
+    # 秒数テキストのない書き出しとは画が違う
+    plain_path = tmp_path / 'plain.mp4'
+    run_ffmpeg(proxy_command(timeline, plain_path, (82, 46), 5, '100k', '32k', file_spans=spans))
+    assert first_frame(output_path, tmp_path) != first_frame(plain_path, tmp_path)
@@ -0,0 +1,82 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from file_upload import upload_file
+
+
+class FakeFilesAPI(BaseHTTPRequestHandler):
+    """Files API の resumable upload を模したローカルサーバー"""
+    received = bytearray()
+    fail_once_at = None
+    processing_polls = 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status=200, headers=None, body=b''):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        cls = type(self)
+        command = self.headers.get('X-Goog-Upload-Command')
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if command == 'start':
+            url = f'http://127.0.0.1:{self.server.server_port}/upload/session'
+            return self._reply(headers={'X-Goog-Upload-URL': url})
+        if command == 'query':
+            return self._reply(headers={'X-Goog-Upload-Size-Received': str(len(cls.received))})
+        offset = int(self.headers['X-Goog-Upload-Offset'])
+        if cls.fail_once_at == offset:
+            # 途中まで受け取った後にエラーを返す
+            cls.fail_once_at = None
+            cls.received[offset:] = data[:len(data) // 2]
+            return self._reply(503)
+        assert offset == len(cls.received)
+        cls.received[offset:] = data
+        if 'finalize' in command:
+            file_info = {'name': 'files/test', 'uri': 'http://fake/v1beta/files/test', 'state': 'PROCESSING'}
+            return self._reply(body=json.dumps({'file': file_info}).encode())
+        return self._reply()
+
+    def do_GET(self):
+        cls = type(self)
+        cls.processing_polls -= 1
+        state = 'PROCESSING' if cls.processing_polls > 0 else 'ACTIVE'
+        file_info = {'name': 'files/test', 'uri': 'http://fake/v1beta/files/test', 'state': state}
+        self._reply(body=json.dumps(file_info).encode())
+
+
+@pytest.fixture
+def server():
+    FakeFilesAPI.received = bytearray()
+    FakeFilesAPI.fail_once_at = None
+    FakeFilesAPI.processing_polls = 2
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeFilesAPI)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def test_upload_streams_file_in_chunks(tmp_path, server):
+    video = tmp_path / 'proxy.mp4'
+    video.write_bytes(bytes(range(256)) * 40)
+    file_info = upload_file(video, api_key='test', base_url=server, chunk_size=1024, poll_interval=0)
+    assert file_info['state'] == 'ACTIVE'
+    assert file_info['uri'] == 'http://fake/v1beta/files/test'
+    assert bytes(FakeFilesAPI.received) == video.read_bytes()
+
+
+def test_upload_resumes_from_received_offset(tmp_path, server, monkeypatch):
+    monkeypatch.setattr('file_upload.time.sleep', lambda seconds: None)
+    video = tmp_path / 'proxy.mp4'
+    video.write_bytes(bytes(range(256)) * 40)
+    FakeFilesAPI.fail_once_at = 2048
+    upload_file(video, api_key='test', base_url=server, chunk_size=1024, poll_interval=0)
+    assert bytes(FakeFilesAPI.received) == video.read_bytes()
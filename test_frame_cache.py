@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+import numpy as np
+import frame_cache
+from ffmpeg_utils import run_ffmpeg
+from frame_cache import FrameCache
+from media_index import scan_media, open_index, frame_entries
+from prefilter import sample_frames
+
+
+def make_video(video_dir, name='A.MP4', source='testsrc2'):
+    video_dir.mkdir(exist_ok=True)
+    video_path = video_dir / name
+    run_ffmpeg(['-f', 'lavfi', '-i', f'{source}=s=320x180:r=30:d=3', '-pix_fmt', 'yuv420p', video_path])
+    return video_path
+
+
+def test_decodes_once_for_all_variants(tmp_path, monkeypatch):
+    video_path = make_video(tmp_path / 'trip')
+    [info] = scan_media([video_path], tmp_path / 'index.sqlite3')
+    cache = FrameCache(tmp_path / 'frames', tmp_path / 'index.sqlite3')
+
+    decodes = []
+    decode = frame_cache.decode_thumbnails
+
+    def counting_decode(info, store_paths, sample_fps):
+        decodes.append(sorted(store_paths))
+        return decode(info, store_paths, sample_fps)
+
+    monkeypatch.setattr(frame_cache, 'decode_thumbnails', counting_decode)
+    cache.ensure_all([info], ('gray', 'rgb'))
+    gray = cache.frames(info, 'gray')
+    rgb = cache.frames(info, 'rgb')
+    assert decodes == [['gray', 'rgb']]
+    assert isinstance(gray, np.memmap) and not gray.flags.writeable
+    # rgb はコンタクトシート用に間引いて小さく保存する
+    assert gray.shape == (6, 90, 160) and rgb.shape == (3, 144, 256, 3)
+    # 直接デコードした場合と同じフレーム
+    np.testing.assert_array_equal(gray, sample_frames(video_path, 320, 180))
+
+    # 別のインスタンス（別のプロセス）からもデコードせずに読める
+    FrameCache(tmp_path / 'frames', tmp_path / 'index.sqlite3').frames(info, 'rgb')
+    assert len(decodes) == 1
+    # 保存先は縮小フレームだけ（作業用のファイルは残らない）
+    assert sorted(path.suffix for path in (tmp_path / 'frames').iterdir()) == ['.raw', '.raw']
+
+
+def test_changed_source_is_decoded_again(tmp_path):
+    video_path = make_video(tmp_path / 'trip')
+    [info] = scan_media([video_path], tmp_path / 'index.sqlite3')
+    cache = FrameCache(tmp_path / 'frames', tmp_path / 'index.sqlite3')
+    old_store = cache.ensure(info)['gray']
+
+    make_video(tmp_path / 'trip', source='smptebars')
+    os.utime(video_path, ns=(info.mtime_ns + 10**9, info.mtime_ns + 10**9))
+    [info] = scan_media([video_path], tmp_path / 'index.sqlite3')
+    frames = cache.frames(info)
+    assert cache.ensure(info)['gray'] != old_store
+    assert not os.path.exists(old_store)
+    np.testing.assert_array_equal(frames, sample_frames(video_path, 320, 180))
+
+
+def test_evicts_least_recently_used_and_deleted_sources(tmp_path):
+    video_dir = tmp_path / 'trip'
+    paths = [make_video(video_dir, name) for name in ('A.MP4', 'B.MP4', 'C.MP4')]
+    timeline = scan_media(paths, tmp_path / 'index.sqlite3')
+    frame_bytes = 6 * 90 * 160
+    cache = FrameCache(tmp_path / 'frames', tmp_path / 'index.sqlite3', max_bytes=2 * frame_bytes)
+    stores = [cache.ensure(info)['gray'] for info in timeline[:2]]
+    # A を使い直してから C を足すと、最後に使われたのが古い B が消える
+    os.utime(stores[0], ns=(1, 1))
+    os.utime(stores[1], ns=(1, 1))
+    cache.ensure(timeline[0])
+    stores.append(cache.ensure(timeline[2])['gray'])
+    assert [os.path.exists(path) for path in stores] == [True, False, True]
+
+    # 元動画が消えたファイルの縮小フレームは容量に関係なく消す
+    os.remove(paths[0])
+    cache.ensure(timeline[1])
+    assert [os.path.exists(path) for path in stores] == [False, True, True]
+    conn = open_index(tmp_path / 'index.sqlite3')
+    assert sorted(Path(path).name for path, _ in frame_entries(conn)) == ['B.MP4', 'C.MP4']
+    conn.close()
@@ -0,0 +1,46 @@
+import json
+import instrumentation
+from instrumentation import Recorder, prometheus_text, write_json_report, measure, start_run
+
+
+def test_stage_accumulates_time_and_throughput():
+    recorder = Recorder()
+    for _ in range(2):
+        with recorder.stage('render', frames=30) as counters:
+            counters['bytes'] += 1000
+    recorder.add('model_request', 2.0)
+    report = recorder.report()
+    render = report['stages']['render']
+    assert render['calls'] == 2
+    assert render['frames'] == 60 and render['bytes'] == 2000
+    assert render['frames_per_second'] == render['frames'] / render['seconds']
+    assert report['stages']['model_request']['max_seconds'] == 2.0
+    assert report['peak_rss_bytes'] > 0
+
+
+def test_stage_is_recorded_even_on_error():
+    recorder = Recorder()
+    try:
+        with recorder.stage('proxy_encode'):
+            raise RuntimeError('ffmpeg')
+    except RuntimeError:
+        pass
+    assert recorder.report()['stages']['proxy_encode']['calls'] == 1
+
+
+def test_reports(tmp_path):
+    recorder = start_run(profile_stages=['overlay'])
+    with measure('overlay', frames=10):
+        sum(range(1000))
+    assert instrumentation.current_recorder() is recorder
+    report = recorder.report()
+
+    path = write_json_report(report, tmp_path / 'trip.metrics.json')
+    assert json.loads(path.read_text())['stages']['overlay']['frames'] == 10
+
+    text = prometheus_text(report, labels=dict(output='tr"ip'))
+    assert '# TYPE video_highlight_stage_seconds gauge' in text
+    assert 'video_highlight_stage_frames{output="tr\\"ip",stage="overlay"} 10' in text
+
+    profiles = recorder.dump_profiles(tmp_path / 'trip')
+    assert [p.name for p in profiles] == ['trip.overlay.prof']
@@ -0,0 +1,36 @@
+import media_index
+from ffmpeg_utils import run_ffmpeg
+from media_index import scan_media
+
+
+def make_video(path, duration=2, audio=True):
+    args = ['-f', 'lavfi', '-i', f'testsrc2=size=160x120:rate=10:duration={duration}']
+    if audio:
+        args += ['-f', 'lavfi', '-i', f'sine=duration={duration}', '-c:a', 'aac']
+    run_ffmpeg(args + ['-c:v', 'libx264', '-shortest', path])
+    return path
+
+
+def test_scan_builds_timeline_and_reuses_index(tmp_path, monkeypatch):
+    files = [make_video(tmp_path / 'A.MP4'), make_video(tmp_path / 'B.MP4', audio=False)]
+    index_path = tmp_path / 'index.sqlite3'
+    timeline = scan_media(files, index_path)
+    assert [info.offset for info in timeline] == [0, timeline[0].duration]
+    assert (timeline[0].codec, timeline[0].profile, timeline[0].pix_fmt) == ('h264', 'High', 'yuv420p')
+    assert (timeline[0].width, timeline[0].height, timeline[0].fps) == (160, 120, 10)
+    assert timeline[0].has_audio and not timeline[1].has_audio
+
+    # 2回目はインデックスの結果を使い、ffmpegを呼ばない
+    def fail(video_path):
+        raise AssertionError('probe_media should not be called')
+    monkeypatch.setattr(media_index, 'probe_media', fail)
+    assert scan_media(files, index_path) == timeline
+
+
+def test_changed_file_is_probed_again(tmp_path):
+    video = make_video(tmp_path / 'A.MP4', duration=2)
+    index_path = tmp_path / 'index.sqlite3'
+    first = scan_media([video], index_path)
+    make_video(video, duration=3)
+    second = scan_media([video], index_path)
+    assert second[0].duration > first[0].duration
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import litellm
+import pytest
+import model_client
+from model_client import ModelClient, TokenBucket
+
+HIGHLIGHTS = {'highlights': [{'start_second': 1, 'end_second': 5, 'narration': []}]}
+
+
+class FakeCompletionAPI(BaseHTTPRequestHandler):
+    """OpenAI 互換の chat completions を模したローカルサーバー"""
+    statuses = []
+    requests = 0
+    in_flight = 0
+    max_in_flight = 0
+    delay = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        cls = type(self)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with cls.lock:
+            cls.requests += 1
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            status = cls.statuses.pop(0) if cls.statuses else 200
+        time.sleep(cls.delay)
+        if status == 200:
+            body = json.dumps({
+                'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': 'fake',
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': json.dumps(HIGHLIGHTS)}}],
+                'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+            }).encode()
+        else:
+            body = json.dumps({'error': {'message': 'fake error', 'type': 'error', 'code': status}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with cls.lock:
+            cls.in_flight -= 1
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(model_client, 'backoff_delay', lambda attempt: 0)
+    FakeCompletionAPI.statuses = []
+    FakeCompletionAPI.requests = 0
+    FakeCompletionAPI.in_flight = 0
+    FakeCompletionAPI.max_in_flight = 0
+    FakeCompletionAPI.delay = 0
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeCompletionAPI)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}/v1'
+    httpd.shutdown()
+
+
+def make_client(api_base, **options):
+    options.setdefault('requests_per_minute', 6000)
+    return ModelClient('openai/fake', api_base=api_base, api_key='test', **options)
+
+
+def test_request_highlights(server):
+    client = make_client(server)
+    highlights = asyncio.run(client.request_highlights('prompt', 'data:video/mp4;base64,AA=='))
+    assert highlights.highlights[0].end_second == 5
+
+
+def test_retries_rate_limit_and_server_errors(server):
+    FakeCompletionAPI.statuses = [429, 503]
+    client = make_client(server, max_retries=2)
+    asyncio.run(client.request_highlights('prompt', 'data:video/mp4;base64,AA=='))
+    assert FakeCompletionAPI.requests == 3
+
+
+def test_gives_up_after_max_retries(server):
+    FakeCompletionAPI.statuses = [429, 429]
+    client = make_client(server, max_retries=1)
+    with pytest.raises(litellm.RateLimitError):
+        asyncio.run(client.request_highlights('prompt', 'data:video/mp4;base64,AA=='))
+    assert FakeCompletionAPI.requests == 2
+
+
+def test_does_not_retry_bad_request(server):
+    FakeCompletionAPI.statuses = [400]
+    client = make_client(server, max_retries=3)
+    with pytest.raises(litellm.BadRequestError):
+        asyncio.run(client.request_highlights('prompt', 'data:video/mp4;base64,AA=='))
+    assert FakeCompletionAPI.requests == 1
+
+
+def test_timeout_is_retried(server):
+    FakeCompletionAPI.delay = 0.5
+    client = make_client(server, max_retries=1, timeout=0.1)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.request_highlights('prompt', 'data:video/mp4;base64,AA=='))
+    assert FakeCompletionAPI.requests == 2
+
+
+def test_concurrency_cap(server):
+    FakeCompletionAPI.delay = 0.2
+    client = make_client(server, concurrency=2)
+
+    async def run_all():
+        await asyncio.gather(*(client.request_highlights('prompt', 'x') for _ in range(6)))
+
+    asyncio.run(run_all())
+    assert FakeCompletionAPI.requests == 6
+    assert FakeCompletionAPI.max_in_flight == 2
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+
+    async def take(n):
+        start = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # 1個目はすぐ、残り4個は 1/20 秒ずつ待つ
+    assert asyncio.run(take(5)) >= 0.18
@@ -0,0 +1,165 @@
+import os
+import re
+import pytest
+import generate_video_highlight
+from ffmpeg_utils import run_ffmpeg
+from highlight_models import Narration, VideoHighlight, VideoHighlights
+from media_index import MediaInfo, scan_media
+from pipeline_state import PipelineState, stage_fingerprint
+
+
+def test_stage_completes_only_with_same_fingerprint_and_artifacts(tmp_path):
+    output_file = tmp_path / 'trip.mp4'
+    output_file.write_bytes(b'proxy')
+    state = PipelineState(output_file)
+    fingerprint = stage_fingerprint([['a.mp4', 1, 1]], dict(prefilter=False))
+    state.complete('proxy', fingerprint, [output_file])
+
+    state = PipelineState(output_file)
+    assert state.is_complete('proxy', fingerprint)
+    assert not state.is_complete('proxy', stage_fingerprint([['a.mp4', 1, 1]], dict(prefilter=True)))
+    # 書き出し途中で止まった・上書きされた成果物は使わない
+    output_file.write_bytes(b'broken')
+    assert not state.is_complete('proxy', fingerprint)
+
+
+def test_invalidate_clears_later_stages(tmp_path):
+    artifact = tmp_path / 'trip.json'
+    artifact.write_text('{}')
+    state = PipelineState(tmp_path / 'trip.mp4')
+    for stage in ('proxy', 'analysis', 'render'):
+        state.complete(stage, stage, [artifact])
+    state.invalidate('analysis')
+    assert state.is_complete('proxy', 'proxy')
+    assert not state.is_complete('analysis', 'analysis')
+    assert not state.is_complete('render', 'render')
+
+
+def make_timeline(tmp_path):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    for name, source in [('A.MP4', 'testsrc2'), ('B.MP4', 'smptebars')]:
+        run_ffmpeg([
+            '-f', 'lavfi', '-i', f'{source}=s=160x90:r=10:d=2', '-f', 'lavfi', '-i', 'sine=d=2',
+            '-pix_fmt', 'yuv420p', '-shortest', video_dir / name,
+        ])
+    return scan_media(sorted(video_dir.glob('*.MP4')), tmp_path / 'index.sqlite3')
+
+
+def decoded_frames(video_path):
+    result = run_ffmpeg(['-i', video_path, '-map', '0:v', '-f', 'null', '-'], loglevel='info')
+    return int(re.findall(r'frame=\s*(\d+)', result.stderr)[-1])
+
+
+def test_render_stage_resumes_from_written_segments(tmp_path, monkeypatch):
+    timeline = make_timeline(tmp_path)
+    highlights = VideoHighlights(highlights=[
+        VideoHighlight(start_second=0, end_second=1, narration=[Narration(narration='a', start_second=0, end_second=1)]),
+        VideoHighlight(start_second=1.5, end_second=3, narration=[]),
+    ])
+
+    rendered = []
+    render_segment = generate_video_highlight.render_highlight_segment
+
+    def counting_render(pool, timeline, highlight, *args):
+        rendered.append(highlight.start_second)
+        return render_segment(pool, timeline, highlight, *args)
+
+    monkeypatch.setattr(generate_video_highlight, 'render_highlight_segment', counting_render)
+    output_file = tmp_path / 'trip.mp4'
+    highlight_video = generate_video_highlight.render_stage(timeline, output_file, highlights, subtitles='srt')
+    assert rendered == [0, 1.5]
+    assert (tmp_path / 'trip_highlight.srt').exists()
+
+    # 完了済みなら何も書き出さない
+    assert generate_video_highlight.render_stage(timeline, output_file, highlights, subtitles='srt') == highlight_video
+    assert rendered == [0, 1.5]
+
+    # 変わったハイライトだけ書き出し直す
+    highlights.highlights[1].end_second = 3.5
+    generate_video_highlight.render_stage(timeline, output_file, highlights, subtitles='srt')
+    assert rendered == [0, 1.5, 1.5]
+    assert len(list((tmp_path / 'trip_highlight.segments').glob('*.mp4'))) == 2
+
+
+def test_parallel_render_matches_serial(tmp_path):
+    timeline = make_timeline(tmp_path)
+    highlights = VideoHighlights(highlights=[
+        VideoHighlight(start_second=0, end_second=1, narration=[]),
+        VideoHighlight(start_second=1.5, end_second=3, narration=[]),
+        VideoHighlight(start_second=3.2, end_second=4, narration=[]),
+    ])
+    serial = generate_video_highlight.render_stage(timeline, tmp_path / 'serial.mp4', highlights, subtitles='srt')
+    parallel = generate_video_highlight.render_stage(
+        timeline, tmp_path / 'parallel.mp4', highlights, subtitles='srt', render_jobs=3
+    )
+    # 並列に書き出したセグメントも同じ形式なので、無劣化で連結した結果は同じ長さになる
+    assert decoded_frames(parallel) == decoded_frames(serial) == 33
+
+
+def test_render_skips_highlights_without_frames(tmp_path):
+    timeline = make_timeline(tmp_path)
+    highlights = VideoHighlights(highlights=[
+        VideoHighlight(start_second=0, end_second=1, narration=[]),
+        # 動画の終わりちょうどから始まる区間と、長さ 0 の区間
+        VideoHighlight(start_second=4, end_second=5, narration=[]),
+        VideoHighlight(start_second=2, end_second=2, narration=[]),
+    ])
+    highlight_video = generate_video_highlight.render_stage(timeline, tmp_path / 'trip.mp4', highlights, subtitles='srt')
+    assert decoded_frames(highlight_video) == 10
+    assert len(list((tmp_path / 'trip_highlight.segments').glob('*.mp4'))) == 1
+
+
+def test_output_format_ignores_unknown_fps():
+    timeline = [
+        MediaInfo(path='a.mp4', size=1, mtime_ns=1, duration=2, fps=None, width=160, height=90),
+        MediaInfo(path='b.mp4', size=1, mtime_ns=1, duration=2, fps=25.0, width=160, height=90, offset=2),
+    ]
+    assert generate_video_highlight.output_format(timeline)['fps'] == 25.0
+    assert generate_video_highlight.output_format(timeline[:1])['fps'] == generate_video_highlight.DEFAULT_FPS
+
+
+def test_parallel_render_skips_highlights_without_frames(tmp_path):
+    timeline = make_timeline(tmp_path)
+    highlights = VideoHighlights(highlights=[
+        VideoHighlight(start_second=0, end_second=1, narration=[]),
+        VideoHighlight(start_second=3, end_second=3.5, narration=[]),
+        VideoHighlight(start_second=4, end_second=5, narration=[]),
+        VideoHighlight(start_second=3, end_second=2, narration=[]),
+    ])
+    highlight_video = generate_video_highlight.render_stage(
+        timeline, tmp_path / 'trip.mp4', highlights, subtitles='srt', render_jobs=2
+    )
+    assert decoded_frames(highlight_video) == 15
+
+
+def test_parallel_render_records_finished_segments_when_one_fails(tmp_path, monkeypatch):
+    timeline = make_timeline(tmp_path)
+    highlights = VideoHighlights(highlights=[
+        VideoHighlight(start_second=0, end_second=1, narration=[]),
+        VideoHighlight(start_second=1, end_second=1.5, narration=[]),
+        VideoHighlight(start_second=2.5, end_second=3, narration=[]),
+    ])
+    # 大きさと更新時刻はそのままで、2本目を読めないファイルにする
+    broken = tmp_path / 'trip' / 'B.MP4'
+    original = broken.read_bytes()
+    stat = broken.stat()
+    broken.write_bytes(b'\0' * len(original))
+    os.utime(broken, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    output_file = tmp_path / 'trip.mp4'
+    with pytest.raises(Exception):
+        generate_video_highlight.render_stage(timeline, output_file, highlights, subtitles='srt', render_jobs=3)
+
+    # 直した後は、失敗したセグメントだけを書き出す
+    broken.write_bytes(original)
+    os.utime(broken, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    rendered = []
+    render_segment = generate_video_highlight.render_highlight_segment
+
+    def counting_render(pool, timeline, highlight, *args):
+        rendered.append(highlight.start_second)
+        return render_segment(pool, timeline, highlight, *args)
+
+    monkeypatch.setattr(generate_video_highlight, 'render_highlight_segment', counting_render)
+    generate_video_highlight.render_stage(timeline, output_file, highlights, subtitles='srt')
+    assert rendered == [2.5]
@@ -0,0 +1,113 @@
+import numpy as np
+from analysis_cache import AnalysisCache
+from ffmpeg_utils import run_ffmpeg
+from frame_cache import FrameCache
+from highlight_models import Narration, VideoHighlight
+from media_index import probe_media, scan_media
+from prefilter import (
+    sample_frames, frame_scores, keep_mask, mask_to_spans, build_remap, to_original, remap_highlights,
+    score_media, detect_spans, SAMPLE_SETTINGS
+)
+
+SAMPLE_FPS = 2
+
+
+def scores_for(motion, exposure=128, blur=500, cut=()):
+    count = len(motion)
+    cuts = np.zeros(count)
+    cuts[list(cut)] = 1
+    return dict(motion=list(motion), exposure=[exposure] * count, blur=[blur] * count, cut=cuts.tolist())
+
+
+def test_frame_scores_detects_motion_exposure_and_cut():
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, size=(2, 36, 64), dtype=np.uint8)
+    black = np.zeros((2, 36, 64), dtype=np.uint8)
+    scores = frame_scores(np.concatenate([noise, black]))
+    assert scores['motion'][1] > 50
+    assert scores['motion'][3] == 0
+    assert scores['exposure'][3] == 0
+    assert scores['blur'][0] > scores['blur'][3] == 0
+    assert scores['cut'][2] > 0.9
+
+
+def test_static_spans_are_compressed():
+    # 4秒動き → 10秒静止 → 4秒動き
+    motion = [10] * 8 + [0] * 20 + [10] * 8
+    keep = keep_mask(scores_for(motion), SAMPLE_FPS)
+    assert mask_to_spans(keep, SAMPLE_FPS, 18) == [[0.0, 6.0], [14.0, 18.0]]
+
+
+def test_defective_frames_are_dropped():
+    scores = scores_for([10] * 10)
+    scores['exposure'][4:8] = [5] * 4
+    keep = keep_mask(scores, SAMPLE_FPS)
+    assert mask_to_spans(keep, SAMPLE_FPS, 5) == [[0.0, 2.0], [4.0, 5.0]]
+
+
+def test_scene_cut_is_kept_in_static_span():
+    motion = [10] * 4 + [0] * 30
+    keep = keep_mask(scores_for(motion, cut=[20]), SAMPLE_FPS)
+    assert mask_to_spans(keep, SAMPLE_FPS, 17) == [[0.0, 4.0], [10.0, 12.0]]
+
+
+def test_remap_splits_highlights_at_dropped_spans():
+    remap = [(0, 0, 6), (6, 14, 4), (10, 30, 5)]
+    assert to_original(7, remap) == 15
+    highlight = VideoHighlight(start_second=4, end_second=8, narration=[
+        Narration(narration='a', start_second=4, end_second=5),
+        Narration(narration='b', start_second=7, end_second=8),
+    ])
+    pieces = remap_highlights([highlight], remap)
+    assert [(h.start_second, h.end_second) for h in pieces] == [(4, 6), (14, 16)]
+    assert [(n.narration, n.start_second) for n in pieces[1].narration] == [('b', 15)]
+
+
+def test_remap_joins_spans_continuous_across_files():
+    class Info:
+        def __init__(self, offset):
+            self.offset = offset
+
+    remap = build_remap([Info(0), Info(10)], [[[5, 10]], [[0, 3]]])
+    pieces = remap_highlights([VideoHighlight(start_second=2, end_second=7, narration=[])], remap)
+    assert [(h.start_second, h.end_second) for h in pieces] == [(7, 12)]
+
+
+def test_sample_frames_from_video(tmp_path):
+    video = tmp_path / 'clip.mp4'
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=s=320x180:r=30:d=2', '-pix_fmt', 'yuv420p', video])
+    info = probe_media(video)
+    frames = sample_frames(video, info.width, info.height, sample_fps=2, sample_width=64)
+    assert frames.shape == (4, 36, 64)
+
+
+def test_frame_cache_is_used_only_for_matching_sample_settings(tmp_path, monkeypatch):
+    video = tmp_path / 'clip.mp4'
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=s=320x180:r=30:d=2', '-pix_fmt', 'yuv420p', video])
+    index_path = tmp_path / 'index.sqlite3'
+    info = scan_media([video], index_path)[0]
+    frame_cache = FrameCache(tmp_path / 'frames', index_path)
+    cache = AnalysisCache(tmp_path / 'scores')
+
+    read = []
+    frames = frame_cache.frames
+    monkeypatch.setattr(frame_cache, 'frames', lambda info, variant: read.append(variant) or frames(info, variant))
+    score_media(info, cache, SAMPLE_SETTINGS, frame_cache)
+    assert read == ['gray']
+    # 縮小フレームと違う幅・間隔では元動画から読む
+    for settings in (dict(SAMPLE_SETTINGS, width=64), dict(SAMPLE_SETTINGS, sample_fps=5)):
+        scores = score_media(info, cache, settings, frame_cache)
+        assert len(scores['motion']) == settings['sample_fps'] * 2
+    assert read == ['gray']
+
+
+def test_detect_spans_uses_given_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    video = tmp_path / 'clip.mp4'
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=s=320x180:r=30:d=2', '-pix_fmt', 'yuv420p', video])
+    index_path = tmp_path / 'work' / 'index.sqlite3'
+    index_path.parent.mkdir()
+    timeline = scan_media([video], index_path)
+    assert detect_spans(timeline, cache_dir=tmp_path / 'scores', index_path=index_path) == [[[0.0, 2.0]]]
+    # 既定のインデックス（カレントディレクトリの下）は作らない
+    assert not (tmp_path / '.cache' / 'media_index.sqlite3').exists()
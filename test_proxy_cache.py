@@ -0,0 +1,40 @@
+import os
+from proxy_cache import ProxyCache, proxy_cache_key
+
+
+def test_cache_key_changes_with_inputs_and_settings(tmp_path):
+    video = tmp_path / 'a.MP4'
+    video.write_bytes(b'1234')
+    settings = dict(fps=None, target_size=10)
+    key = proxy_cache_key([video], settings)
+    assert key == proxy_cache_key([video], dict(settings))
+    assert key != proxy_cache_key([video], dict(settings, target_size=20))
+    video.write_bytes(b'12345')
+    assert key != proxy_cache_key([video], settings)
+
+
+def test_get_copies_cached_proxy(tmp_path):
+    cache = ProxyCache(tmp_path / 'cache')
+    source = tmp_path / 'proxy.mp4'
+    source.write_bytes(b'proxy')
+    output = tmp_path / 'out' / 'video.mp4'
+    assert not cache.get('key', output)
+    cache.put('key', source)
+    assert cache.get('key', output)
+    assert output.read_bytes() == b'proxy'
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ProxyCache(tmp_path / 'cache', max_bytes=10)
+    source = tmp_path / 'proxy.mp4'
+    source.write_bytes(b'x' * 4)
+    cache.put('old', source)
+    cache.put('used', source)
+    os.utime(cache.path_for('old'), (1, 1))
+    os.utime(cache.path_for('used'), (2, 2))
+    # 'used' を参照して最新にする
+    assert cache.get('used', tmp_path / 'out.mp4')
+    cache.put('new', source)
+    assert not cache.path_for('old').exists()
+    assert cache.path_for('used').exists()
+    assert cache.path_for('new').exists()
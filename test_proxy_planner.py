@@ -0,0 +1,58 @@
+from media_index import MediaInfo
+from proxy_planner import plan_proxy, plan_for_timeline, estimate_tokens, width_for, MODEL_INPUT_TOKENS
+
+MB = 1024 * 1024
+
+
+def test_short_video_keeps_resolution_and_audio():
+    plan = plan_proxy(60, 10 * MB, source_fps=30, source_width=1920, source_height=1080)
+    assert plan.height == 720
+    assert plan.fps >= 5
+    assert plan.audio_bitrate == 32000
+    assert plan.fits_token_budget
+
+
+def test_long_video_lowers_fps_resolution_and_audio():
+    plan = plan_proxy(3600, 10 * MB, source_fps=30, source_width=1920, source_height=1080)
+    assert plan.fps == 1
+    assert plan.height < 720
+    assert plan.audio_bitrate is None
+
+
+def test_plan_fits_byte_budget():
+    for duration in (30, 600, 3600):
+        plan = plan_proxy(duration, 10 * MB, source_fps=30, source_width=1920, source_height=1080)
+        assert (plan.video_bitrate + (plan.audio_bitrate or 0)) * duration / 8 <= 10 * MB
+
+
+def test_never_upscales_source():
+    plan = plan_proxy(10, 10 * MB, source_fps=24, source_width=320, source_height=240)
+    assert plan.height == 240
+    assert plan.fps == 15
+
+
+def test_token_budget_drops_audio_and_flags_overflow():
+    plan = plan_proxy(100, 100 * MB, token_budget=estimate_tokens(100, audio=False))
+    assert plan.audio_bitrate is None
+    assert plan.fits_token_budget
+    plan = plan_proxy(100, 100 * MB, token_budget=1000)
+    assert not plan.fits_token_budget
+
+
+def test_default_budget_leaves_room_for_prompt_and_output():
+    # 映像だけで入力の上限に収まっても、プロンプトと出力の分が残らなければ収まらない扱い
+    duration = 3800
+    assert estimate_tokens(duration, audio=False) < MODEL_INPUT_TOKENS
+    assert not plan_proxy(duration, 1000 * MB).fits_token_budget
+
+
+def test_plan_for_timeline_uses_largest_source():
+    timeline = [
+        MediaInfo(path='a', size=1, mtime_ns=1, duration=10, fps=60, width=1280, height=720, has_audio=False),
+        MediaInfo(path='b', size=1, mtime_ns=1, duration=10, fps=30, width=640, height=480, has_audio=True),
+    ]
+    plan = plan_for_timeline(timeline, 20, 10 * MB)
+    assert plan.height == 720
+    assert plan.fps == 30
+    assert plan.audio_bitrate == 32000
+    assert width_for(360, 1280, 720) == 640
@@ -0,0 +1,101 @@
+import re
+import pytest
+import numpy as np
+import timestamp_overlay
+import generate_video_highlight
+from ffmpeg_utils import run_ffmpeg
+from proxy_cache import ProxyCache
+from timestamp_overlay import GlyphAtlas, TIMESTAMP_GLYPHS
+
+
+def fake_atlas(**style):
+    # ImageMagick がなくても動くよう、グリフは単色の矩形にする
+    glyphs = {char: (np.full((4, 2, 3), 255, dtype=np.uint8), np.ones((4, 2), dtype=np.float32))
+              for char in TIMESTAMP_GLYPHS}
+    return GlyphAtlas(glyphs)
+
+
+def stream_durations(video_path, streams=('v', 'a')):
+    """映像と音声のそれぞれの長さ（デコードして測る）"""
+    durations = {}
+    for stream in streams:
+        result = run_ffmpeg(['-i', video_path, '-map', f'0:{stream}', '-f', 'null', '-'], loglevel='info')
+        times = re.findall(r'time=(\d+):(\d+):([\d.]+)', result.stderr)
+        hours, minutes, seconds = times[-1]
+        durations[stream] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return durations
+
+
+def test_parallel_segments_keep_audio_for_files_without_audio(tmp_path, monkeypatch):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    # 1本目は音声なし（concat demuxer は最初のファイルのストリーム構成を使う）
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc2=s=160x90:r=10:d=2', '-pix_fmt', 'yuv420p', video_dir / 'A.MP4'])
+    run_ffmpeg([
+        '-f', 'lavfi', '-i', 'smptebars=s=160x90:r=10:d=2', '-f', 'lavfi', '-i', 'sine=d=2',
+        '-pix_fmt', 'yuv420p', '-shortest', video_dir / 'B.MP4',
+    ])
+    monkeypatch.setattr(timestamp_overlay, 'build_glyph_atlas', fake_atlas)
+
+    output_path = str(tmp_path / 'trip.mp4')
+    merged_path, timeline, _ = generate_video_highlight.merge_videos_with_timestamp(
+        video_dir, output_path, cache=ProxyCache(tmp_path / 'cache'), jobs=2,
+        index_path=tmp_path / 'index.sqlite3', target_size=2 * 1024 * 1024
+    )
+    assert merged_path == output_path
+    durations = stream_durations(output_path)
+    # 音声は全体の長さで、映像とずれない
+    assert abs(durations['v'] - 4) < 0.2
+    assert abs(durations['a'] - durations['v']) < 0.2
+
+
+def test_incremental_append_reuses_written_segments(tmp_path, monkeypatch):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    for name, source in [('A.MP4', 'testsrc2'), ('B.MP4', 'smptebars')]:
+        run_ffmpeg(['-f', 'lavfi', '-i', f'{source}=s=320x180:r=10:d=2', '-pix_fmt', 'yuv420p', video_dir / name])
+    monkeypatch.setattr(timestamp_overlay, 'build_glyph_atlas', fake_atlas)
+    target_size = 200 * 1024
+
+    def merge():
+        return generate_video_highlight.merge_videos_with_timestamp(
+            video_dir, str(tmp_path / 'trip.mp4'), cache=ProxyCache(tmp_path / 'cache'), incremental=True,
+            index_path=tmp_path / 'index.sqlite3', target_size=target_size
+        )
+
+    merge()
+    segment_dir = tmp_path / 'trip.segments'
+    written = {path.name: path.stat().st_mtime_ns for path in segment_dir.glob('*.mp4')}
+    assert len(written) == 2
+
+    # 追加すると全体の計画（ビットレート）は下がるが、書き出し済みのセグメントはそのまま使う
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=s=320x180:r=10:d=2', '-pix_fmt', 'yuv420p', video_dir / 'C.MP4'])
+    merged_path, timeline, _ = merge()
+    segments = {path.name: path.stat().st_mtime_ns for path in segment_dir.glob('*.mp4')}
+    assert len(segments) == 3
+    assert all(segments[name] == mtime for name, mtime in written.items())
+    # 新しいファイルには残りの容量だけを使う
+    assert sum(path.stat().st_size for path in segment_dir.glob('*.mp4')) <= target_size
+    assert abs(stream_durations(merged_path, ('v',))['v'] - 6) < 0.2
+
+
+def frame_sizes(video_path):
+    result = run_ffmpeg(['-i', video_path, '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-'], loglevel='info')
+    return re.findall(r' s:(\d+x\d+) ', result.stderr)
+
+
+@pytest.mark.parametrize('options', [dict(jobs=1), dict(jobs=2), dict(incremental=True)])
+def test_segments_share_one_size_across_orientations(tmp_path, monkeypatch, options):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    # 横長・縦長・小さい横長が混ざったフォルダ
+    for name, size in [('A.MP4', '320x180'), ('B.MP4', '180x320'), ('C.MP4', '320x180'), ('D.MP4', '160x90')]:
+        run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc2=s={size}:r=10:d=1', '-pix_fmt', 'yuv420p', video_dir / name])
+    monkeypatch.setattr(timestamp_overlay, 'build_glyph_atlas', fake_atlas)
+    merged_path, _, _ = generate_video_highlight.merge_videos_with_timestamp(
+        video_dir, str(tmp_path / 'trip.mp4'), cache=ProxyCache(tmp_path / 'cache'),
+        index_path=tmp_path / 'index.sqlite3', target_size=2 * 1024 * 1024, **options
+    )
+    sizes = frame_sizes(merged_path)
+    assert len(sizes) == 40
+    assert set(sizes) == {'320x180'}
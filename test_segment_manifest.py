@@ -0,0 +1,49 @@
+from segment_manifest import (
+    segment_name, load_manifest, save_manifest, manifest_entry, is_reusable, previous_settings
+)
+
+SETTINGS = dict(fps=30.0, codec='libx264')
+
+
+def make_segment(tmp_path, name='C0001.MP4'):
+    video = tmp_path / name
+    video.write_bytes(b'video')
+    segment = tmp_path / segment_name(video)
+    segment.write_bytes(b'segment')
+    return video, segment
+
+
+def test_manifest_round_trip(tmp_path):
+    video, segment = make_segment(tmp_path)
+    entry = manifest_entry(video, segment, 0, 1000, SETTINGS)
+    save_manifest(tmp_path, {str(video): entry})
+    assert load_manifest(tmp_path) == {str(video): entry}
+
+
+def test_reusable_only_when_source_and_settings_match(tmp_path):
+    video, segment = make_segment(tmp_path)
+    entry = manifest_entry(video, segment, 10.0, 1000, SETTINGS)
+    assert is_reusable(entry, video, tmp_path, 10.0, SETTINGS)
+    # 前のファイルの長さが変わると秒数表示がずれる
+    assert not is_reusable(entry, video, tmp_path, 12.0, SETTINGS)
+    assert not is_reusable(entry, video, tmp_path, 10.0, dict(SETTINGS, fps=15.0))
+    video.write_bytes(b'changed video')
+    assert not is_reusable(entry, video, tmp_path, 10.0, SETTINGS)
+
+
+def test_missing_segment_is_not_reusable(tmp_path):
+    video, segment = make_segment(tmp_path)
+    entry = manifest_entry(video, segment, 0, 1000, SETTINGS)
+    segment.unlink()
+    assert not is_reusable(entry, video, tmp_path, 0, SETTINGS)
+    assert not is_reusable(None, video, tmp_path, 0, SETTINGS)
+
+
+def test_previous_settings_keeps_plan_only_when_other_settings_match(tmp_path):
+    video, segment = make_segment(tmp_path)
+    previous = dict(SETTINGS, size=[640, 360], audio_bitrate='32k')
+    entry = manifest_entry(video, segment, 0, 1000, dict(previous, spans=[[0, 1]]))
+    # フレームレート・高さ・音声は書き出し済みのものに合わせる
+    assert previous_settings([entry], dict(SETTINGS, fps=10.0, size=[426, 240], audio_bitrate=None)) == previous
+    assert previous_settings([entry], dict(SETTINGS, codec='libx265', size=[426, 240], audio_bitrate=None)) is None
+    assert previous_settings([], previous) is None
@@ -0,0 +1,130 @@
+import re
+import pytest
+import generate_video_highlight
+import smart_cut
+from ffmpeg_utils import run_ffmpeg
+from highlight_models import VideoHighlight, VideoHighlights
+from media_index import scan_media, probe_media
+from smart_cut import keyframe_times, smart_cut_piece, can_smart_cut, create_smart_highlight_video, reencode_options
+
+
+def make_clip(path, source='testsrc2', size='160x90', audio=True, profile='high', pix_fmt='yuv420p'):
+    """10fps・4秒・GOP 10フレーム（毎秒キーフレーム）のクリップ"""
+    args = ['-f', 'lavfi', '-i', f'{source}=s={size}:r=10:d=4']
+    if audio:
+        args += ['-f', 'lavfi', '-i', 'sine=d=4', '-shortest']
+    args += ['-c:v', 'libx264', '-g', '10', '-keyint_min', '10', '-sc_threshold', '0',
+             '-profile:v', profile, '-pix_fmt', pix_fmt, path]
+    run_ffmpeg(args)
+
+
+def make_timeline(tmp_path, second_size='160x90'):
+    video_dir = tmp_path / 'trip'
+    video_dir.mkdir()
+    make_clip(video_dir / 'A.MP4')
+    # 2本目は音声なし（連結時は無音で揃える）
+    make_clip(video_dir / 'B.MP4', 'smptebars', second_size, audio=False)
+    return scan_media(sorted(video_dir.glob('*.MP4')), tmp_path / 'index.sqlite3')
+
+
+@pytest.fixture
+def mpegts(tmp_path):
+    """区間は MPEG-TS で書き出すので、読めない ffmpeg ではスキップ"""
+    path = tmp_path / 'probe.ts'
+    try:
+        run_ffmpeg(['-f', 'lavfi', '-i', 'color=s=16x16:d=0.1', '-f', 'mpegts', path])
+        run_ffmpeg(['-i', path, '-f', 'null', '-'])
+    except RuntimeError:
+        pytest.skip('ffmpeg が MPEG-TS を読めません')
+
+
+def frame_times(video_path):
+    result = run_ffmpeg(['-i', video_path, '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-'], loglevel='info')
+    return [float(t) for t in re.findall(r'pts_time:([\d.]+)', result.stderr)]
+
+
+def audio_duration(video_path):
+    result = run_ffmpeg(['-i', video_path, '-map', '0:a:0', '-f', 'null', '-'], loglevel='info')
+    hours, minutes, seconds = re.findall(r'time=(\d+):(\d+):([\d.]+)', result.stderr)[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def test_keyframes_and_split_into_head_copy_tail(tmp_path, mpegts):
+    info = make_timeline(tmp_path)[0]
+    keyframes = keyframe_times(info.path)
+    assert keyframes == [0.0, 1.0, 2.0, 3.0]
+
+    paths = smart_cut_piece(info, 0.5, 2.5, tmp_path, 'piece', keyframes)
+    # GOP の途中の頭と尻だけを再エンコードし、キーフレーム間はコピー（次の GOP のフレームは入らない）
+    assert [path.name for path in paths] == ['piece_head.ts', 'piece_copy.ts', 'piece_tail.ts']
+    assert [len(frame_times(path)) for path in paths] == [5, 10, 5]
+
+    # キーフレームに揃った区間はコピーだけ
+    paths = smart_cut_piece(info, 1, 3, tmp_path, 'aligned', keyframes)
+    assert [path.name for path in paths] == ['aligned_copy.ts']
+
+    # コピーできる区間がなければ全体を再エンコード
+    paths = smart_cut_piece(info, 1.2, 1.8, tmp_path, 'short', keyframes)
+    assert [path.name for path in paths] == ['short_full.ts']
+    assert len(frame_times(paths[0])) == 6
+
+
+def test_can_smart_cut_requires_same_format(tmp_path):
+    timeline = make_timeline(tmp_path, second_size='320x180')
+    assert can_smart_cut([(timeline[0], 0, 1), (timeline[0], 2, 3)])
+    assert not can_smart_cut([(timeline[0], 0, 1), (timeline[1], 0, 1)])
+    # 画素フォーマットやプロファイルが違うものも連結しない
+    info = timeline[0]
+    assert not can_smart_cut([(info, 0, 1), (info.model_copy(update=dict(pix_fmt='yuv444p')), 0, 1)])
+    assert not can_smart_cut([(info, 0, 1), (info.model_copy(update=dict(profile='Main')), 0, 1)])
+
+
+def test_reencoded_pieces_match_source_format(tmp_path, mpegts):
+    video_path = tmp_path / 'A.MP4'
+    make_clip(video_path, profile='main')
+    [info] = scan_media([video_path], tmp_path / 'index.sqlite3')
+    assert (info.profile, info.pix_fmt) == ('Main', 'yuv420p')
+    assert reencode_options(info)[-6:] == ['-pix_fmt', 'yuv420p', '-profile:v', 'main', '-r', '10.0']
+    paths = smart_cut_piece(info, 0.5, 2.5, tmp_path, 'piece', keyframe_times(video_path))
+    assert [(probe_media(path).profile, probe_media(path).pix_fmt) for path in paths] == [('Main', 'yuv420p')] * 3
+
+
+def test_unknown_fps_falls_back_to_full_reencode(tmp_path):
+    info = make_timeline(tmp_path)[0].model_copy(update=dict(fps=None))
+    # コピーするフレーム数を決められないので、キーフレームがあっても全体を再エンコード
+    paths = smart_cut_piece(info, 0.5, 2.5, tmp_path, 'piece', [0.0, 1.0, 2.0, 3.0])
+    assert [path.name for path in paths] == ['piece_full.ts']
+
+
+def test_smart_highlight_is_continuous(tmp_path, mpegts):
+    timeline = make_timeline(tmp_path)
+    highlights = [
+        VideoHighlight(start_second=0.5, end_second=2.5, narration=[]),
+        # ファイルの境目をまたぐ区間（音声のないファイルには無音が入る）
+        VideoHighlight(start_second=3.3, end_second=5.7, narration=[]),
+    ]
+    output_path = create_smart_highlight_video(timeline, tmp_path / 'smart.mp4', highlights)
+    times = frame_times(output_path)
+    assert len(times) == 20 + 24
+    # フレームは欠けも重なりもなく並ぶ（区間の境目のずれは1フレーム未満）
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert all(0.05 < gap < 0.15 for gap in gaps)
+    # 音声は区間ごとに AAC の先頭の詰め物（約 23ms）が入る分だけ長くてよい
+    assert abs(audio_duration(output_path) - 4.4) < 0.2
+
+
+def test_render_stage_falls_back_to_moviepy(tmp_path, monkeypatch):
+    timeline = make_timeline(tmp_path, second_size='320x180')
+    highlights = VideoHighlights(highlights=[
+        VideoHighlight(start_second=0.5, end_second=1.5, narration=[]),
+        VideoHighlight(start_second=3.5, end_second=4.5, narration=[]),
+    ])
+    monkeypatch.setattr(smart_cut, 'keyframe_times', None)
+    highlight_video = generate_video_highlight.render_stage(
+        timeline, tmp_path / 'trip.mp4', highlights, render_mode='smart', subtitles='srt'
+    )
+    # 解像度が揃っていないので高速モードは使わず、MoviePy で書き出す
+    assert not list((tmp_path / 'trip_highlight.segments').glob('smart_*.mp4'))
+    # 解像度の違うファイルをまたぐ区間も、フレーム数と音声の長さが区間の長さに合う
+    assert len(frame_times(highlight_video)) == 20
+    assert abs(audio_duration(highlight_video) - 2) < 0.1
@@ -0,0 +1,36 @@
+from highlight_models import Narration, VideoHighlight
+from subtitles import narration_cues, render_subtitles, format_time
+
+
+def make_highlights():
+    return [
+        VideoHighlight(start_second=10, end_second=20, narration=[
+            Narration(narration='最初のカット', start_second=12, end_second=15),
+        ]),
+        VideoHighlight(start_second=100, end_second=130, narration=[
+            Narration(narration='次のカット', start_second=100, end_second=104),
+        ]),
+    ]
+
+
+def test_cues_are_retimed_to_highlight_video():
+    cues = narration_cues(make_highlights(), total_duration=120)
+    # 2つ目のハイライトは120秒で切られるが、開始位置は1つ目の長さ（10秒）の後
+    assert cues == [(2, 5, '最初のカット'), (10, 14, '次のカット')]
+
+
+def test_cues_skip_highlights_after_end():
+    assert narration_cues(make_highlights(), total_duration=50) == [(2, 5, '最初のカット')]
+
+
+def test_format_time():
+    assert format_time(3723.456, 'srt') == '01:02:03,456'
+    assert format_time(3723.456, 'vtt') == '01:02:03.456'
+    assert format_time(3723.456, 'ass') == '1:02:03.45'
+
+
+def test_render_formats():
+    cues = [(2, 5, 'A & B')]
+    assert render_subtitles(cues, 'srt') == '1\n00:00:02,000 --> 00:00:05,000\nA & B\n'
+    assert render_subtitles(cues, 'vtt').startswith('WEBVTT\n\n00:00:02.000 --> 00:00:05.000\nA &amp; B')
+    assert 'Dialogue: 0,0:00:02.00,0:00:05.00,Default,,0,0,0,,A & B' in render_subtitles(cues, 'ass')
@@ -0,0 +1,53 @@
+import numpy as np
+from moviepy.editor import ColorClip
+from timestamp_overlay import GlyphAtlas, TIMESTAMP_GLYPHS, add_timestamp_overlay, timestamp_label
+
+
+def make_atlas():
+    # 文字ごとに色の違う 4x2 の不透明グリフを用意
+    glyphs = {}
+    for i, char in enumerate(TIMESTAMP_GLYPHS):
+        rgb = np.full((4, 2, 3), i * 10, dtype=np.uint8)
+        alpha = np.ones((4, 2), dtype=np.float32)
+        glyphs[char] = (rgb, alpha)
+    return GlyphAtlas(glyphs)
+
+
+def test_stamp_draws_label_at_top_right():
+    atlas = make_atlas()
+    frame = np.full((10, 20, 3), 255, dtype=np.uint8)
+    stamped = atlas.stamp(frame, "12秒")
+    # 右上 4x6 に「1」「2」「秒」の順で描画される
+    assert (stamped[:4, 14:16] == 10).all()
+    assert (stamped[:4, 16:18] == 20).all()
+    assert (stamped[:4, 18:20] == 100).all()
+    # それ以外の領域は変化しない
+    assert (stamped[4:] == 255).all()
+    assert (stamped[:, :14] == 255).all()
+
+
+def test_stamp_blends_with_alpha():
+    glyphs = {char: (np.zeros((2, 2, 3), dtype=np.uint8), np.full((2, 2), 0.5, dtype=np.float32))
+              for char in TIMESTAMP_GLYPHS}
+    atlas = GlyphAtlas(glyphs)
+    frame = np.full((4, 4, 3), 200, dtype=np.uint8)
+    stamped = atlas.stamp(frame, "0秒")
+    assert (stamped[:2, :] == 100).all()
+    # 元のフレームは書き換えないので、同じフレームに何度合成しても結果は同じ
+    assert (frame == 200).all()
+    assert (atlas.stamp(frame, "0秒") == stamped).all()
+
+
+def test_overlay_uses_offset_seconds():
+    atlas = make_atlas()
+    clip = ColorClip((20, 10), color=(255, 255, 255), duration=3).set_fps(10)
+    overlay = add_timestamp_overlay(clip, atlas, offset=5)
+    frame = overlay.get_frame(2.0)
+    # 2秒 + オフセット5秒 = 「7秒」
+    assert (frame[:4, 16:18] == 70).all()
+    assert (frame[:4, 18:20] == 100).all()
+
+
+def test_label_rounds_half_up_like_drawtext():
+    # ffmpeg の drawtext（floor(t + 0.5)）と同じく 0.5 秒は切り上げる
+    assert [timestamp_label(t) for t in (0.49, 0.5, 1.5, 2.5)] == ['0秒', '1秒', '2秒', '3秒']
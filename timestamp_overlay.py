@@ -0,0 +1,81 @@
+import math
+import numpy as np
+
+# オーバーレイに使う文字（経過秒数の数字と「秒」）
+TIMESTAMP_GLYPHS = "0123456789秒"
+
+
+class GlyphAtlas:
+    """数字と「秒」を一枚に並べたグリフアトラス"""
+
+    def __init__(self, glyphs):
+        # glyphs: 文字 -> (RGB画像, アルファ) の辞書
+        height = max(rgb.shape[0] for rgb, _ in glyphs.values())
+        width = sum(rgb.shape[1] for rgb, _ in glyphs.values())
+        self.rgb = np.zeros((height, width, 3), dtype=np.float32)
+        self.alpha = np.zeros((height, width, 1), dtype=np.float32)
+        self.offsets = {}
+        x = 0
+        for char, (rgb, alpha) in glyphs.items():
+            h, w = rgb.shape[:2]
+            self.rgb[:h, x:x + w] = rgb[:, :, :3]
+            self.alpha[:h, x:x + w, 0] = alpha
+            self.offsets[char] = (x, w)
+            x += w
+        self._last_label = None
+        self._last_render = None
+
+    def render(self, label):
+        """ラベル文字列をアトラスから切り出して連結する（直前の結果を再利用）"""
+        if label != self._last_label:
+            slices = [self.offsets[char] for char in label]
+            rgb = np.concatenate([self.rgb[:, x:x + w] for x, w in slices], axis=1)
+            alpha = np.concatenate([self.alpha[:, x:x + w] for x, w in slices], axis=1)
+            self._last_label = label
+            self._last_render = (rgb, alpha)
+        return self._last_render
+
+    def stamp(self, frame, label):
+        """フレームの右上にラベルを合成する"""
+        rgb, alpha = self.render(label)
+        h = min(rgb.shape[0], frame.shape[0])
+        w = min(rgb.shape[1], frame.shape[1])
+        # MoviePy はデコードしたフレームを使い回すので、元のフレームには書き込まない（同じフレームに二重に合成される）
+        frame = frame.copy()
+        region = frame[:h, frame.shape[1] - w:]
+        blended = alpha[:h, -w:] * rgb[:h, -w:] + (1 - alpha[:h, -w:]) * region
+        region[...] = blended.astype(frame.dtype)
+        return frame
+
+
+def build_glyph_atlas(fontsize=24, color='white', bg_color='rgba(0,0,0,0.7)', font=None):
+    """各文字を一度だけTextClipでラスタライズしてアトラスを作成"""
+    from moviepy.editor import TextClip
+
+    options = dict(fontsize=fontsize, color=color, bg_color=bg_color)
+    if font:
+        options['font'] = font
+    glyphs = {}
+    for char in TIMESTAMP_GLYPHS:
+        clip = TextClip(char, **options)
+        rgb = clip.get_frame(0)
+        if clip.mask is not None:
+            alpha = clip.mask.get_frame(0)
+        else:
+            alpha = np.ones(rgb.shape[:2], dtype=np.float32)
+        glyphs[char] = (rgb, alpha)
+        clip.close()
+    return GlyphAtlas(glyphs)
+
+
+def timestamp_label(seconds):
+    """経過秒数の表示（0.5 秒は切り上げ、ffmpeg の drawtext と同じ floor(t + 0.5)）"""
+    return f"{math.floor(seconds + 0.5)}秒"
+
+
+def add_timestamp_overlay(clip, atlas, offset=0):
+    """フレームごとに経過秒数を描画したクリップを返す"""
+    def stamp_frame(get_frame, t):
+        return atlas.stamp(get_frame(t), timestamp_label(t + offset))
+
+    return clip.fl(stamp_frame)